@@ -333,8 +333,8 @@ class CellElementLineStringbase(CellElement):
         >>> l.bounds
         (0, 1, 4, 5)
         """
-        coords = N.array(self._coords)
-        return tuple(coords.min(0)) + tuple(coords.max(0))
+        xs, ys = zip(*self._coords)
+        return min(xs), min(ys), max(xs), max(ys)
         
 class CellElementPOI(CellElementPointbase):
     typecode=16
@@ -672,6 +672,46 @@ class CellElementArea(CellElement):
 
         return cdata, polytype, nvertices
 
+    def clip(self, rec):
+        """Return list of area cell elements of the parts inside the rectangle rec
+
+        >>> a = CellElementArea([[[0,0],[10,0],[10,10],[0,10]], [[1,1],[1,2],[2,2]]], objtype=3)
+        >>> a.clip(Rec((5,-5),(15,5)))
+        [CellElementArea((((5, 0), (10, 0), (10, 5), (5, 5)),),objtype=3)]
+        >>> a.clip(Rec((20,20),(30,30)))
+        []
+        """
+        rings = [clipring(ring, rec) for ring in self._coords]
+        if len(rings[0]) == 0:
+            return []
+        return [CellElementArea([rings[0]] + [ring for ring in rings[1:] if len(ring) > 0],
+                                objtype=self.objtype, textslot=self.textslot)]
+
+    def simplify(self, tolerance):
+        """Return area cell element with vertices removed by the Douglas-Peucker algorithm
+
+        The element itself is returned if no vertices are removed or if the exterior ring
+        would get less than three vertices. Interior rings that get less than three vertices
+        are removed.
+
+        >>> a = CellElementArea([[[0,0],[5,1],[10,0],[10,10],[0,10]], [[2,2],[2,8],[8,8]]], objtype=3)
+        >>> a.simplify(2)
+        CellElementArea((((0, 0), (10, 0), (10, 10), (0, 10)), ((2, 2), (2, 8), (8, 8))),objtype=3)
+        >>> a.simplify(20) is a
+        True
+        """
+        rings = []
+        for i, ring in enumerate(self._coords):
+            kept = douglaspeucker(ring + ring[:1], tolerance)[:-1]
+            if kept.sum() >= 3:
+                rings.append(list(N.array(ring)[kept]))
+            elif i == 0:
+                return self
+
+        if sum(map(len, rings)) == sum(map(len, self._coords)):
+            return self
+        return CellElementArea(rings, objtype=self.objtype, textslot=self.textslot)
+
     def __repr__(self):
         args = [str(self._coords)]
         if self.objtype != None:
@@ -881,6 +921,46 @@ class CellElementPolyline(CellElementLineStringbase):
                                              
         return data        
 
+    def clip(self, rec):
+        """Return list of polyline cell elements of the parts inside the rectangle rec
+
+        >>> l = CellElementPolyline([[0,0],[10,0],[10,10],[0,10]], objtype=2)
+        >>> l.clip(Rec((5,-5),(15,5)))
+        [CellElementPolyline(((5, 0), (10, 0), (10, 5)))]
+        >>> l.clip(Rec((-5,-5),(5,15)))
+        [CellElementPolyline(((0, 0), (5, 0))), CellElementPolyline(((5, 10), (0, 10)))]
+        """
+        return [CellElementPolyline(part, objtype=self.objtype, textslot=self.textslot,
+                                    unk=self.unk)
+                for part in cliplinestring(self._coords, rec)]
+
+    def simplify(self, tolerance, keep=None):
+        """Return polyline cell element with vertices removed by the Douglas-Peucker algorithm
+
+        keep is an optional boolean array that is True for vertices that must not be removed.
+        The element itself is returned if no vertices are removed or if it has routing
+        vertex indices.
+
+        >>> l = CellElementPolyline([[0,0],[5,1],[10,0],[10,10]], objtype=2)
+        >>> l.simplify(2)
+        CellElementPolyline(((0, 0), (10, 0), (10, 10)))
+        >>> l.simplify(2, keep=N.array([False, True, False, False]))
+        CellElementPolyline(((0, 0), (5, 1), (10, 0), (10, 10)))
+        """
+        if len(self.routingvertexindices) > 0:
+            return self
+
+        ## The vertices that were inserted to limit the vertex deltas are removed by
+        ## the simplification but are inserted again when the polyline is created
+        vertices = N.array(self._coords)[douglaspeucker(self._coords, tolerance, keep)]
+        if ninterpolated(vertices) >= len(self._coords):
+            return self
+
+        polyline = CellElementPolyline(list(vertices),
+                                       objtype=self.objtype, textslot=self.textslot, unk=self.unk)
+        polyline.routingattributes = self.routingattributes
+        return polyline
+
 
 
 class CellElementRouting(CellElementLineStringbase):
@@ -1201,6 +1281,15 @@ class Rec(object):
         return Rec(self.c1-v,self.c2+v)
     def iscoveredby(self, rec2, xmargin=0, ymargin=0):
         return N.alltrue(rec2.c1 <= self.c1+xmargin) and N.alltrue(rec2.c2 >= self.c2-ymargin)
+    def intersects(self, rec2):
+        """Return True if the rectangles overlap or touch
+
+        >>> Rec((0, 0), (2, 2)).intersects(Rec((2, 1), (3, 3)))
+        True
+        >>> Rec((0, 0), (2, 2)).intersects(Rec((3, 1), (4, 3)))
+        False
+        """
+        return N.alltrue(self.c1 <= rec2.c2) and N.alltrue(rec2.c1 <= self.c2)
 
     @property
     def wkt(self):
@@ -1263,6 +1352,12 @@ def vlistinterpolate(vlist, maxdelta=127):
               
 
        '''
+    ## Integer vertices are returned unchanged if no vertices need to be inserted
+    vertices = N.asarray(vlist)
+    if vertices.dtype.kind in 'iu' and len(vertices) > 1 and \
+            N.abs(N.diff(vertices, axis=0)).max() <= maxdelta:
+        return list(vlist)
+
     position = vlist[0]
     newvlist = [position]
     for nextvertex in vlist[1:]:
@@ -1273,6 +1368,18 @@ def vlistinterpolate(vlist, maxdelta=127):
 
     return newvlist
 
+def ninterpolated(vlist, maxdelta=127):
+    """Return the number of vertices that vlistinterpolate returns for the vertices vlist
+
+    >>> ninterpolated([[1,1], [0,2], [200,2]])
+    4
+    """
+    vertices = N.asarray(vlist)
+    if len(vertices) < 2:
+        return len(vertices)
+    steps = N.ceil(N.abs(N.diff(vertices, axis=0)).max(axis=1) / float(maxdelta))
+    return 1 + int(N.maximum(steps, 1).sum())
+
 def encodedelta(vlist):
     r'''Encode a list of vertices as the difference between adjacents vertices.
        The result is a string of signed bytes: vlist[1][0]-vlist[0][0], vlist[1][1]-vlist[0][1], vlist[2][0]-vlist[1][0], ...
@@ -1349,6 +1456,136 @@ def rotate_sequence(seq, bbox):
 
     return seq[firstindex:] + seq[:firstindex]
 
+def clipring(ring, rec):
+    """Clip a polygon ring to the rectangle rec using the Sutherland-Hodgman algorithm
+
+    The ring is given and returned as a sequence of vertices without the closing vertex.
+    The clipped vertices are rounded to integers and an empty list is returned if less
+    than three vertices remain. Parts of a concave ring that are connected through the
+    outside of the rectangle are joined by edges along the rectangle border.
+
+    >>> clipring([[0,0],[10,0],[10,10],[0,10]], Rec((5,5),(20,20)))
+    [[10, 5], [10, 10], [5, 10], [5, 5]]
+    >>> clipring([[0,0],[10,0],[10,10]], Rec((20,20),(30,30)))
+    []
+    """
+    vertices = N.asarray(ring, dtype=float)
+    for axis, value, sign in ((0, rec.c1[0], -1), (0, rec.c2[0], 1), 
+                              (1, rec.c1[1], -1), (1, rec.c2[1], 1)):
+        if len(vertices) == 0:
+            break
+        next = N.roll(vertices, -1, axis=0)
+        vertices = _clip_halfplane(vertices, next, axis, value, sign)[0]
+
+    return _rounded(vertices, closed=True)
+
+def cliplinestring(vlist, rec):
+    """Clip a line string to the rectangle rec
+
+    Returns a list of the parts of the line string inside the rectangle with the vertices 
+    rounded to integers.
+
+    >>> cliplinestring([[0,0],[10,0],[10,10]], Rec((5,-5),(20,5)))
+    [[[5, 0], [10, 0], [10, 5]]]
+    >>> cliplinestring([[0,0],[10,0],[10,10],[0,10]], Rec((-5,-5),(5,15)))
+    [[[0, 0], [5, 0]], [[5, 10], [0, 10]]]
+    """
+    parts = [N.asarray(vlist, dtype=float)]
+    for axis, value, sign in ((0, rec.c1[0], -1), (0, rec.c2[0], 1), 
+                              (1, rec.c1[1], -1), (1, rec.c2[1], 1)):
+        newparts = []
+        for vertices in parts:
+            vertices, leaving = _clip_halfplane(vertices[:-1], vertices[1:], axis, value, sign,
+                                                last = vertices[-1])
+            newparts += [part for part in N.split(vertices, N.flatnonzero(leaving) + 1) 
+                         if len(part) > 1]
+        parts = newparts
+
+    return [part for part in [_rounded(vertices) for vertices in parts] if len(part) > 1]
+
+def douglaspeucker(vlist, tolerance, keep=None):
+    """Simplify a line string with the Douglas-Peucker algorithm
+
+    Returns a boolean array that is True for the vertices that are kept. The first and 
+    last vertices and the vertices where keep is True are always kept. The distances of 
+    the vertices between two kept vertices are calculated as one array operation.
+
+    >>> douglaspeucker([[0,0],[5,1],[10,0],[15,-1],[20,0]], 2)
+    array([ True, False, False, False,  True], dtype=bool)
+    >>> douglaspeucker([[0,0],[5,1],[10,0],[15,-1],[20,0]], 0.5)
+    array([ True,  True, False,  True,  True], dtype=bool)
+    """
+    vertices = N.asarray(vlist, dtype=float)
+    kept = N.zeros(len(vertices), dtype=bool)
+    kept[0] = kept[-1] = True
+    if keep is not None:
+        kept |= keep
+
+    anchors = N.flatnonzero(kept)
+    stack = zip(anchors[:-1], anchors[1:])
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        start = vertices[first]
+        delta = vertices[last] - start
+        offsets = vertices[first+1:last] - start
+        length = N.sqrt(N.dot(delta, delta))
+        if length > 0:
+            distances = N.abs(delta[0] * offsets[:, 1] - delta[1] * offsets[:, 0]) / length
+        else:
+            distances = N.sqrt((offsets ** 2).sum(axis=1))
+
+        i = N.argmax(distances)
+        if distances[i] > tolerance:
+            i += first + 1
+            kept[i] = True
+            stack.extend([(first, i), (i, last)])
+
+    return kept
+
+def _clip_halfplane(starts, ends, axis, value, sign, last = None):
+    """Clip the edges from starts to ends to the half plane where sign*(v[axis]-value) <= 0
+
+    Returns the vertices that are kept and the intersection points in order and a
+    boolean array that is True for the vertices where the edges leave the half plane.
+    If last is given the edges form an open line string that ends in last.
+    """
+    startdist = sign * (starts[:, axis] - value)
+    enddist = sign * (ends[:, axis] - value)
+    inside = startdist <= 0
+    crossing = inside != (enddist <= 0)
+
+    intersections = starts.copy()
+    t = startdist[crossing] / (startdist[crossing] - enddist[crossing])
+    intersections[crossing] = starts[crossing] + t[:, N.newaxis] * (ends[crossing] - starts[crossing])
+    intersections[crossing, axis] = value
+
+    vertices = N.concatenate((starts[:, N.newaxis], intersections[:, N.newaxis]), axis=1).reshape(-1, 2)
+    keep = N.column_stack((inside, crossing)).ravel()
+    leaving = N.column_stack((N.zeros(len(starts), dtype=bool), crossing & inside)).ravel()
+
+    if last is not None and sign * (last[axis] - value) <= 0:
+        vertices = N.concatenate((vertices, [last]))
+        keep = N.concatenate((keep, [True]))
+        leaving = N.concatenate((leaving, [False]))
+
+    return vertices[keep], leaving[keep]
+
+def _rounded(vertices, closed=False):
+    """Round vertices to integers and remove repeated vertices"""
+    vertices = N.round(vertices).astype(int)
+    if len(vertices) > 1:
+        keep = N.concatenate(([True], N.any(vertices[1:] != vertices[:-1], axis=1)))
+        vertices = vertices[keep]
+    if closed:
+        if len(vertices) > 1 and N.all(vertices[0] == vertices[-1]):
+            vertices = vertices[:-1]
+        if len(vertices) < 3:
+            return []
+    return vertices.tolist()
+
 class RoutingAttributes(object):
     """Routing attributes that are attached to a CellElementPolyLine object and then copied
     to the routing edges when the routing network is constructed
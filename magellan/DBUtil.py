@@ -5,6 +5,7 @@ import struct
 import zlib
 import tempfile
 import shutil
+from lrucache import LRUCache
 
 def sortHashFunc(name):
     """Hash function used for indexing auxillary string tables and POI categories"""
@@ -349,6 +350,22 @@ class File:
 
         return data[offset:offset+self.fstruct.ft_slsize]
 
+    def readSlots(self, start=1, stop=None):
+        """Iterate over the data of slot start to stop-1, each page is only read once"""
+        if stop == None:
+            stop = self.pz.next
+
+        slot = start
+        while slot < stop:
+            page = ((slot-1)/self.fstruct.ft_slots)+1
+            data = self.readPage(page)
+
+            pagestop = min(stop, page*self.fstruct.ft_slots+1)
+            for s in xrange(slot, pagestop):
+                offset = self.fstruct.ft_slsize*((s-1) % self.fstruct.ft_slots)+4
+                yield data[offset:offset+self.fstruct.ft_slsize]
+            slot = pagestop
+
     def readPage(self, pagenum):
         if pagenum >= self.npages:
             raise ValueError, "Trying to read from an non-existent page (%d/%d)"%(pagenum,self.npages)
@@ -720,6 +737,73 @@ class Table(object):
     def getColumnNames(self):
         return [fs.name for fs in self.db.schema.getFieldStructsByRecordStruct(self.rstruct)]
 
+    def getColumn(self, name):
+        "Return a list of the values of a column in all rows"
+        return self.getColumns([name])[0]
+
+    def getColumns(self, names):
+        "Return a list of the values in all rows for each of the columns in names. The rows are read once"
+        fdstructs = [self.db.schema.getFieldStructsByRecordStruct(self.rstruct)[self.getColumnIndex(name)]
+                     for name in names]
+        types = [fdstruct.getStructTypeString() for fdstruct in fdstructs]
+        
+        columns = [[] for name in names]
+        for data in self.getFile().readSlots():
+            for fdstruct, fdtypes, values in zip(fdstructs, types, columns):
+                value = self.db.unpack(fdtypes, data[fdstruct.fd_ptr: fdstruct.fd_ptr+fdstruct.fd_len])
+                if fdstruct.fd_dim1 == 0 or fdtypes[-1]=='s':
+                    value = value[0]
+                values.append(value)
+        return columns
+
+    def writeRows(self, columns):
+        """Append rows given as a dictionary of column names and sequences of values
+
+        Columns that are not given are set to zero. The record layout is only looked
+        up once for all the rows.
+        """
+        rnum = self.db.getTableIndex(self)
+        assert rnum < 2**16
+        endian = self.db.bigendian and '>' or '<'
+
+        fields = []
+        for fdstruct in self.db.schema.getFieldStructsByRecordStruct(self.rstruct):
+            if fdstruct.name in columns:
+                fields.append((struct.Struct(endian + fdstruct.getStructTypeString()),
+                               fdstruct.fd_ptr, columns[fdstruct.name]))
+        nrows = max([len(values) for packer, ptr, values in fields] + [0])
+
+        ## The table index and db address are followed by the set and member pointers which
+        ## are all zero in a new row
+        file = self.getFile()
+        header = struct.Struct(endian + 'HI')
+        template = chr(0)*self.rstruct.rt_len
+        for i in xrange(nrows):
+            data = bytearray(template)
+            header.pack_into(data, 0, rnum, int(file.getNextDBAddr()))
+            for packer, ptr, values in fields:
+                packer.pack_into(data, ptr, values[i])
+            file.writeSlot(str(data))
+
+    def getRows(self, indices):
+        """Return a dictionary of rows keyed by row index. Consecutive rows are read in one pass"""
+        rows = {}
+        indices = sorted(set(indices))
+        file = self.getFile()
+
+        i = 0
+        while i < len(indices):
+            ## Find run of consecutive rows
+            j = i
+            while j+1 < len(indices) and indices[j+1] == indices[j]+1:
+                j += 1
+
+            for index, data in zip(indices[i:j+1], file.readSlots(indices[i]+1, indices[j]+2)):
+                rows[index] = Row(self, data)
+            i = j+1
+
+        return rows
+
     def getCursor(self, n):
         "Return cursor at row n"
         return Cursor(self, n)
@@ -834,20 +918,45 @@ class Row(object):
         return str(self.asDict())
 
 class AuxTableManager(object):
-    def __init__(self, table, endchar=chr(0), searchindex=True):
+    """Reader and writer of auxillary string tables
+
+    The strings are stored back to back in fixed length rows and are referenced by
+    textslots. When writing, the text is buffered and only complete rows are written
+    to the table.
+
+    Arguments:
+    table: aux table
+    endchar: string terminator
+    searchindex: if True the first row is reserved for the first character search index
+    cachesize: number of recently written strings whose textslots are remembered so that
+               identical strings share the same textslot. 1 reuses textslots of consecutive
+               identical strings only, None means no limit and 0 disables the reuse
+    """
+    def __init__(self, table, endchar=chr(0), searchindex=True, cachesize=1):
         self.table = table
         self.endchar = endchar
         self.rowlen = table.getColumnDimensions(0)[0]
-        self.outtext = ""
+        self.outtext = []     # Pending text that has not been written to the table yet
+        self.outtextlen = 0
         self.slotnum = 0
         self.has_searchindex = searchindex
 
         self.index = (self.rowlen/4)*[0]
         self.lasttext = None
+        self.lasttextslot = None
+
+        if cachesize == None:
+            self.textslots = {}
+        elif cachesize > 1:
+            self.textslots = LRUCache(size=cachesize)
+        else:
+            self.textslots = None
+        self.cachesize = cachesize
 
     def appendText(self, text, refslot = None):
         """Append a string to an aux-table.
-           Returns textslot as 0xooiiiiii where oo is the offset and iiiiii is the row index."""
+           Returns textslot as 0xooiiiiii where oo is the offset and iiiiii is the row index.
+           If the string has been written before and is still remembered the old textslot is returned"""
 
         ## Reserve space for search index
         if self.slotnum == 0 and self.has_searchindex:
@@ -855,22 +964,40 @@ class AuxTableManager(object):
             self.table.writeRow(row)
             self.slotnum += 1
 
-        ## Update index
-        if text != self.lasttext and refslot != None:
-            self.index[sortHashFuncFast(text)] = refslot
-            self.lasttext = text
-        
-        offset = len(self.outtext)
+        ## Update index with the first slot of each hash bucket
+        if refslot != None and text != self.lasttext:
+            bucket = sortHashFuncFast(text)
+            if self.index[bucket] == 0:
+                self.index[bucket] = refslot
+
+        ## Reuse textslot of identical strings
+        if text == self.lasttext and self.cachesize != 0:
+            return self.lasttextslot
+        if self.textslots != None and text in self.textslots:
+            textslot = self.textslots[text]
+            self.lasttext, self.lasttextslot = text, textslot
+            return textslot
+
+        offset = self.outtextlen
         textslot =  (offset << 24) | self.slotnum
-        
-        self.outtext += text+self.endchar
 
-        if len(self.outtext) >= self.rowlen:
-            row = Row(self.table)
-            row.setColumnString(0, self.outtext[0:self.rowlen])
-            self.outtext = self.outtext[self.rowlen:]
-            self.table.writeRow(row)
-            self.slotnum += 1
+        self.outtext.append(text+self.endchar)
+        self.outtextlen += len(text) + len(self.endchar)
+
+        if self.outtextlen >= self.rowlen:
+            outtext = ''.join(self.outtext)
+            while len(outtext) >= self.rowlen:
+                row = Row(self.table)
+                row.setColumnString(0, outtext[0:self.rowlen])
+                self.table.writeRow(row)
+                self.slotnum += 1
+                outtext = outtext[self.rowlen:]
+            self.outtext = [outtext]
+            self.outtextlen = len(outtext)
+
+        if self.textslots != None:
+            self.textslots[text] = textslot
+        self.lasttext, self.lasttextslot = text, textslot
 
         return textslot
 
@@ -880,13 +1007,40 @@ class AuxTableManager(object):
 
         [data] = self.table.getCursor(index).getRow().asList()
 
+        ## The string may continue in the next row
         try:
-            [data2] = self.table.getCursor(index).getRow().asList()
+            [data2] = self.table.getCursor(index+1).getRow().asList()
         except ValueError:
             data2 = ""
 
-        data =  data + data2
+        return self._decodeText(data + data2, offset, maxlen)
+
+    def lookupTexts(self, textslots, maxlen=None):
+        """Look up a sequence of strings given by their textslots. The needed rows are read in bulk"""
+        nrows = self.table.getRowCount()
+        indices = []
+        for textslot in textslots:
+            if textslot >> 24 != 0xff:
+                index = textslot & 0xffffff
+                indices.append(index)
+                if index+1 < nrows:
+                    indices.append(index+1)
+
+        rows = self.table.getRows(indices)
+
+        texts = []
+        for textslot in textslots:
+            index, offset = textslot & 0xffffff, textslot >> 24
+            if offset == 0xff:
+                texts.append("")
+            else:
+                data = rows[index].asList()[0]
+                if index+1 in rows:
+                    data += rows[index+1].asList()[0]
+                texts.append(self._decodeText(data, offset, maxlen))
+        return texts
 
+    def _decodeText(self, data, offset, maxlen=None):
         data = data[offset: ]
 
         length=None
@@ -905,15 +1059,27 @@ class AuxTableManager(object):
         return data
 
     def flush(self):
-        if len(self.outtext)>0:
+        if self.outtextlen > 0:
             row = Row(self.table)
-            row.setColumnString(0, self.outtext)
+            row.setColumnString(0, ''.join(self.outtext))
             self.table.writeRow(row)
-            self.outtext = ''
+            self.slotnum += 1
+            self.outtext = []
+            self.outtextlen = 0
 
         if self.has_searchindex:
             self.writeIndex()
 
+    def readIndex(self):
+        """Read first character search index from the table. The index maps the sort hash
+           of the first character to the (1-based) reference slot of the first string"""
+        try:
+            [data] = self.table.getCursor(0).getRow().asList()
+        except ValueError:
+            return len(self.index)*[0]
+
+        return list(self.table.db.unpack('%dI'%len(self.index), data[:4*len(self.index)]))
+
     def writeIndex(self):
         if self.slotnum > 0:
             row = Row(self.table)
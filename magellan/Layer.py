@@ -8,7 +8,7 @@ import os
 import tempfile
 import shutil
 import numpy as N
-from itertools import izip
+from itertools import izip, groupby
 import shelve
 import logging
 
@@ -78,6 +78,10 @@ class LayerStyle(object):
     purpose = LayerPurposeNormal
     
     _style = 'US_INTERSTATE_HW_LINE'
+
+    ## Length in pixels of the scale bar whose length in meters is given by the zoom levels
+    scalebarpixels = 50
+    
     def __init__(self, layerinfostr=None, style=None, color=None):
         if layerinfostr:
             fields = re.split('\s+', layerinfostr)
@@ -134,6 +138,20 @@ class LayerStyle(object):
             self.hidebasemaprange.append((int(fields[4]), int(fields[5])))
             fields = fields[6:]
     
+    def pixelsize(self):
+        """Return the size in meters of a pixel at the most detailed zoom level where the
+        layer is visible
+
+        >>> DetailMapLayerStyle().pixelsize()
+        1.0
+        >>> ls = LayerStyle()
+        >>> ls.setvisibilitystr(5 * '4 6 0 0 0 0 ')
+        >>> ls.pixelsize()
+        20.0
+        """
+        minzoomlevel = min([zoomrange[0] for zoomrange in self.visiblerange])
+        return float(zoomlevels[minzoomlevel]) / self.scalebarpixels
+
     def setStyle(self, style):
         self._style = style
     def getStyle(self):
@@ -377,6 +395,12 @@ class Layer(object):
         self.packed = False
         self.packer = None
 
+        ## Cell level that polygons and polylines spanning several cells are split at
+        self.splitlevel = None
+
+        ## Tolerance in meters of the simplification of polygons and polylines
+        self.simplifytolerance = None
+
     def __eq__(self, a):
         return isinstance(a, Layer) and self.name == a.name
     
@@ -439,7 +463,8 @@ class Layer(object):
         At the beginning there is only one cell but with the new nlevel value the number of cells
         may grow. Hence the cell elements might have to be placed in new cells.
 
-        Returns a dictionary of mapping between old and new cellreferences
+        Returns a dictionary of mapping between old and new cellreferences. If a cell element
+        was split the new cell reference is a list of the references of the parts.
         
         """
 
@@ -478,7 +503,10 @@ class Layer(object):
                 for i in range(len(oldcell1)-1,-1,-1):
                     ce = oldcell1.pop(i)
                     newcellrefs = self.addCellElement(ce)
-                    remapdict[(oldcell1.cellnum, i)] = newcellrefs[0]
+                    if len(newcellrefs) == 1:
+                        remapdict[(oldcell1.cellnum, i)] = newcellrefs[0]
+                    else:
+                        remapdict[(oldcell1.cellnum, i)] = newcellrefs
 
             return remapdict
         else:
@@ -516,6 +544,12 @@ class Layer(object):
             tmplay.seek(0)
             self.write_header(tmplay)
 
+            # The layer file is opened for reading in append mode. The unchanged cells
+            # have been copied so it can be reopened for writing
+            if self.mode == 'a':
+                self.fhlay.close()
+                self.fhlay = self.map.mapdir.open(self.layerfilename, "wb")
+
             # Copy temporary file to layer file
             tmplay.close()
             tmplay = open(tmplay.name, 'rb')
@@ -738,51 +772,141 @@ class Layer(object):
 	
     def addCellElement(self, cellelem, cellnum = None):
         """Add cell element to layer. The element might be divided into smaller elements.
-         Returns list of (cellnum,# in cell) pairs"""
+         Returns list of (cellnum,# in cell) pairs
+
+         If the splitlevel attribute is set, polygons and polylines that span several cells
+         at that level are clipped to the cells and each part is added to its cell."""
         if self.mode in ('r', None):
             raise ValueError('Layer must be opened in write or append mode to add cell elements')
 
-        ## Calculate the minimum cell that contains the extents of the new element
-        if self._bbox != None:
-            if cellnum == None:
-                cellnum, level, dcellrec = get_best_cell(self._dbbox,
-                                                        cellelem.dbboxrec.negY(),
-                                                        self.nlevels)
+        if cellnum == None or self._bbox == None or self.nlevels == 0:
+            cellnum = self._selectCell(cellelem)
+
+            if self.splitlevel != None and hasattr(cellelem, 'clip') and \
+                    cell_level(cellnum) < min(self.splitlevel, self.nlevels):
+                refs = self._addSplitCellElement(cellelem, min(self.splitlevel, self.nlevels))
+                if len(refs) > 0:
+                    return refs
 
 #            assert cellelem.bboxrec(self).iscoveredby(self.bboxrec, xmargin=self._scale[0], ymargin=self._scale[1]), "CellElement is outside layer boundaries:" + \
 #                   str(self.bboxrec(self)) + " cellelement:" + str(cellelem.bboxrec(self))
+
+        cellelem.cellnum = cellnum
+
+        return self._addToCell(cellnum, [cellelem])
+
+    def _selectCell(self, cellelem):
+        """Return the number of the minimum cell that contains the extents of a cell element.
+        A layer without cell levels only has the top cell"""
+        if self._bbox != None and self.nlevels > 0:
+            cellnum, level, dcellrec = get_best_cell(self._dbbox,
+                                                    cellelem.dbboxrec.negY(),
+                                                    self.nlevels)
+            return cellnum
         else:
             if self.nlevels > 0:
                 raise ValueError('Cannot add cell element to layer with nlevels>0 and no bounding box')
-            cellnum = 1
 
-            self.estimator.addCellElement(cellelem)
-         
-        cellelem.cellnum = cellnum
-        
+            if self._bbox == None:
+                self.estimator.addCellElement(cellelem)
+
+            return 1
+
+    def _addToCell(self, cellnum, cellelements):
+        """Add cell elements to a cell and mark the cell as modified.
+        Returns list of (cellnum,# in cell) pairs, one for each cell element"""
         cell = self.getCell(cellnum)
 
-        assert cell.bboxrec == None or \
-            cellelem.dbboxrec.iscoveredby(cell.dbboxrec), \
-            "Incorrect cell %d with bbox %s for cell element with bbox %s"%(cellnum, cell.dbboxrec, str(cellelem.dbboxrec))
-        
-        nincell = cell.addCellElement(cellelem)
-        
-        assert self.nlevels == 0 or nincell < 2**16
-        
+        refs = []
+        for cellelem in cellelements:
+            assert cell.bboxrec == None or \
+                cellelem.dbboxrec.iscoveredby(cell.dbboxrec), \
+                "Incorrect cell %d with bbox %s for cell element with bbox %s"%(cellnum, cell.dbboxrec, str(cellelem.dbboxrec))
+
+            nincell = cell.addCellElement(cellelem)
+
+            assert self.nlevels == 0 or nincell < 2**16
+
+            refs.append((cellnum, nincell))
+
         if not cell in self.modifiedcells:
             self.modifiedcells[cellnum] = cell
         if not cellnum in self.cellnumbers:
             self.cellnumbers.append(cellnum)
 
-        self.nobjects += 1
+        self.nobjects += len(cellelements)
+
+        return refs
+
+    def _addSplitCellElement(self, cellelem, level):
+        """Clip cell element to the cells at the given level that it overlaps and add the parts.
+        Returns list of (cellnum,# in cell) pairs of the parts"""
+        n = 2 ** level
+        cellsize = N.array([self._dbbox.width, self._dbbox.height]) / n
+        dbbox = cellelem.dbboxrec.negY()
+        mincol, minrow = N.clip((dbbox.c1 - self._dbbox.c1) // cellsize, 0, n - 1).astype(int)
+        maxcol, maxrow = N.clip((dbbox.c2 - self._dbbox.c1) // cellsize, 0, n - 1).astype(int)
+
+        refs = []
+        for row in range(minrow, maxrow + 1):
+            for col in range(mincol, maxcol + 1):
+                cellnum = totcells_at_level(level - 1) + 1 + row * n + col
+                for part in cellelem.clip(self.calc_cell_extents(cellnum).negY()):
+                    refs += self.addCellElement(part, cellnum)
+        return refs
+
+    def addCellElements(self, cellelements):
+        """Add several cell elements to layer. The cell elements are added cell by cell so
+        each cell is only fetched once. The cell elements are not split, so the splitlevel
+        attribute must not be set.
+        Returns list of (cellnum,# in cell) pairs, one for each cell element"""
+        if self.mode in ('r', None):
+            raise ValueError('Layer must be opened in write or append mode to add cell elements')
+
+        if self.splitlevel != None:
+            raise ValueError('Cannot add several cell elements to a layer with a split level, use addCellElement')
+
+        ## Group the cell elements by cell in order of first appearance
+        cellindices = {}
+        cellnums = []
+        for i, cellelem in enumerate(cellelements):
+            cellnum = self._selectCell(cellelem)
+            cellelem.cellnum = cellnum
+
+            if cellnum not in cellindices:
+                cellindices[cellnum] = []
+                cellnums.append(cellnum)
+            cellindices[cellnum].append(i)
 
-        return [(cellnum, nincell)]
+        refs = len(cellelements) * [None]
+        for cellnum in cellnums:
+            for i, ref in zip(cellindices[cellnum], 
+                              self._addToCell(cellnum, [cellelements[i] for i in cellindices[cellnum]])):
+                refs[i] = ref
+
+        return refs
 
     def updateCellElement(self, cellelementref, cellelement):
         """the updateCellElement must be called when a cell element has been updated"""
         self.getCell(cellelementref[0]).updateElement(cellelementref[1], cellelement)
 
+    def setCellElementAttributes(self, updates, attributes):
+        """Set attributes of several cell elements
+
+        updates is a sequence of (cellelementref, values) pairs where values is a tuple
+        with a value for each attribute name in attributes. The updates are applied in
+        cell order so each cell is only fetched once.
+        """
+        updates = sorted(updates, key=lambda update: update[0])
+
+        for cellnum, cellupdates in groupby(updates, key=lambda update: update[0][0]):
+            cell = self.getCell(cellnum)
+            for (cellnum, nincell), values in cellupdates:
+                cellelement = cell.getCellElement(nincell)
+                for name, value in zip(attributes, values):
+                    setattr(cellelement, name, value)
+                cell.updateElement(nincell, cellelement)
+
     def getName(self):
         return self.name
 
@@ -867,10 +991,7 @@ class Layer(object):
 
         Note, the extents return is in the internal coordinates with negated Y-values
         """
-        ## Calculate cell level
-        level=0
-        while cellnum > totcells_at_level(level):
-           level=level+1
+        level = cell_level(cellnum)
 
         n = 2**level             # Number of rows/cols 
 
@@ -897,6 +1018,44 @@ class Layer(object):
 
         return Rec(mincorner + lbb.c1, maxcorner + lbb.c1)
 
+    def calc_cells_intersecting(self, level, rec):
+        """
+        Return the numbers of the cells at a level whose extents intersect rec, touching
+        cells are included. The cells of a level are the unshifted cells followed by the
+        cells shifted half a cell.
+
+        Note, rec is in the internal coordinates with negated Y-values like the extents
+        returned by calc_cell_extents
+        """
+        n = 2**level
+
+        lbb = self._dbbox
+        layersize = N.array([lbb.width, lbb.height])
+        cellsize = layersize / n
+
+        ## Limit rec to the layer, the shifted cells are clipped at the layer border
+        lo = N.maximum(rec.c1 - lbb.c1, 0)
+        hi = N.minimum(rec.c2 - lbb.c1, layersize)
+        if (lo > hi).any():
+            return []
+
+        first = totcells_at_level(level-1) + 1
+
+        ## Index ranges of the unshifted cells
+        rmin = N.maximum(N.ceil(lo / cellsize.astype(float)).astype(int) - 1, 0)
+        rmax = N.minimum(N.floor(hi / cellsize.astype(float)).astype(int), n-1)
+        cellnums = [first + col + n*row
+                    for row in range(rmin[1], rmax[1]+1) for col in range(rmin[0], rmax[0]+1)]
+
+        if level > 0:
+            ## Index ranges of the shifted cells
+            smin = N.maximum(N.ceil((lo - cellsize/2) / cellsize.astype(float)).astype(int), 0)
+            smax = N.minimum(N.floor((hi + cellsize/2) / cellsize.astype(float)).astype(int), n)
+            cellnums += [first + n*n + col + (n+1)*row
+                         for row in range(smin[1], smax[1]+1) for col in range(smin[0], smax[0]+1)]
+
+        return cellnums
+
     def layer_header_nok(self, pcnt):
         """Header check from magsendtool"""
 	
@@ -1019,18 +1178,50 @@ class LayerParamEstimator(object):
             for cellnum, cellelementinfolist in sizeestimates.items():
                 for i in xrange(len(cellelementinfolist)-1,-1,-1):
                     newcellnum = max_cellno_containing_bbox(self.layer.dbboxrec.negY(), cellelementinfolist[i][0].negY(), nlevels)
+
+                    ## Cell elements that the layer will split are divided into parts
+                    if self.layer.splitlevel != None and \
+                            cell_level(newcellnum) < min(self.layer.splitlevel, nlevels):
+                        parts = self.splitCellElementInfo(cellelementinfolist.pop(i),
+                                                          min(self.layer.splitlevel, nlevels))
+                    elif newcellnum != cellnum:
+                        parts = [(newcellnum, cellelementinfolist.pop(i))]
+                    else:
+                        parts = []
+
                     ## If cell is updated move the item to the new cell
-                    if newcellnum != cellnum:
-                        cellelementinfo = cellelementinfolist.pop(i)
+                    for newcellnum, cellelementinfo in parts:
                         if newcellnum in sizeestimates:
                             sizeestimates[newcellnum].append(cellelementinfo)
                         else:
                             sizeestimates[newcellnum] = [cellelementinfo]
 
-        raise Exception('Could not determine number of cell levels of layer'%self.layer.name +
+        raise Exception('Could not determine number of cell levels of layer %s'%self.layer.name +
                         ', try increasing maxnlevels' )
 
 
+    def splitCellElementInfo(self, cellelementinfo, level):
+        """Divide the size estimate of a cell element among the cells at the given level that 
+        its bounding box overlaps. Returns a list of (cellnum, (bbox, datasize)) pairs"""
+        layerbbox = self.layer.dbboxrec.negY()
+        bbox = cellelementinfo[0].negY()
+        n = 2 ** level
+        cellsize = N.array([layerbbox.width, layerbbox.height], dtype=float) / n
+        mincol, minrow = N.clip((bbox.c1 - layerbbox.c1) // cellsize, 0, n - 1).astype(int)
+        maxcol, maxrow = N.clip((bbox.c2 - layerbbox.c1) // cellsize, 0, n - 1).astype(int)
+
+        parts = []
+        for row in range(minrow, maxrow + 1):
+            for col in range(mincol, maxcol + 1):
+                cellmin = layerbbox.c1 + N.array([col, row]) * cellsize
+                ## The part is kept inside the cell so it stays there at the next levels
+                partbbox = Rec(N.maximum(bbox.c1, cellmin),
+                               N.minimum(bbox.c2, cellmin + cellsize * (1 - 1e-6)))
+                parts.append((totcells_at_level(level - 1) + 1 + row * n + col, partbbox.negY()))
+
+        return [(cellnum, (partbbox, float(cellelementinfo[1]) / len(parts)))
+                for cellnum, partbbox in parts]
+
     def calculateDBBox(self):
         """Calculate estimated bounding box of layer in discrete coordinates"""
         if N.alltrue(self.dbboxmin == self.layer.float2discrete((N.array([180.0, 90.0]),))):
@@ -1077,10 +1268,11 @@ def get_best_cell(bounds, r, max_cell_level):
         # Normalise rectangle's coordinates to within 0 to i-1
         v = (bounds.s - bounds.n) / i   # vertical normalisation factor
         h = (bounds.e - bounds.w) / i   # horizontal normalisation factor
-        n = (r.n - bounds.n) / v
-        s = (r.s - bounds.n) / v
-        w = (r.w - bounds.w) / h
-        e = (r.e - bounds.w) / h
+        ## The coordinates of point elements are floats
+        n = int((r.n - bounds.n) / v)
+        s = int((r.s - bounds.n) / v)
+        w = int((r.w - bounds.w) / h)
+        e = int((r.e - bounds.w) / h)
 
         # Find the best "direct" cell (without half cell shifting)
         m = (n ^ s) | (w ^ e)
@@ -1195,6 +1387,17 @@ def max_cellno_containing_bbox(layerbbox, bbox, maxlevels):
 
     return cellnum
 
+def cell_level(cellnum):
+    """Return the level of a cell
+
+    >>> [cell_level(cellnum) for cellnum in (1, 2, 5, 6, 14, 15)]
+    [0, 1, 1, 1, 1, 2]
+    """
+    level = 0
+    while cellnum > totcells_at_level(level):
+        level += 1
+    return level
+
 # Function totcells_at_level(n)
 #
 # Description:  Function that calculates the number of cells at level n
@@ -18,6 +18,7 @@ import numpy as N
 import logging
 from misc import cfg_readlist, cfg_writelist
 import routing
+import routinggraph
 
 def createMap(dir, **kvargs):
     return Map(mapdir.MapDirectory(dir), **kvargs)
@@ -103,6 +104,8 @@ class Map(object):
         else:
             self.routingcfg = None
 
+        self._routinggraph = None ## Routing graph loaded by getRoutingGraph
+
         ## Set endian
         self.bigendian = bigendian
 
@@ -360,6 +363,8 @@ class Map(object):
         
         write = self.mode in ['a','w']
 
+        self._routinggraph = None
+
         
         ## Optimize layers in groups
         logging.info('Optimizing cell structure of normal layers')
@@ -377,7 +382,8 @@ class Map(object):
                 self.routingcfg.build_routing_network(self)
                 
             elif self.mode == 'a':
-                raise Exception('Updating of routing network not implemented')
+                logging.info('Updating routing network')
+                self.routingcfg.update_routing_network(self)
 
             ## Copying routing data file
             self.mapdir.copyfile(os.path.join(datadir, 'routing.dat'))
@@ -546,6 +552,13 @@ class Map(object):
         if self.maptype != MapTypeStreetRoute:
             raise ValueError('Map is not of type street route')
         self.routingcfg.addRoutingLayer(self, layer, routingsetnumber, direction = 'N', speed = (1, 1))
+
+    def getRoutingGraph(self):
+        """Return routing graph of the routing network. The graph is loaded from the routing edge
+        layers the first time and then kept until the map is closed"""
+        if self._routinggraph == None:
+            self._routinggraph = routinggraph.RoutingGraph.fromMap(self)
+        return self._routinggraph
        
     def _updatecfg(self):
         """Update cfg data"""
@@ -49,25 +49,31 @@ class OGRExporter:
             for field,fieldtype in zip(group.getFeatureExportFields(), group.getFeatureExportFieldTypes()):
                 ogrlayer.CreateField(ogr.FieldDefn(field, type2ogrtype[fieldtype]))
 
-        for cellelement in layer.getCellElements():
-            # Insert cellelement
-            f = ogr.Feature(feature_def=ogrlayer.GetLayerDefn())
-            f.SetGeometryDirectly(ogr.CreateGeometryFromWkt(cellelement.wkt))
+        for cell in layer.getCells():
+            cellelements = list(cell.getCellElements())
 
-            excess = " ".join(["0x%02x"%ord(x) for x in cellelement.excess])
+            # Look up the group features of all cell elements in the cell at once
+            if group:
+                groupfeatures = group.getFeaturesByCellElements(cellelements)
+            else:
+                groupfeatures = len(cellelements) * [None]
 
-            for i, field in enumerate(layerfields):
-                f.SetField(i, str(getattr(cellelement, field)))
+            for cellelement, groupfeature in zip(cellelements, groupfeatures):
+                # Insert cellelement
+                f = ogr.Feature(feature_def=ogrlayer.GetLayerDefn())
+                f.SetGeometryDirectly(ogr.CreateGeometryFromWkt(cellelement.wkt))
 
-            if group:
-                groupfeature = group.getFeatureByCellElement(cellelement)
+                excess = " ".join(["0x%02x"%ord(x) for x in cellelement.excess])
+
+                for i, field in enumerate(layerfields):
+                    f.SetField(i, str(getattr(cellelement, field)))
 
                 if groupfeature != None:
                     for i,field in enumerate(groupfeature.exportToList(group)):
                         f.SetField(i+dbfields,field)
 
-            ogrlayer.CreateFeature(f)
+                ogrlayer.CreateFeature(f)
 
-            f.Destroy()
+                f.Destroy()
 
 
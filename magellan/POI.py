@@ -3,10 +3,16 @@ import DBUtil
 from DBUtil import AuxTableManager, Row, sortHashFunc
 from DBSchema import FieldStruct, FieldTypeLONGINT,FieldTypeSHORTINT,FieldTypeCHARACTER,SetSortOrderAscending
 import DBSchema
-from SearchGroup import Group,Feature
+from SearchGroup import Group,Feature,FeatureView
 from sets import Set
 import Layer
+from CellElement import Rec
 import operator
+import heapq
+import math
+from itertools import izip
+import numpy as N
+from misc import earthradius
 
 POIIcons = ['AERIAL', 'AIRPORTS', 'AMUSEMENT', 'AMUSEMENT_PARK', 'ARCH', 'AREA', 'ARROYO', 'ATM', 'AUTO_CLUB', 'AUTO_REPAIR', 'BANK', 'BAR', 'BASIN', 'BEACH', 'BENCH', 'BEND', 'BOATING', 'BOX', 'BRIDGE', 'BUS_STATION', 'CAMPS', 'CAPE', 'CASINO', 'CITY_CENTER2', 'CLIFF', 'COMMUNITY_CENTER', 'CRATER', 'CROSS', 'DEFAULT', 'EXIT', 'FALLS', 'FERRY_TERM', 'FIRST_AID', 'FISHING', 'FIXED_NAV_AID', 'FLAT', 'FLOAT_BUOY', 'FOREST', 'FUEL', 'GAP', 'GARDENS', 'GAS_STATION', 'GEYSER', 'GLACIER', 'GOLF_COURSES', 'GUT', 'HARBOR', 'HOSPITAL', 'HOTEL', 'HOUSE', 'HUNT_FISH', 'ISTHMUS', 'LARGE_CITIES', 'LAVA', 'LEVEE', 'LIGHT_HOUSE', 'LOCALE', 'MAJOR_CITIES', 'MARINA', 'MEDIUM_CITIES', 'MINE', 'MUSEUM', 'OBSTRUCTION', 'OILFIELD', 'PARKS', 'PILLAR', 'PLUS', 'RAILWAY_STATION', 'RANGE', 'RAPIDS', 'RESERVE', 'RESORT', 'RESTAURANT', 'RESTUARANTS', 'RIDGE', 'ROCKS', 'RV_SERVICES', 'SCHOOL', 'SCUBA', 'SHOOTING', 'SHOPPING_CENTER', 'SIGHT_SEEING', 'SLOPE', 'SMALL_CITIES', 'SOUNDINGS', 'SPORT_ARENA', 'SPORTS_ARENA', 'SPRING', 'SUMMIT', 'SWAMP', 'TOURIST', 'TOURIST_OFFICE', 'TOWER', 'TRAIN_STATION', 'TRUCK_SERVICES', 'TUNNEL', 'UNIVERSITY', 'VALLEY', 'WELL', 'WINERIES', 'WINERY', 'WOODS', 'WRECK', 'ZOOS',
             'RENTACAR',  'BORDER_CROSSING',  'BUSINESS_FACILITY', '']
@@ -77,12 +83,16 @@ def createPOITables(db, poiprefix, compressed = False):
 
 class POIGroup(Group):
     textslot_column = 'TEXT_SLOT'
+    cellnum_column = 'CELL_NUMBER'
+    numincell_column = 'NUMBER_IN_CELL'
     def __init__(self, map):
         Group.__init__(self, map)
         
         self.catman = POICategoryManager()
 
         self.sortcategories = False
+        self._pointindex = None
+        self._cellnumbers = None
 
         self.poiprefix = map.mapnumstr + "poi"
 
@@ -109,6 +119,9 @@ class POIGroup(Group):
 
     def open(self, mode='r'):
         self.mode = mode
+        self._textslotindex = None
+        self._pointindex = None
+        self._cellnumbers = None
 
         self._initDB(self.map.getDB())
         
@@ -116,33 +129,44 @@ class POIGroup(Group):
             lay.open(self.mode)
 
         if self.mode == 'a':
-            for i in range(0, self.maintable.getRowCount()):
-                self.features.append(self._getFeatureByIndex(i))
+            for feature in FeatureView(self, 0, self.maintable.getRowCount()):
+                self._features.append(feature)
 
     def _getFeatureByIndex(self, index):
         if index >= self.maintable.getRowCount():
             raise IndexError("index out of bounds")
 
-        rec = self.maintable.getCursor(index).asDict()
+        return self._getFeaturesByRange(index, index+1)[0]
 
-        offset = rec['TEXT_SLOT']>>24
-        index = rec['TEXT_SLOT']&0xffffff
+    def _getFeaturesByRange(self, start, stop):
+        """Decode the POIs in row start to stop-1 with bulk reads of the main and aux tables"""
+        rows = self.maintable.getRows(xrange(start, stop))
+        recs = [rows[i].asDict() for i in xrange(start, stop)]
 
-        aux=self.auxmanager.lookupText(index, offset).split('\t')
+        texts = self.auxmanager.lookupTexts([rec['TEXT_SLOT'] for rec in recs])
 
-        # List is terminated by a \t char so the aux will be one element too long
-        aux = aux[:-1]
+        features = []
+        for rec, text in zip(recs, texts):
+            # List is terminated by a \t char so the aux will be one element too long
+            aux = text.split('\t')[:-1]
 
-        categoryid = rec['CATG_ID']
-        subcategoryid = rec['SUBCAT_ID']
+            categoryid = rec['CATG_ID']
+            subcategoryid = rec['SUBCAT_ID']
         
-        return FeaturePOI([(rec['CELL_NUMBER'], rec['NUMBER_IN_CELL']-1)], aux, categoryid, subcategoryid)
+            features.append(FeaturePOI([(rec['CELL_NUMBER'], rec['NUMBER_IN_CELL']-1)], aux, categoryid, subcategoryid))
+        return features
+
+    def getFeatureByIndex(self, index):
+        if self.mode == 'r':
+            return self._getFeatureByIndex(index)
+        else:
+            return self._features[index]
 
     def getFeatureCount(self):
         if self.mode=='r':
             return self.maintable.getRowCount()
         else:
-            return len(self.features)
+            return len(self._features)
 
     def getCategoryManager(self):
         return self.catman
@@ -163,73 +187,353 @@ class POIGroup(Group):
 
             aux = AuxTableManager(self.auxtable, endchar=chr(7), searchindex=False)
 
+            features = self._features
+            nfeatures = len(features)
+
+            if nfeatures > 0:
+                auxvalues = features.getValues('aux')
+                auxids = N.array(features.getValueIds('aux'), dtype=N.int64)
+                catids = N.array(features.getValues('categoryid'), dtype=N.int64)[
+                    N.array(features.getValueIds('categoryid'), dtype=N.int64)]
+                subcatids = N.array(features.getValues('subcategoryid'), dtype=N.int64)[
+                    N.array(features.getValueIds('subcategoryid'), dtype=N.int64)]
+            else:
+                auxvalues = []
+                auxids = catids = subcatids = N.zeros(0, dtype=N.int64)
+
             # sort categories, note that this will create new category ids
             # and the features have to be updated
             if self.sortcategories:
                 cattrans, subcattrans = self.catman.sortCategories()
 
-                # translate categories
-                for f in self.features:
-                    oldcatid = f.getCategoryId()
-                    oldsubcatid = f.getSubCategoryId()
+                # translate categories once per distinct pair of category and subcategory
+                pairs, inverse = N.unique(catids * 2**16 + subcatids, return_inverse=True)
+                catids = N.array([cattrans[int(pair >> 16)] for pair in pairs], dtype=N.int64)[inverse]
+                subcatids = N.array([subcattrans[(int(pair >> 16), int(pair & 0xffff))] for pair in pairs],
+                                    dtype=N.int64)[inverse]
 
-                    f.setCategoryId(cattrans[oldcatid])
-                    f.setSubCategoryId(subcattrans[(oldcatid, oldsubcatid)])
+            # Sort features on ids and upper case name. The names are ranked and hashed
+            # once per distinct aux value
+            names = [poiaux[0].upper() for poiaux in auxvalues]
+            namerank = N.zeros(len(names), dtype=N.int64)
+            namerank[sorted(xrange(len(names)), key=names.__getitem__)] = N.arange(len(names))
+            buckets = N.array([sortHashFunc(poiaux[0]) for poiaux in auxvalues], dtype=N.int64)
+            order = N.lexsort((namerank[auxids], subcatids, catids))
 
-            # Sort features on ids
-            self.features.sort(lambda x,y: cmp((x.getCategoryId(), x.getSubCategoryId(), x.name.upper()), (y.getCategoryId(), y.getSubCategoryId(), y.name.upper())))
+            catids = catids[order]
+            subcatids = subcatids[order]
+            auxids = auxids[order]
 
+            # Update category statistics
+            self._updateCategoryStatistics(catids, subcatids, buckets[auxids])
 
-            # Clear category statistics
-            for cat in self.catman.getCategories():
-                cat.clearStatistics()
-                for subcat in cat.getSubCategories():
-                    subcat.clearStatistics()
+            # Write aux texts in slot order, the texts are joined once per distinct aux value
+            auxtexts = ['\t'.join(poiaux)+'\t' for poiaux in auxvalues]
+            textslots = [aux.appendText(auxtexts[auxid]) for auxid in auxids]
 
             # Write features to database
-            slot = 1
-            for f in self.features:
-                # Update category statistics
-                cat=self.catman.getCategory(f.getCategoryId())
-                subcat=cat.getSubCategory(f.getSubCategoryId())
-                cat.updateFromPOI(slot,f.getAux()[0])
-                subcat.updateFromPOI(slot,f.getAux()[0])
-                
-                textslot = aux.appendText('\t'.join(f.getAux())+'\t')
-
-                # Update cell elements
-                for ref, e in zip(f.cellelementrefs, f.getCellElements(self.map)):
-                    e.textslot = textslot
-                    e.setCategoryId(f.getCategoryId())
-                    e.setSubCategoryId(f.getSubCategoryId())
-                    layer = self.map.getPOILayers()[0]
-                    layer.updateCellElement(ref, e)
-                
-                row = Row(self.maintable)
-                row.setColumnUInt(self.maintable.getColumnIndex("TEXT_SLOT"), textslot)
-
-                row.setColumnUInt(self.maintable.getColumnIndex("CATG_ID"), f.getCategoryId())
-                row.setColumnUInt(self.maintable.getColumnIndex("SUBCAT_ID"), f.getSubCategoryId())
-                
-                cellelementrefs = f.getCellElementRefs()
-                row.setColumnUInt(self.maintable.getColumnIndex("CELL_NUMBER"), cellelementrefs[0][0])
-                row.setColumnUInt(self.maintable.getColumnIndex("NUMBER_IN_CELL"), cellelementrefs[0][1]+1)
-                self.maintable.writeRow(row)
-
-                slot+=1
+            refs = [features.getCellElementRefs(index) for index in order]
+            catids = catids.tolist()
+            subcatids = subcatids.tolist()
+            self.maintable.writeRows({'TEXT_SLOT': textslots,
+                                      'CATG_ID': catids,
+                                      'SUBCAT_ID': subcatids,
+                                      'CELL_NUMBER': [r[0][0] for r in refs],
+                                      'NUMBER_IN_CELL': [r[0][1]+1 for r in refs]})
+
+            cellelementupdates = [(ref, (textslot, catid, subcatid))
+                                  for cellelementrefs, textslot, catid, subcatid
+                                  in izip(refs, textslots, catids, subcatids)
+                                  for ref in cellelementrefs]
+
+            # Update cell elements in cell order
+            if len(cellelementupdates) > 0:
+                layer = self.map.getPOILayers()[0]
+                layer.setCellElementAttributes(cellelementupdates, ('textslot', 'categoryid', 'subcategoryid'))
 
         self.catman.close()
 
+    def _updateCategoryStatistics(self, catids, subcatids, buckets):
+        """Set the statistics of the categories and subcategories from arrays of the
+        category id, subcategory id and first character hash of the POIs in slot order"""
+        for cat in self.catman.getCategories():
+            cat.clearStatistics()
+            for subcat in cat.getSubCategories():
+                subcat.clearStatistics()
+
+        def groupslots(keys):
+            ## Return the distinct keys with the first slot, last slot and count of each key
+            ukeys, first, counts = N.unique(keys, return_index=True, return_counts=True)
+            last = len(keys) - 1 - N.unique(keys[::-1], return_index=True)[1]
+            return zip(ukeys.tolist(), (first + 1).tolist(), (last + 1).tolist(), counts.tolist())
+
+        subcatkeys = catids * 2**16 + subcatids
+        for keys, getcategory in ((catids, self.catman.getCategory),
+                                  (subcatkeys, lambda key: self.catman.getCategory(key >> 16).getSubCategory(key & 0xffff))):
+            for key, firstslot, lastslot, count in groupslots(keys):
+                cat = getcategory(key)
+                cat.firstslot, cat.lastslot, cat.poicount = firstslot, lastslot, count
+
+            # The first slot of each first character bucket
+            for key, firstslot, lastslot, count in groupslots(keys * 64 + buckets):
+                getcategory(key >> 6).first_char_slots[key & 63] = firstslot
+
+    def nearest(self, lon, lat, k=1, categoryid=None, subcategoryid=None):
+        """Return the k POIs nearest to (lon, lat) as a list of (distance, feature) tuples
+
+        The distance is in meters and is calculated with an equirectangular approximation
+        at the latitude of the query point. The POIs can be filtered on category and
+        subcategory id.
+
+        The cell hierarchy of the POI layer is descended from the top cell in order of
+        increasing distance and the search stops when no unvisited cell can contain a POI 
+        closer than the k:th nearest found. If buildPointIndex has been called the point 
+        index is used instead.
+        """
+        if self.mode != 'r':
+            raise ValueError("POI queries can only be made when the group is opened in read-only")
+
+        layer = self.layers[0]
+        qx, qy = layer.float2discrete([(lon, lat)])[0]
+        mx, my = self._metricFactors(layer, lat)
+
+        if self._pointindex != None:
+            candidates, distances = self._pointIndexNearest(qx, qy, mx, my, k, categoryid, subcategoryid)
+            features = self._resolvePOIs([self._pointIndexEntry(i) for i in candidates])
+            return zip(distances.tolist(), features)
+
+        def celldistance(rec):
+            rec = rec.negY()
+            dx = max(rec.minX() - qx, 0, qx - rec.maxX())
+            dy = max(rec.minY() - qy, 0, qy - rec.maxY())
+            return math.hypot(dx*mx, dy*my)
+
+        ## The heap contains both cells and POIs, a POI that is popped is nearer than
+        ## everything that remains. A cell is pushed when a cell of the level above that 
+        ## intersects it is popped. The point of a cell nearest to the query point lies in a
+        ## cell of each level above that is at most as far away, so the cells are pushed
+        ## before any POI further away is popped.
+        rec = layer.calc_cell_extents(1)
+        heap = [(celldistance(rec), 0, (1, rec))]
+        pushed = Set([1])
+        cellnumbers = self._getCellNumbers(layer)
+
+        result = []
+        while heap and len(result) < k:
+            distance, ispoi, item = heapq.heappop(heap)
+            if ispoi:
+                result.append((distance, item))
+            else:
+                cellnum, rec = item
+                level = Layer.cell_level(cellnum)
+                if level < layer.nlevels:
+                    for child in layer.calc_cells_intersecting(level+1, rec):
+                        if child not in pushed:
+                            pushed.add(child)
+                            childrec = layer.calc_cell_extents(child)
+                            heapq.heappush(heap, (celldistance(childrec), 0, (child, childrec)))
+
+                if cellnum in cellnumbers:
+                    cell = layer.getCell(cellnum)
+                    for nincell, ce in enumerate(cell.getCellElements()):
+                        if self._matchCategory(ce, categoryid, subcategoryid):
+                            entry = (cellnum, nincell, ce.textslot, ce.categoryid, ce.subcategoryid)
+                            heapq.heappush(heap, (math.hypot((ce.x-qx)*mx, (ce.y-qy)*my), 1, entry))
+
+        features = self._resolvePOIs([entry for distance, entry in result])
+        return zip([distance for distance, entry in result], features)
+
+    def within(self, bboxrec, categoryid=None, subcategoryid=None):
+        """Return a list of the POIs within a bounding box given as a Rec in longitude, latitude.
+        The POIs can be filtered on category and subcategory id. The cell hierarchy of the
+        POI layer is descended from the top cell and only the cells that intersect the 
+        bounding box are read"""
+        if self.mode != 'r':
+            raise ValueError("POI queries can only be made when the group is opened in read-only")
+
+        layer = self.layers[0]
+        (minx, miny), (maxx, maxy) = layer.float2discrete([bboxrec.c1, bboxrec.c2])
+
+        if self._pointindex != None:
+            candidates = self._pointIndexWithin(minx, miny, maxx, maxy, categoryid, subcategoryid)
+            return self._resolvePOIs([self._pointIndexEntry(i) for i in candidates])
+
+        ## The bounding box in internal coordinates with negated Y-values
+        queryrec = Rec((minx, miny), (maxx, maxy)).negY()
+        cellnumbers = self._getCellNumbers(layer)
+
+        entries = []
+        cells = [1]
+        for level in range(layer.nlevels+1):
+            children = Set()
+            for cellnum in cells:
+                if cellnum in cellnumbers:
+                    cell = layer.getCell(cellnum)
+                    for nincell, ce in enumerate(cell.getCellElements()):
+                        if minx <= ce.x <= maxx and miny <= ce.y <= maxy and \
+                               self._matchCategory(ce, categoryid, subcategoryid):
+                            entries.append((cellnum, nincell, ce.textslot, ce.categoryid, ce.subcategoryid))
+
+                if level < layer.nlevels:
+                    ## Only the parts of the cell within the bounding box can contain matches
+                    rec = layer.calc_cell_extents(cellnum)
+                    cliprec = Rec(N.maximum(rec.c1, queryrec.c1), N.minimum(rec.c2, queryrec.c2))
+                    if (cliprec.c1 <= cliprec.c2).all():
+                        children.update(layer.calc_cells_intersecting(level+1, cliprec))
+            cells = sorted(children)
+
+        return self._resolvePOIs(entries)
+
+    def _getCellNumbers(self, layer):
+        """Return a set of the numbers of the non-empty cells of layer"""
+        if self._cellnumbers == None:
+            self._cellnumbers = Set(layer.cellnumbers)
+        return self._cellnumbers
+
+    def buildPointIndex(self, bucketsize=4):
+        """Build a grid index of the coordinates and category ids of all POIs that is used by
+        the nearest and within queries instead of the cell traversals, which is faster for 
+        repeated queries. 
+
+        The bounding box of the POIs is divided in a grid with on average bucketsize POIs
+        per grid bucket. The POIs are stored as arrays sorted on grid bucket number, the 
+        POIs of a range of buckets in a grid row are found with a binary search.
+        """
+        entries = []
+        for layer in self.layers[:1]:
+            for ce, (cellnum, nincell) in layer.getCellElementsAndRefs():
+                entries.append((ce.x, ce.y, ce.categoryid, ce.subcategoryid, cellnum, nincell, ce.textslot))
+
+        columns = ('x', 'y', 'categoryid', 'subcategoryid', 'cellnum', 'nincell', 'textslot')
+        dtypes = (N.float64, N.float64, N.int32, N.int32, N.int64, N.int32, N.int64)
+
+        index = {}
+        for i, (column, dtype) in enumerate(zip(columns, dtypes)):
+            index[column] = N.array([entry[i] for entry in entries], dtype=dtype)
+
+        ## Grid with ngrid x ngrid buckets of size gridsize
+        ngrid = max(int(math.sqrt(len(entries) / float(bucketsize))), 1)
+        if entries:
+            gridorigin = N.array([index['x'].min(), index['y'].min()])
+            gridsize = N.maximum(N.array([index['x'].max(), index['y'].max()]) - gridorigin, 1) / ngrid
+        else:
+            gridorigin, gridsize = N.zeros(2), N.ones(2)
+
+        index['ngrid'], index['gridorigin'], index['gridsize'] = ngrid, gridorigin, gridsize
+
+        bx, by = self._gridBuckets(index, index['x'], index['y'])
+        keys = by * ngrid + bx
+        order = N.argsort(keys, kind='mergesort')
+        for column in columns:
+            index[column] = index[column][order]
+        index['key'] = keys[order]
+
+        self._pointindex = index
+
+    def _gridBuckets(self, index, x, y):
+        """Return the grid column and row of coordinates, the buckets are limited to the grid"""
+        bx = N.clip(N.floor((x - index['gridorigin'][0]) / index['gridsize'][0]).astype(int), 0, index['ngrid']-1)
+        by = N.clip(N.floor((y - index['gridorigin'][1]) / index['gridsize'][1]).astype(int), 0, index['ngrid']-1)
+        return bx, by
+
+    def _pointIndexRange(self, bxmin, bxmax, bymin, bymax, categoryid, subcategoryid):
+        """Return the indices of the POIs in the grid buckets bxmin to bxmax in the rows bymin
+        to bymax that match the category and subcategory id"""
+        index = self._pointindex
+        rows = N.arange(bymin, bymax+1) * index['ngrid']
+        starts = N.searchsorted(index['key'], rows + bxmin, side='left')
+        stops = N.searchsorted(index['key'], rows + bxmax, side='right')
+        candidates = N.concatenate([N.arange(0)] + [N.arange(start, stop) for start, stop in zip(starts, stops)])
+        return candidates[self._pointIndexMask(candidates, categoryid, subcategoryid)]
+
+    def _pointIndexWithin(self, minx, miny, maxx, maxy, categoryid, subcategoryid):
+        index = self._pointindex
+        (bxmin, bxmax), (bymin, bymax) = self._gridBuckets(index, N.array([minx, maxx]), N.array([miny, maxy]))
+        candidates = self._pointIndexRange(bxmin, bxmax, bymin, bymax, categoryid, subcategoryid)
+        x, y = index['x'][candidates], index['y'][candidates]
+        return candidates[(x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)]
+
+    def _pointIndexNearest(self, qx, qy, mx, my, k, categoryid, subcategoryid):
+        """Return the indices and distances of the k POIs nearest to (qx, qy). The grid buckets 
+        are searched in squares of increasing size around the bucket of the query point until
+        no POI outside the square can be nearer than the k:th nearest found"""
+        index = self._pointindex
+        ngrid = index['ngrid']
+        (cx,), (cy,) = self._gridBuckets(index, N.array([qx]), N.array([qy]))
+
+        candidates = N.arange(0)
+        distances = N.zeros(0)
+        radius = 0
+        while True:
+            ## The buckets of the square that are not in the previous square
+            x0, x1, y0, y1 = max(cx-radius, 0), min(cx+radius, ngrid-1), max(cy-radius, 0), min(cy+radius, ngrid-1)
+            found = [self._pointIndexRange(x0, x1, y, y, categoryid, subcategoryid)
+                     for y in set([cy-radius, cy+radius]) if 0 <= y < ngrid]
+            for x in set([cx-radius, cx+radius]):
+                if 0 <= x < ngrid and y0 <= y1:
+                    found.append(self._pointIndexRange(x, x, max(y0, cy-radius+1), min(y1, cy+radius-1),
+                                                       categoryid, subcategoryid))
+            new = N.concatenate([N.arange(0)] + found)
+            candidates = N.concatenate((candidates, new))
+            distances = N.concatenate((distances, N.hypot((index['x'][new]-qx)*mx, (index['y'][new]-qy)*my)))
+
+            ## Distance to the nearest bucket that is not searched yet
+            lo = index['gridorigin'] + N.array([x0, y0]) * index['gridsize']
+            hi = index['gridorigin'] + N.array([x1+1, y1+1]) * index['gridsize']
+            bounds = [(qx - lo[0]) * mx for covered in [x0 == 0] if not covered] + \
+                     [(hi[0] - qx) * mx for covered in [x1 == ngrid-1] if not covered] + \
+                     [(qy - lo[1]) * my for covered in [y0 == 0] if not covered] + \
+                     [(hi[1] - qy) * my for covered in [y1 == ngrid-1] if not covered]
+            if not bounds or (len(distances) >= k and N.sort(distances)[k-1] <= max(min(bounds), 0)):
+                break
+            radius += 1
+
+        order = N.lexsort((candidates, distances))[:k]
+        return candidates[order], distances[order]
+
+    def _pointIndexMask(self, candidates, categoryid, subcategoryid):
+        index = self._pointindex
+        mask = N.ones(len(candidates), dtype=bool)
+        if categoryid != None:
+            mask &= index['categoryid'][candidates] == categoryid
+        if subcategoryid != None:
+            mask &= index['subcategoryid'][candidates] == subcategoryid
+        return mask
+
+    def _pointIndexEntry(self, i):
+        index = self._pointindex
+        return (int(index['cellnum'][i]), int(index['nincell'][i]), int(index['textslot'][i]),
+                int(index['categoryid'][i]), int(index['subcategoryid'][i]))
+
+    def _matchCategory(self, ce, categoryid, subcategoryid):
+        return (categoryid == None or ce.categoryid == categoryid) and \
+               (subcategoryid == None or ce.subcategoryid == subcategoryid)
+
+    def _metricFactors(self, layer, lat):
+        """Return meters per discrete unit in x and y at latitude lat"""
+        k = earthradius * math.pi / 180
+        return layer.scale[0] * k * math.cos(math.radians(lat)), layer.scale[1] * k
+
+    def _resolvePOIs(self, entries):
+        """Create features from (cellnum, nincell, textslot, categoryid, subcategoryid) tuples,
+        the aux texts are looked up in one pass"""
+        textslots = [entry[2] for entry in entries]
+        texts = self.auxmanager.lookupTexts([0xff000000 if textslot is None else textslot for textslot in textslots])
+
+        features = []
+        for (cellnum, nincell, textslot, categoryid, subcategoryid), text in zip(entries, texts):
+            # List is terminated by a \t char so the aux will be one element too long
+            features.append(FeaturePOI([(cellnum, nincell)], text.split('\t')[:-1], categoryid, subcategoryid))
+        return features
+
     def optimizeLayers(self):
         """Call the optimize function of each member layer and update cell element reference in all features"""
 
-        cellrefremap = {}
         for layer in self.layers:
             remapdict = layer.optimize()
 
-            for feature in self.xfeatures:
-                if len(remapdict) > 0:
-                    feature.cellelementrefs = tuple([remapdict[ceref] for ceref in feature.cellelementrefs])
+            if len(remapdict) > 0:
+                self._remapCellElementRefs(remapdict, None)
 
     @property
     def layers(self):
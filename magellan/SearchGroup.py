@@ -7,30 +7,32 @@ from DBUtil import Row,AuxTableManager, sortHashFuncFast
 from DBSchema import FieldStruct,FieldTypeLONGINT,FieldTypeSHORTINT,FieldTypeCHARACTER
 import copy
 import os
+import shutil
+import atexit
 from sets import Set
-import bisect
-
-def textslot_cmp(x,y):
-    if x == y:
-        return 0
-    if x == None:
-        return -1
-    if y == None:
-        return 1
-    else:
-        return cmp((x & 0xffffff, x >> 24),(y & 0xffffff, y >> 24))
+import heapq
+import itertools
+import tempfile
+import cPickle
+import array
+import numpy as N
+
+## Key of the textslot index of a group
+textslotkeytype = [('textslot', N.int64), ('cellnum', N.int64), ('numincell', N.int64)]
 
 class Group(object):
     def __init__(self, map, name=None):
         self._layers = []
+        self._objtypeindices = {} ## Cache of objtype indices by layer number and objtype
         self.map = map
         self.mode = None
         self._name = name
-        self._features = []
+        self._features = FeatureStore()
         self.exportfields = []
         self.exportfieldtypes = []
         self.isopen = False
         self._searchable = False
+        self._textslotindex = None
 
     def __equal__(self, g):
         return isinstance(Group, g) and g.name == self.name
@@ -40,14 +42,17 @@ class Group(object):
     @property
     def xfeatures(self):
         """Returns an iterator over all features in group"""
-        for i in xrange(0,self.getFeatureCount()):
-            yield self.getFeatureByIndex(i)
+        if self.mode == 'r':
+            return iter(FeatureView(self))
+        else:
+            return (self.getFeatureByIndex(i) for i in xrange(0,self.getFeatureCount()))
 
     @property
     def features(self):
-        """Returns a sequence of all features in group"""
+        """Returns a sequence of all features in group. In read-only mode the sequence is a
+        lazy view that reads the features when they are accessed"""
         if self.mode == 'r':
-            return [self.getFeatureByIndex(i) for i in xrange(0,self.getFeatureCount())]
+            return FeatureView(self)
         else:
             return self._features
 
@@ -65,37 +70,88 @@ class Group(object):
 
     def getFeatureByIndex(self, index):
         return self._features[index]
+
+    def _getFeaturesByRange(self, start, stop):
+        """Return a list of the features with index start to stop-1"""
+        return [self.getFeatureByIndex(i) for i in xrange(start, stop)]
     
-    def getFeatureByCellElement(self, cellelement, startindex=None, stopindex=None):
-        if self.mode != 'r':
-            return ValueError("Features can only be indexed by textslot when the group is opened in read-only")
+    def getFeatureByCellElement(self, cellelement):
+        """Return the feature that a cell element belongs to or None if the cell element has no textslot
 
-        if cellelement.textslot in (0xff000000, None):
-            return None
+        The first call reads the cell element references of the main table and builds an index
+        sorted on textslot, cell number and number in cell that is used for all following lookups.
+        """
+        return self.getFeaturesByCellElements([cellelement])[0]
 
-        if startindex==None:
-            startindex=0
-        if stopindex==None:
-            stopindex=self.maintable.getRowCount()-1
+    def getFeaturesByCellElements(self, cellelements):
+        """Return a list of the features that a sequence of cell elements belong to, for example
+        the cell elements of a cell. The item is None for cell elements that have no textslot
 
-        # For small intervals use linear search
-        if stopindex-startindex+1 < 4:
-            for i in range(startindex, stopindex+1):
-                textslot = self.maintable.getCursor(i).asDict()[self.textslot_column]
-                if textslot == cellelement.textslot:
-                    return self.getFeatureByIndex(i)
-            raise Exception("Textslot not found: 0x%x"%cellelement.textslot)
+        All cell elements are looked up in the textslot index with one searchsorted call and
+        each feature is only decoded once.
+        """
+        if self.mode != 'r':
+            raise ValueError("Features can only be indexed by textslot when the group is opened in read-only")
 
-        midindex = (startindex+stopindex)/2
+        keys, indices = self._getTextslotIndex()
 
-        midtextslot = self.maintable.getCursor(midindex).asDict()[self.textslot_column]
+        hastext = N.array([cellelement.textslot not in (0xff000000, None) for cellelement in cellelements],
+                          dtype=bool)
+        query = N.zeros(len(cellelements), dtype=textslotkeytype)
+        query['textslot'] = [cellelement.textslot if text else -1
+                             for cellelement, text in zip(cellelements, hastext)]
+        query['cellnum'] = [cellelement.cellnum for cellelement in cellelements]
+        query['numincell'] = [getattr(cellelement, 'numincell', -1) for cellelement in cellelements]
 
-        if cellelement.textslot == midtextslot:
-            return self.getFeatureByIndex(midindex)
-        elif textslot_cmp(cellelement.textslot,midtextslot)<0:
-            return self.getFeatureByCellElement(cellelement, startindex=startindex, stopindex=midindex-1)
+        if len(keys) == 0:
+            positions = N.zeros(len(cellelements), dtype=int)
+            found = N.zeros(len(cellelements), dtype=bool)
         else:
-            return self.getFeatureByCellElement(cellelement, startindex=midindex+1, stopindex=stopindex)
+            positions = N.minimum(keys.searchsorted(query), len(keys)-1)
+
+            ## Identical names share textslot, if the cell element reference is not found the 
+            ## feature with the same textslot before the insertion point is used
+            found = keys['textslot'][positions] == query['textslot']
+            previous = ~found & (positions > 0)
+            previous[previous] = keys['textslot'][positions[previous]-1] == query['textslot'][previous]
+            positions[previous] -= 1
+            found |= previous
+
+        missing = hastext & ~found
+        if missing.any():
+            raise Exception("Textslot not found: 0x%x"%query['textslot'][missing][0])
+
+        features = {}
+        result = []
+        for text, position in zip(hastext, positions):
+            if text:
+                index = int(indices[position])
+                if index not in features:
+                    features[index] = self.getFeatureByIndex(index)
+                result.append(features[index])
+            else:
+                result.append(None)
+        return result
+
+    def _getTextslotIndex(self):
+        """Return the sorted (textslot, cellnum, numincell) keys of the cell element references in 
+        the main table and the corresponding row indices"""
+        if self._textslotindex == None:
+            textslots, cellnums, numincells, rows = self._getCellElementRefColumns()
+            keys = N.zeros(len(textslots), dtype=textslotkeytype)
+            keys['textslot'] = textslots
+            keys['cellnum'] = cellnums
+            keys['numincell'] = numincells
+            order = N.argsort(keys, kind='mergesort')
+            self._textslotindex = keys[order], rows[order]
+        return self._textslotindex
+
+    def _getCellElementRefColumns(self):
+        """Return arrays of the textslot, cell number, number in cell and row index of the cell
+        element references in the main table"""
+        textslots, cellnums, numincells = [N.array(column, dtype=N.int64) for column in 
+            self.maintable.getColumns([self.textslot_column, self.cellnum_column, self.numincell_column])]
+        return textslots, cellnums, numincells-1, N.arange(len(textslots))
 
     def getFeatureExportFields(self): return self.exportfields
     def getFeatureExportFieldTypes(self): return self.exportfieldtypes
@@ -105,8 +161,7 @@ class Group(object):
         if self.mode=='r':
             raise ValueError("Group is open as read-only")
 
-        self._features.append(feature)
-        return self._features.index(feature)
+        return self._features.append(feature)
 
     def optimizeLayers(self):
         """Call the optimize function of each member layer and update cell element reference in all features"""
@@ -115,11 +170,13 @@ class Group(object):
         for layer in self.layers:
             cellrefremap[self.map.getLayerIndex(layer)] = layer.optimize()
 
-        for feature in self.xfeatures:
-            remapdict = cellrefremap[feature.layerindex]
-
+        for layerindex, remapdict in cellrefremap.items():
             if len(remapdict) > 0:
-                feature.cellelementrefs = tuple([remapdict[ceref] for ceref in feature.cellelementrefs])
+                self._remapCellElementRefs(remapdict, layerindex)
+
+    def _remapCellElementRefs(self, remapdict, layerindex):
+        """Replace the cell element references of the features in a layer"""
+        self._features.remapCellElementRefs(remapdict, layerindex)
 
     @property
     def name(self):
@@ -132,11 +189,41 @@ class Group(object):
     searchable = property(get_searchable, set_searchable, doc='True if group is searchable')    
 
 
+class RunDirectory(object):
+    """Temporary directory that holds the spilled runs of a group. The directory and the runs
+    are removed when the instance is deleted or at the latest when the interpreter exits"""
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix='group_')
+        atexit.register(shutil.rmtree, self.dir, True)
+
+    def __str__(self):
+        return self.dir
+
+    def __del__(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
 class GroupNormal(Group):
     textslot_column = 'NAME_REF'
+    cellnum_column = 'CELL_NUM'
+    numincell_column = 'N_IN_C'
     extrafields = []
+
+    ## Maximum number of features that are kept in memory when writing. Above this
+    ## the features are spilled to disk as sorted runs that are merged at close. 
+    ## None means no limit
+    maxfeaturesinmemory = None
+
+    ## Number of leading characters of a search prefix whose case variants are binary searched
+    searchvariantchars = 3
+
     def __init__(self, map, name=None):
         Group.__init__(self, map, name=name)
+        self._order = None
+        self._sortkeys = None
+        self._serialbase = 0
+        self._runs = []
+        self._rundir = None
+        self._nspilled = 0
         self.exportfields += ['name', 'objtype']
         self.exportfieldtypes += ['string', 'int']
     
@@ -151,6 +238,7 @@ class GroupNormal(Group):
         tok = tok[2:]
 
         self._layers=[]
+        self._objtypeindices = {}
         for i in range(0, nlayers):
             layer={}
 
@@ -227,6 +315,7 @@ class GroupNormal(Group):
 
         if not self.isopen:
             self.mode = mode
+            self._textslotindex = None
 
             self._initDB(self.map.getDB())
 
@@ -234,8 +323,8 @@ class GroupNormal(Group):
                 self.map.getLayerByIndex(li['number']).open(mode)
 
             if self.mode == 'a':
-                for i in range(0, self.maintable.getRowCount()):
-                    self._insert(self._getFeatureByIndex(i))
+                for feature in FeatureView(self, 0, self.maintable.getRowCount()):
+                    self._insert(feature)
             self.isopen = True
             
     def close(self):
@@ -247,39 +336,214 @@ class GroupNormal(Group):
 
                 aux = AuxTableManager(self.auxtable)
 
-                # Write features to database
-                addrow = 0
-                for f in self.xfeatures:
-                    textslot = aux.appendText(f.name, self.maintable.getRowCount()+1)
-
-                    # Update cell elements
-                    for ref, e in zip(f.cellelementrefs, f.getCellElements(self.map)):
-                        e.textslot = textslot
-                        layer = self.map.getLayerByIndex(f.layerindex)
-                        layer.updateCellElement(ref, e)
-
-                    row = Row(self.maintable)
-                    row.setColumnUInt(self.maintable.getColumnIndex("NAME_REF"), textslot)
-
-                    row.setColumnUInt(self.maintable.getColumnIndex("OBJ_TYPE"), f.getObjtypeIndex(self))
-
-                    cellelementrefs = f.getCellElementRefs()
-                    if len(cellelementrefs) == 1:
-                        row.setColumnUInt(self.maintable.getColumnIndex("CELL_NUM"), cellelementrefs[0][0])
-                        row.setColumnUInt(self.maintable.getColumnIndex("N_IN_C"), cellelementrefs[0][1]+1)
-                    else:
-                        row.setColumnUInt(self.maintable.getColumnIndex("CELL_NUM"), 0x80000000|(addrow+1) )
-                        row.setColumnUInt(self.maintable.getColumnIndex("N_IN_C"), len(cellelementrefs))
-                        for cref in cellelementrefs:
-                            rowrc = Row(self.addtable)
-                            rowrc.setColumnUInt(self.addtable.getColumnIndex("CELL_NUM"), cref[0])
-                            rowrc.setColumnUInt(self.addtable.getColumnIndex("N_IN_C"), cref[1]+1)
-                            self.addtable.writeRow(rowrc)
-                            addrow+=1
-                    self.maintable.writeRow(row)
+                # Write features to database, the textslots of the cell elements
+                # are collected and updated per layer afterwards
+                textslotupdates = {}
+                try:
+                    self._writeFeatures(aux, textslotupdates)
+                finally:
+                    self._removeRuns()
+
+                # Update cell elements
+                for layerindex, updates in textslotupdates.items():
+                    self.map.getLayerByIndex(layerindex).setCellElementAttributes(updates, ('textslot',))
 
             self.isopen = False            
 
+    def _writeFeatures(self, aux, textslotupdates):
+        """Write features to the main and additional cells tables in sorted order. The textslots
+        of the cell element references are added to textslotupdates per layer index"""
+        addrow = 0
+        for f in self.xfeatures:
+            textslot = aux.appendText(f.name, self.maintable.getRowCount()+1)
+
+            updates = textslotupdates.setdefault(f.layerindex, [])
+            for ref in f.cellelementrefs:
+                updates.append((ref, (textslot,)))
+
+            row = Row(self.maintable)
+            row.setColumnUInt(self.maintable.getColumnIndex("NAME_REF"), textslot)
+
+            row.setColumnUInt(self.maintable.getColumnIndex("OBJ_TYPE"), f.getObjtypeIndex(self))
+
+            cellelementrefs = f.getCellElementRefs()
+            if len(cellelementrefs) == 1:
+                row.setColumnUInt(self.maintable.getColumnIndex("CELL_NUM"), cellelementrefs[0][0])
+                row.setColumnUInt(self.maintable.getColumnIndex("N_IN_C"), cellelementrefs[0][1]+1)
+            else:
+                row.setColumnUInt(self.maintable.getColumnIndex("CELL_NUM"), 0x80000000|(addrow+1) )
+                row.setColumnUInt(self.maintable.getColumnIndex("N_IN_C"), len(cellelementrefs))
+                for cref in cellelementrefs:
+                    rowrc = Row(self.addtable)
+                    rowrc.setColumnUInt(self.addtable.getColumnIndex("CELL_NUM"), cref[0])
+                    rowrc.setColumnUInt(self.addtable.getColumnIndex("N_IN_C"), cref[1]+1)
+                    self.addtable.writeRow(rowrc)
+                    addrow+=1
+            self.maintable.writeRow(row)
+
+    def search(self, prefix, limit=None):
+        """Return a list of at most limit features whose name starts with prefix
+
+        The comparison is case-insensitive. Features are stored sorted on first character
+        sort hash and case-sensitive name. In read-only mode the first character search index
+        of the aux table gives the rows of the sort hash bucket of the prefix. Each case
+        variant of the first searchvariantchars characters of the prefix is binary searched
+        within the bucket and only the contiguous run of rows that starts with the variant
+        is read.
+
+        In write mode the in-memory features are searched in the same way and the spilled
+        runs are scanned, they are not merged into memory.
+        """
+        prefix = prefix.upper()
+
+        if self.mode == 'r':
+            startindex, stopindex = self._getSearchRange(prefix)
+
+            result = []
+            for start, stop in self._searchRanges(self._getSortKeyByIndex, startindex, stopindex, prefix):
+                if limit != None:
+                    stop = min(stop, start + limit - len(result))
+                if len(prefix) <= self.searchvariantchars:
+                    ## All rows in the range match
+                    result.extend(self._getFeaturesByRange(start, stop))
+                else:
+                    for index, name in self._iterNamesByRange(start, stop):
+                        if name.upper().startswith(prefix):
+                            result.append(self.getFeatureByIndex(index))
+                            if limit != None and len(result) >= limit:
+                                break
+                if limit != None and len(result) >= limit:
+                    break
+            return result
+        else:
+            items = heapq.merge(*([self._searchRun(filename, prefix) for filename in self._runs] + 
+                                  [self._searchInMemory(prefix)]))
+            return [feature for key, serial, feature in itertools.islice(items, limit)]
+
+    def _searchRanges(self, getkey, start, stop, prefix):
+        """Return the (start, stop) ranges of the sorted features start to stop-1 whose sort keys
+        start with a case variant of the first searchvariantchars characters of prefix. The
+        ranges are returned in sort order"""
+        if not prefix:
+            return [(start, stop)]
+
+        def firstindex(lo, hi, before):
+            ## Find first feature with a sort key for which before is false
+            while lo < hi:
+                mid = (lo+hi)/2
+                if before(getkey(mid)):
+                    lo = mid+1
+                else:
+                    hi = mid
+            return lo
+
+        bucket = chr(sortHashFuncFast(prefix))
+        ranges = []
+        for variant in casevariants(prefix[:self.searchvariantchars]):
+            key = bucket + variant
+            first = firstindex(start, stop, lambda sortkey: sortkey < key)
+            last = firstindex(first, stop, lambda sortkey: sortkey[:len(key)] <= key)
+            if first < last:
+                ranges.append((first, last))
+        return ranges
+
+    def _searchInMemory(self, prefix):
+        """Iterate over the (sortkey, serial, feature) items of the in-memory features whose name 
+        starts with prefix in sorted order"""
+        self._sortInMemory()
+        getkey = lambda index: self._getSortKey(self._order[index])
+        for start, stop in self._searchRanges(getkey, 0, len(self._features), prefix):
+            for index in xrange(start, stop):
+                sortkey = getkey(index)
+                if sortkey[1:].upper().startswith(prefix):
+                    yield sortkey, self._serialbase+self._order[index], self._features[self._order[index]]
+
+    def _searchRun(self, filename, prefix):
+        """Iterate over the (sortkey, serial, feature) items of a spilled run whose name starts 
+        with prefix"""
+        bucket = prefix and chr(sortHashFuncFast(prefix))
+        for sortkey, serial, feature in self._readRun(filename):
+            if sortkey[:1] < bucket:
+                continue
+            if sortkey[:1] > bucket and bucket:
+                break
+            if sortkey[1:].upper().startswith(prefix):
+                yield sortkey, serial, feature
+
+    def _iterNamesByRange(self, start, stop, chunksize=256):
+        """Iterate over (index, name) of the rows start to stop-1 of the main table. The
+        names are read in bulk chunksize rows at a time"""
+        for chunkstart in xrange(start, stop, chunksize):
+            chunkstop = min(chunkstart+chunksize, stop)
+            rows = self.maintable.getRows(xrange(chunkstart, chunkstop))
+            names = self.auxmanager.lookupTexts([rows[i].asDict()[self.textslot_column]
+                                                 for i in xrange(chunkstart, chunkstop)])
+            for index, name in zip(xrange(chunkstart, chunkstop), names):
+                yield index, name
+
+    def _getSearchRange(self, prefix):
+        """Return (startindex, stopindex) of the rows that may match prefix using the search index"""
+        nrows = self.maintable.getRowCount()
+
+        if not prefix:
+            return 0, nrows
+
+        if getattr(self, '_searchindex', None) == None:
+            self._searchindex = self.auxmanager.readIndex()
+        index = self._searchindex
+
+        bucket = sortHashFuncFast(prefix)
+
+        if index[bucket] == 0:
+            if max(index) == 0:
+                ## No search index present
+                return 0, nrows
+            return 0, 0
+
+        startindex = index[bucket]-1
+        stopindex = nrows
+        for refslot in index[bucket+1:]:
+            if refslot > 0:
+                stopindex = min(stopindex, refslot-1)
+
+        ## Fall back to the full table if the index does not point at the first row of the bucket
+        if startindex > 0 and ord(self._getSortKeyByIndex(startindex-1)[0]) == bucket:
+            return 0, nrows
+
+        return startindex, stopindex
+
+    def _getSortKeyByIndex(self, index):
+        """Return the sort key of a feature in the main table by only decoding its name"""
+        namekey = self.maintable.getCursor(index).asDict()[self.textslot_column]
+        name = self.auxmanager.lookupText(namekey & 0xffffff, namekey >> 24)
+        if not name:
+            return ''
+        return chr(sortHashFuncFast(name)) + name
+
+    def _getCellElementRefColumns(self):
+        """Return arrays of the textslot, cell number, number in cell and row index of the cell
+        element references in the main table. The references of features that are present in
+        more than one cell are read from the additional cells table"""
+        textslots, cellnums, numincells, rows = Group._getCellElementRefColumns(self)
+
+        multi = (cellnums & 0x80000000) != 0
+        if not multi.any():
+            return textslots, cellnums, numincells, rows
+
+        ## The number in cell column of the main table holds the number of additional cells
+        counts = numincells[multi]+1
+        offsets = N.arange(counts.sum()) - N.repeat(N.cumsum(counts)-counts, counts)
+        addindices = N.repeat((cellnums[multi] & 0xffffff)-1, counts) + offsets
+
+        addcellnums, addnumincells = [N.array(column, dtype=N.int64) for column in 
+                                      self.addtable.getColumns(['CELL_NUM', 'N_IN_C'])]
+
+        single = ~multi
+        return (N.concatenate((textslots[single], N.repeat(textslots[multi], counts))),
+                N.concatenate((cellnums[single], addcellnums[addindices])),
+                N.concatenate((numincells[single], addnumincells[addindices]-1)),
+                N.concatenate((rows[single], N.repeat(rows[multi], counts))))
+
     def getLayerAndObjtypeFromObjtypeIndex(self, objtypeindex):
         idx=0
         for l in self._layers:
@@ -303,37 +567,69 @@ class GroupNormal(Group):
         if self.mode=='r':
             return self.maintable.getRowCount()
         else:
-            return len(self._features)
+            return len(self._features) + self._nspilled
 
     def getFeatureByIndex(self, index):
         if self.mode == 'r':
             return self._getFeatureByIndex(index)
         else:
-            return self._features[index][1]
+            self._mergeRuns()
+            return self._features[self._order[index]]
+
+    @property
+    def xfeatures(self):
+        """Returns an iterator over all features in group"""
+        if self.mode == 'r':
+            return Group.xfeatures.fget(self)
+        else:
+            return (item[2] for item in self._iterSorted())
+
+    @property
+    def features(self):
+        """Returns a sequence of all features in group"""
+        if self.mode == 'r':
+            return Group.features.fget(self)
+        else:
+            return list(self.xfeatures)
     
     def _getFeatureByIndex(self, index):
         if index >= self.maintable.getRowCount():
             raise IndexError("index out of bounds")
 
-        rec = self.maintable.getCursor(index).asDict()
+        return self._getFeaturesByRange(index, index+1)[0]
 
-        namekey = rec['NAME_REF']
+    def _getFeaturesByRange(self, start, stop):
+        """Decode the features in row start to stop-1. The main, additional cells and aux tables
+        are read in bulk"""
+        rows = self.maintable.getRows(xrange(start, stop))
+        recs = [rows[i].asDict() for i in xrange(start, stop)]
 
-        objtype_index = rec['OBJ_TYPE']
-        layer, objtype = self.getLayerAndObjtypeFromObjtypeIndex(objtype_index)
-        
-        nameindex = namekey & 0xffffff
-        nameoffset = namekey >> 24
-        name = self.auxmanager.lookupText(nameindex, nameoffset)
-        
-        cellelementrefs = []
-        if rec['CELL_NUM'] & 0x80000000:
-            for j in range(0,rec['N_IN_C']):
-                 rcrow = (rec['CELL_NUM']&0xffffff)+j-1
-                 rec2 = self.addtable.getCursor(rcrow).asDict()
-                 cellelementrefs.append((rec2['CELL_NUM'],rec2['N_IN_C']-1))
-        else:
-            cellelementrefs.append((rec['CELL_NUM'], rec['N_IN_C']-1))
+        names = self.auxmanager.lookupTexts([rec['NAME_REF'] for rec in recs])
+
+        ## Read additional cells of features that are present in more than one cell
+        addindices = []
+        for rec in recs:
+            if rec['CELL_NUM'] & 0x80000000:
+                first = (rec['CELL_NUM']&0xffffff)-1
+                addindices.extend(xrange(first, first+rec['N_IN_C']))
+        addrecs = dict([(i, row.asDict()) for i, row in self.addtable.getRows(addindices).items()])
+
+        features = []
+        for rec, name in zip(recs, names):
+            cellelementrefs = []
+            if rec['CELL_NUM'] & 0x80000000:
+                for j in range(0,rec['N_IN_C']):
+                     rec2 = addrecs[(rec['CELL_NUM']&0xffffff)+j-1]
+                     cellelementrefs.append((rec2['CELL_NUM'],rec2['N_IN_C']-1))
+            else:
+                cellelementrefs.append((rec['CELL_NUM'], rec['N_IN_C']-1))
+
+            features.append(self._featureFromRecord(rec, name, cellelementrefs))
+
+        return features
+
+    def _featureFromRecord(self, rec, name, cellelementrefs):
+        layer, objtype = self.getLayerAndObjtypeFromObjtypeIndex(rec['OBJ_TYPE'])
 
         return FeatureNormal(self.map.getLayerIndex(layer), cellelementrefs,
                              name, objtype)
@@ -354,28 +650,124 @@ class GroupNormal(Group):
         self._insert(feature)
 
     def _insert(self, feature):
-        ## Insert feature and keep the list sorted on name
+        ## Append feature, the features are sorted on sort hash, name and insertion order
+        ## when they are needed in order
         name = feature.name
         
         if name:
-            item = (chr(sortHashFuncFast(name)) + name, feature)
-            index = bisect.bisect_right(self._features, item)
-            self._features.insert(index, item)
-            return index
+            self._features.append(feature)
+            self._order = None
+
+            if self.maxfeaturesinmemory != None and len(self._features) >= self.maxfeaturesinmemory:
+                self._spill()
+
+    def _getSortKey(self, index):
+        """Return sort key of the in-memory feature with the given storage index"""
+        return self._sortkeys[self._features.getValueId(index, 'name')]
+
+    def _sortInMemory(self):
+        if self._order == None:
+            ## Sort keys are calculated once per distinct name
+            self._sortkeys = [chr(sortHashFuncFast(name)) + name for name in self._features.getValues('name')]
+            self._order = sorted(xrange(len(self._features)), key=self._getSortKey)
+
+    def _iterInMemory(self):
+        """Iterate over (sortkey, serial, feature) items of the in-memory features in sorted order"""
+        self._sortInMemory()
+        for index in self._order:
+            yield self._getSortKey(index), self._serialbase+index, self._features[index]
+
+    def _iterSorted(self):
+        """Return an iterator over all (sortkey, serial, feature) items in sorted order"""
+        if self._runs:
+            return heapq.merge(*([self._readRun(filename) for filename in self._runs] + [self._iterInMemory()]))
+        else:
+            return self._iterInMemory()
+
+    def _spill(self):
+        """Write the in-memory features as a sorted run to a temporary file"""
+        self._runs.append(self._writeRun(self._iterInMemory()))
+        self._nspilled += len(self._features)
+        self._serialbase += len(self._features)
+        self._features = FeatureStore()
+        self._order = None
+
+    def _writeRun(self, items):
+        if self._rundir == None:
+            self._rundir = RunDirectory()
+        fd, filename = tempfile.mkstemp(prefix='run_', dir=str(self._rundir))
+        f = os.fdopen(fd, 'wb')
+        for item in items:
+            cPickle.dump(item, f, 2)
+        f.close()
+        return filename
+
+    def _readRun(self, filename):
+        f = open(filename, 'rb')
+        try:
+            while True:
+                yield cPickle.load(f)
+        except EOFError:
+            pass
+        finally:
+            f.close()
+
+    def _mergeRuns(self):
+        """Read back all spilled features to memory, needed for random access"""
+        if self._runs:
+            features = FeatureStore()
+            for key, serial, feature in self._iterSorted():
+                features.append(feature)
+            self._features = features
+            self._order = None
+            self._serialbase = 0
+            self._removeRuns()
+        self._sortInMemory()
+
+    def _removeRuns(self):
+        self._runs = []
+        self._rundir = None
+        self._nspilled = 0
+
+    def _remapCellElementRefs(self, remapdict, layerindex):
+        Group._remapCellElementRefs(self, remapdict, layerindex)
+
+        ## Rewrite spilled runs with the updated features
+        def remap(items):
+            for key, serial, feature in items:
+                if feature.layerindex == layerindex:
+                    feature.cellelementrefs = tuple(remapCellElementRefs(feature.cellelementrefs, remapdict))
+                yield key, serial, feature
+
+        runs = []
+        for filename in self._runs:
+            runs.append(self._writeRun(remap(self._readRun(filename))))
+            os.unlink(filename)
+        self._runs = runs
 
     def getObjtypeIndex(self, layernumber, objtype):
+        try:
+            return self._objtypeindices[(layernumber, objtype)]
+        except KeyError:
+            pass
+
         idx=0
         objnumber_index = None
         for li in self._layers:
             if li['number'] == layernumber:
                 if objtype in li['objtypes']:
-                    return idx+li['objtypes'].index(objtype)
+                    index = idx+li['objtypes'].index(objtype)
                 else:
                     if self.mode == 'r':
                         raise ValueError("Objtype does not exists")
                     # Objtype is not used in this layer before, add it
                     li['objtypes'].append(objtype)
-                    return idx+len(li['objtypes'])-1
+                    index = idx+len(li['objtypes'])-1
+
+                    # The indices of the objtypes of the following layers are shifted
+                    self._objtypeindices.clear()
+                self._objtypeindices[(layernumber, objtype)] = index
+                return index
             idx += len(li['objtypes'])
 
 class GroupStreet(GroupNormal):
@@ -394,18 +786,16 @@ class GroupStreet(GroupNormal):
         self.citytable = db.getTableByName("C_R")
         self.ziptable = db.getTableByName("Z_R")
 
-    def _getFeatureByIndex(self, index):
-        feature = GroupNormal._getFeatureByIndex(self, index)
-
-        rec = self.maintable.getCursor(index).asDict()
+    def _featureFromRecord(self, rec, name, cellelementrefs):
+        layer, objtype = self.getLayerAndObjtypeFromObjtypeIndex(rec['OBJ_TYPE'])
 
         zipindex = rec['FLD0']
 
         streetNumBeg = rec['FLD1']
         streetNumEnd = streetNumBeg
 
-        return FeatureStreet(feature.layerindex, feature.getCellElementRefs(),
-                             feature.name, feature.getObjtype(),
+        return FeatureStreet(self.map.getLayerIndex(layer), cellelementrefs,
+                             name, objtype,
                              streetNumBeg=streetNumBeg, streetNumEnd=streetNumEnd)
 
 class Feature(object):
@@ -475,6 +865,251 @@ class FeatureStreet(FeatureNormal):
     def importFromList(l, group):
         (self.attributes['name'], self.attributes['objtype']) = l
 
+class FeatureView(object):
+    """Lazy read-only sequence of the features of a group
+
+    The features are decoded when accessed. Iteration decodes batchsize features at
+    a time with bulk reads of the group tables. Slicing returns a new view.
+    """
+    batchsize = 256
+
+    def __init__(self, group, start=0, stop=None, step=1):
+        self.group = group
+        if stop == None:
+            stop = group.getFeatureCount()
+        self._range = (start, stop, step)
+
+    def __len__(self):
+        return len(xrange(*self._range))
+
+    def _index(self, i):
+        start, stop, step = self._range
+        return start + i*step
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            n = len(xrange(start, stop, step))
+            step *= self._range[2]
+            return FeatureView(self.group, self._index(start), self._index(start)+n*step, step)
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("index out of bounds")
+        return self.group.getFeatureByIndex(self._index(key))
+
+    def __iter__(self):
+        start, stop, step = self._range
+        if step == 1:
+            for batchstart in xrange(start, stop, self.batchsize):
+                for feature in self.group._getFeaturesByRange(batchstart, min(stop, batchstart+self.batchsize)):
+                    yield feature
+        else:
+            for index in xrange(*self._range):
+                yield self.group.getFeatureByIndex(index)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(' + str(self.group.name) + ',' + str(self._range) + ')'
+
+class FeatureStore(object):
+    """Columnar container of features
+
+    The features are not kept as objects. Instead the layer index, the cell element
+    references and the attributes are stored in parallel arrays. Attribute values are
+    interned so each distinct value, for example a street name, is only stored once
+    and the rows refer to it by id. The cell element references are flattened to
+    arrays of cell numbers and numbers in cell with an offset per feature.
+
+    Feature objects are created on access, so modifying a returned feature does not
+    change the stored feature.
+
+    >>> store = FeatureStore()
+    >>> store.append(FeatureNormal(0, [(1, 0), (2, 3)], 'Apgatan', 29))
+    0
+    >>> store.append(FeatureNormal(1, [(1, 1)], 'Apgatan', 30))
+    1
+    >>> len(store)
+    2
+    >>> store[0]
+    FeatureNormal(0,((1, 0), (2, 3)),{'objtype': 29, 'name': 'Apgatan'})
+    >>> store.getValues('name')
+    ['Apgatan']
+    >>> store.remapCellElementRefs({(1, 0): (5, 0), (2, 3): (6, 1)}, 0)
+    >>> store[0].getCellElementRefs()
+    ((5, 0), (6, 1))
+    >>> store[1].getCellElementRefs()
+    ((1, 1),)
+    """
+    def __init__(self):
+        self._classes = []
+        self._classids = array.array('i')
+        self._layerindices = array.array('i')
+        self._refoffsets = array.array('l', [0])
+        self._cellnums = array.array('l')
+        self._numincells = array.array('i')
+        self._columns = {}       # Attribute name -> (value ids, values, value to id dictionary)
+
+    def __len__(self):
+        return len(self._layerindices)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("index out of bounds")
+
+        cls = self._classes[self._classids[index]]
+        feature = cls.__new__(cls)
+        feature.layerindex = self._layerindices[index]
+        feature.cellelementrefs = tuple(self.getCellElementRefs(index))
+
+        attributes = {}
+        for name, (ids, values, valueids) in self._columns.iteritems():
+            if ids[index] >= 0:
+                attributes[name] = values[ids[index]]
+        feature.attributes = attributes
+
+        return feature
+
+    def append(self, feature):
+        """Add feature to store and return its index"""
+        index = len(self)
+
+        cls = feature.__class__
+        if cls not in self._classes:
+            self._classes.append(cls)
+        self._classids.append(self._classes.index(cls))
+
+        self._layerindices.append(feature.layerindex)
+
+        for cellnum, numincell in feature.cellelementrefs:
+            self._cellnums.append(cellnum)
+            self._numincells.append(numincell)
+        self._refoffsets.append(len(self._cellnums))
+
+        for name, value in feature.attributes.iteritems():
+            if name not in self._columns:
+                self._columns[name] = (array.array('i', index*[-1]), [], {})
+            ids, values, valueids = self._columns[name]
+
+            valueid = valueids.get(value)
+            if valueid == None:
+                valueid = valueids[value] = len(values)
+                values.append(value)
+            ids.append(valueid)
+
+        ## Attributes that the feature does not have
+        for name, (ids, values, valueids) in self._columns.iteritems():
+            if len(ids) == index:
+                ids.append(-1)
+
+        return index
+
+    def getCellElementRefs(self, index):
+        start, stop = self._refoffsets[index], self._refoffsets[index+1]
+        return zip(self._cellnums[start:stop], self._numincells[start:stop])
+
+    def getLayerIndex(self, index):
+        return self._layerindices[index]
+
+    def getValues(self, name):
+        """Return the list of distinct values of an attribute"""
+        if name in self._columns:
+            return self._columns[name][1]
+        return []
+
+    def getValueIds(self, name):
+        """Return the array of value ids of an attribute for all features"""
+        return self._columns[name][0]
+
+    def getValueId(self, index, name):
+        """Return the id in the values list of an attribute value of a feature or -1 if the feature lacks the attribute"""
+        return self._columns[name][0][index]
+
+    def getAttribute(self, index, name):
+        ids, values, valueids = self._columns[name]
+        return values[ids[index]]
+
+    def setAttribute(self, index, name, value):
+        if name not in self._columns:
+            self._columns[name] = (array.array('i', len(self)*[-1]), [], {})
+        ids, values, valueids = self._columns[name]
+
+        valueid = valueids.get(value)
+        if valueid == None:
+            valueid = valueids[value] = len(values)
+            values.append(value)
+        ids[index] = valueid
+
+    def remapCellElementRefs(self, remapdict, layerindex=None):
+        """Replace cell element references using remapdict, only features in layer layerindex
+        are changed unless layerindex is None
+
+        A cell element reference is replaced by several references if the value in 
+        remapdict is a list
+
+        >>> store = FeatureStore()
+        >>> store.append(FeatureNormal(0, [(1, 0)], 'Apgatan', 29))
+        0
+        >>> store.append(FeatureNormal(0, [(1, 1)], 'Bjorngatan', 29))
+        1
+        >>> store.remapCellElementRefs({(1, 0): [(5, 0), (6, 0)], (1, 1): (5, 1)})
+        >>> store[0].getCellElementRefs(), store[1].getCellElementRefs()
+        (((5, 0), (6, 0)), ((5, 1),))
+        """
+        if not [refs for refs in remapdict.itervalues() if isinstance(refs, list)]:
+            for index in xrange(len(self)):
+                if layerindex == None or self._layerindices[index] == layerindex:
+                    for i in xrange(self._refoffsets[index], self._refoffsets[index+1]):
+                        self._cellnums[i], self._numincells[i] = remapdict[(self._cellnums[i], self._numincells[i])]
+            return
+
+        ## Some cell elements were split so the reference arrays are rebuilt
+        refoffsets = array.array('l', [0])
+        cellnums = array.array('l')
+        numincells = array.array('i')
+        for index in xrange(len(self)):
+            refs = self.getCellElementRefs(index)
+            if layerindex == None or self._layerindices[index] == layerindex:
+                refs = remapCellElementRefs(refs, remapdict)
+            for cellnum, numincell in refs:
+                cellnums.append(cellnum)
+                numincells.append(numincell)
+            refoffsets.append(len(cellnums))
+
+        self._refoffsets = refoffsets
+        self._cellnums = cellnums
+        self._numincells = numincells
+
+def casevariants(s):
+    """Return a sorted list of the upper and lower case variants of the string s
+
+    >>> casevariants('a1b')
+    ['A1B', 'A1b', 'a1B', 'a1b']
+    """
+    return sorted(Set([''.join(chars) for chars in itertools.product(*[(c.upper(), c.lower()) for c in s])]))
+
+def remapCellElementRefs(cellelementrefs, remapdict):
+    """Return the cell element references replaced by the references in remapdict.
+    The values in remapdict are either a reference or a list of references
+
+    >>> remapCellElementRefs([(1, 0), (1, 2)], {(1, 0): (5, 0), (1, 2): [(6, 0), (7, 1)]})
+    [(5, 0), (6, 0), (7, 1)]
+    """
+    result = []
+    for ref in cellelementrefs:
+        newrefs = remapdict[ref]
+        if isinstance(newrefs, list):
+            result.extend(newrefs)
+        else:
+            result.append(newrefs)
+    return result
+
 def groupFactory(map, groupnumber, inicfg, db):
     maintable = db.getTableByName("R_GR%d"%groupnumber)
 
@@ -1,5 +1,8 @@
 import struct
 
+## Mean earth radius in meters
+earthradius = 6371000.0
+
 def dump(x):
     return " ".join(["%02x"%ord(c) for c in x])
 
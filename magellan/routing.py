@@ -5,8 +5,7 @@ import CellElement
 import Layer
 from Map import cfg_readlist, cfg_writelist
 import ConfigParser
-
-import osgeo.osr as osr
+from misc import earthradius
 
 class RoutingConfig(object):
     """Routing configuration
@@ -199,104 +198,16 @@ class RoutingConfig(object):
                 self.routingedgelayers.append(layer)
                 
     def build_routing_network(self, mapobj):
-        """Build routing network from layers"""
-        ## Find end-nodes
-        
-        ## Obtain the added layers in each routing set
-        diffsets = N.diff([Set()] + map(Set, self.routingsets))
-        nroutingsets = len(diffsets)
-        
-        ## Find all nodes in the routing network and calculate minimum
-        ## routing set number of all nodes 
-        nodes = {}
-        for irset, layers in enumerate(diffsets):
-            for layer in layers:
-                for cellelement in layer.getCellElements():
-                    coords = cellelement.coords
-                    ## Iterate over start and end point
-                    for coord in coords[0], coords[-1]:
-                        if coord not in nodes:
-                            nodes[coord] = irset
-                        else:
-                            nodes[coord] = min(irset, nodes[coord])
-
-        def create_edge(iroutingset, layer, cellelement, ceref, istartvertex, iendvertex, 
-                        startnode_edgenum, endnode_edgenum):
-            routingedge = CellElement.CellElementRouting(coords = (cellelement.coords[istartvertex], cellelement.coords[iendvertex]),
-                                                         layernumref = mapobj.getLayerIndex(layer),
-                                                         cellnumref = ceref[0],
-                                                         numincellref = ceref[1],
-                                                         ivertices =  (istartvertex, iendvertex),
-                                                         edgeindices = (startnode_edgenum, endnode_edgenum),
-                                                         orientations = cellelement2orientations(cellelement, \
-                                                                                                 istartvertex, iendvertex, layer),
-                                                         cost = distance(cellelement, istartvertex, iendvertex, layer),
-                                                         routingattributes = cellelement.routingattributes
-                                                         )
-            self.routingedgelayers[iroutingset].addCellElement(routingedge)
-            
-        ## Dictionary that keep track of the maximum edge number for each routing node
-        nedges = {}
-            
-        ## Create routing edges
-        for irset, laytuple in enumerate(zip(diffsets, self.routingedgelayers)):
-            layers, edgelayer = laytuple
-            for layer in layers:
-                for cellelement, ceref in layer.getCellElementsAndRefs():
-                    coords = cellelement.coords
-
-                    ## Keep a list of start vertex per route set
-                    istartvertex = nroutingsets * [0]
-                    routingvertices = [0]
-
-                    ## Iterate over vertices in polyline
-                    for iendvertex in range(1, len(coords)):
-                        ## Check if vertex is part of routing network
-                        if coords[iendvertex] not in nodes:
-                            continue
-
-                        routingvertices.append(iendvertex)
-
-                        if coords[iendvertex] not in nedges:
-                            endvertex_edgeindex = 0
-                        else:
-                            endvertex_edgeindex = nedges[coords[iendvertex]]
-                            
-                        ## Iterate over routing sets that the cell elements belongs to
-                        for irset2 in range(nodes[coords[iendvertex]], nroutingsets):
-                            ## Get vertex index of routing edge start point
-                            istart = istartvertex[irset2]
-
-                            ## Calculate edge index for the start node of the routing edge
-                            if coords[istart] not in nedges:
-                                nedges_startvertex = 0
-                            else:
-                                nedges_startvertex = nedges[coords[istart]]
-
-                            if istart > 0:
-                                startvertex_edgeindex = nedges_startvertex + 1
-                            else:
-                                startvertex_edgeindex = nedges_startvertex
-
-                            create_edge(irset2, layer, cellelement, ceref, istart, iendvertex, \
-                                        startvertex_edgeindex, endvertex_edgeindex)
-
-                            ## Update start vertex for this routing set
-                            istartvertex[irset2] = iendvertex
-
-                    ## Update nedges to include the created edges
-                    for ivertex in routingvertices:
-                        vertex = coords[ivertex]
-
-                        if ivertex > 0 and ivertex < len(coords)-1:
-                            nvertices = 2
-                        else:
-                            nvertices = 1
-                        
-                        if vertex in nedges:
-                            nedges[vertex] += nvertices
-                        else:
-                            nedges[vertex] = nvertices
+        """Build routing network from layers
+
+        The vertices of all polylines are packed into arrays with the discrete coordinates
+        as int64 keys so the nodes, the edges and their edge indices are found with array
+        operations.
+        """
+        polylines = self._gather_routing_polylines(mapobj)
+
+        for edgelayer, edges in zip(self.routingedgelayers, self._routing_edges(polylines)):
+            edgelayer.addCellElements(self._create_routing_edges(polylines, edges))
 
         ## If there is no alternate roads layer, create one
         if len(self.alternatelayers) == 0:
@@ -304,7 +215,305 @@ class RoutingConfig(object):
             mapobj.addLayer(altlay)
             self.addAlternateLayer(altlay)
             altlay.open('w')
-            
+
+    def update_routing_network(self, mapobj):
+        """Update routing network of a map opened in append mode
+
+        The changed polylines are the polylines in the modified cells of the routing layers.
+        The affected nodes are the vertices of the changed polylines and the end points
+        of their old routing edges. Only the routing edges of the changed polylines and the
+        edges that ends at or passes an affected node are removed and created again. The edge
+        indices of the other edges are not affected since the other polylines keep their
+        order and their routing vertices.
+
+        Only the polylines near the changes are read. The affected nodes are within the
+        modified cells, so the polylines that pass them are found in the cells that intersect
+        the modified cells. The edges of these polylines depend on the polylines that share
+        a vertex with them, which are found in the cells that intersect their bounding boxes.
+        """
+        ## Modified cells of the routing layers and their bounding boxes
+        changedcells = Set()
+        changedrecs = []
+        for layer in self.routinglayers:
+            if layer.mode == None:
+                layer.open('r')
+            layernum = mapobj.getLayerIndex(layer)
+            for cellnum in layer.modifiedcells:
+                changedcells.add((layernum, cellnum))
+                changedrecs.append(layer.calc_cell_extents(cellnum).negY())
+
+        if len(changedcells) == 0:
+            return
+
+        ## The routing edges are covered by the bounding boxes of their source polylines so the
+        ## old edges of the changed polylines are in the cells of the routing edge layers that
+        ## intersect the modified cells
+        for edgelayer in self.routingedgelayers:
+            if edgelayer.mode == None:
+                edgelayer.open('a')
+        oldedges = [{} for edgelayer in self.routingedgelayers]
+        self._read_routing_edges(oldedges, changedrecs)
+
+        ## The affected nodes are the vertices of the changed polylines and the end points of
+        ## their old edges
+        nearby = self._gather_routing_polylines(mapobj, self._routing_cells(changedrecs))
+        isnearbychanged = self._ischanged(nearby, changedcells)
+        affectedkeys = [nearby.keys[isnearbychanged[nearby.polyline]]]
+        for layeredges in oldedges:
+            affectedkeys.append(coordkeys(N.array([edge.coords for edge in layeredges.values()
+                                                   if (edge.layernumref, edge.cellnumref) in changedcells],
+                                                  dtype=N.int64).reshape(-1, 2)))
+        affectedkeys = N.unique(N.concatenate(affectedkeys))
+
+        ## Gather the changed polylines, the polylines that pass an affected node and the
+        ## polylines that share a vertex with them
+        isaffectedvertex = N.in1d(nearby.keys, affectedkeys)
+        selected = N.unique(N.r_[N.flatnonzero(isnearbychanged), nearby.polyline[isaffectedvertex]])
+        polylines = self._gather_routing_polylines(mapobj, 
+                                                   self._routing_cells(changedrecs + nearby.bboxrecs(selected)))
+        ischanged = self._ischanged(polylines, changedcells)
+        polylineindex = dict(((layernum, ceref[0], ceref[1]), i)
+                             for i, (layernum, ceref) in enumerate(zip(polylines.layernums, polylines.cerefs)))
+
+        ## Number of vertices at affected nodes up to and including each vertex
+        isaffectedvertex = N.in1d(polylines.keys, affectedkeys)
+        naffected = N.cumsum(isaffectedvertex)
+
+        def isaffected(istart, iend):
+            ## True for edges between the vertices istart and iend that ends at or passes
+            ## an affected node
+            return (naffected[iend] - naffected[istart] + isaffectedvertex[istart]) > 0
+
+        ## The old edges of unchanged polylines that passes an affected node may be
+        ## outside the modified cells
+        self._read_routing_edges(oldedges, 
+                                 polylines.bboxrecs(N.unique(polylines.polyline[isaffectedvertex & 
+                                                                                ~ischanged[polylines.polyline]])))
+
+        ## The cell structure of the routing edge layers cannot be changed in append mode
+        ## so check that the new edges are covered by the layers before removing any edges
+        newedges = []
+        for edgelayer, edges in zip(self.routingedgelayers, self._routing_edges(polylines)):
+            selection = ischanged[edges['polyline']] | isaffected(edges['istart'], edges['iend'])
+            newedges.append(self._create_routing_edges(polylines, edges, selection))
+            if edgelayer.dbboxrec != None:
+                for edge in newedges[-1]:
+                    if not edge.dbboxrec.iscoveredby(edgelayer.dbboxrec):
+                        raise ValueError('Routing edge %s is outside the bounding box of layer %s'%
+                                         (str(edge.dbboxrec), edgelayer.name))
+
+        for edgelayer, layeredges, layernewedges in zip(self.routingedgelayers, oldedges, newedges):
+            ## The source polylines of the old edges that are not gathered do not pass
+            ## an affected node
+            removed = []
+            for (cellnum, nincell), edge in layeredges.items():
+                source = (edge.layernumref, edge.cellnumref, edge.numincellref)
+                if (edge.layernumref, edge.cellnumref) in changedcells:
+                    removed.append((cellnum, nincell))
+                elif source in polylineindex:
+                    start = polylines.polylinestart[polylineindex[source]]
+                    if isaffected(start + edge.ivertices[0], start + edge.ivertices[1]):
+                        removed.append((cellnum, nincell))
+
+            ## Remove the old edges in reversed order so the numbers in cell stay valid
+            for cellnum, nincell in sorted(removed, reverse=True):
+                edgelayer.markCellModified(cellnum)
+                edgelayer.getCell(cellnum).pop(nincell)
+                edgelayer.nobjects -= 1
+
+            edgelayer.addCellElements(layernewedges)
+
+    def _ischanged(self, polylines, changedcells):
+        """Return a boolean array that is True for the polylines in the changed cells"""
+        return N.array([(layernum, ceref[0]) in changedcells
+                        for layernum, ceref in zip(polylines.layernums, polylines.cerefs)], dtype=bool)
+
+    def _routing_cells(self, recs):
+        """Return a dictionary keyed by routing layer of the sets of non-empty cells that 
+        intersect any of the bounding boxes in recs"""
+        return dict((layer, cells_intersecting(layer, recs)) for layer in self.routinglayers)
+
+    def _read_routing_edges(self, oldedges, recs):
+        """Read the routing edges in the cells that intersect any of the bounding boxes
+        in recs into a dictionary for each routing edge layer keyed by cell element reference
+        """
+        if len(recs) == 0:
+            return
+        for edgelayer, layeredges in zip(self.routingedgelayers, oldedges):
+            for cellnum in cells_intersecting(edgelayer, recs):
+                if (cellnum, 0) not in layeredges:
+                    for nincell, edge in enumerate(edgelayer.getCell(cellnum).getCellElements()):
+                        layeredges[(cellnum, nincell)] = edge
+
+    def _gather_routing_polylines(self, mapobj, cells=None):
+        """Gather the vertices of all routing polylines in the order they are processed
+
+        If cells is given only the polylines in these cells are gathered. It is a dictionary
+        keyed by layer of the sets of cell numbers. The gathered polylines keep their
+        relative order.
+
+        Returns a RoutingPolylines object with no polylines if there are no polylines
+        """
+        ## Obtain the added layers in each routing set
+        diffsets = N.diff([Set()] + map(Set, self.routingsets))
+
+        coordblocks = []
+        lonlatblocks = []
+        nvertices = []
+        polylinesets = []
+        polylinelayernums = []
+        cerefs = []
+        routingattributes = []
+        for irset, layers in enumerate(diffsets):
+            for layer in layers:
+                ## The cells are written in cell number order
+                if cells == None:
+                    layercells = sorted(layer.cellnumbers)
+                else:
+                    layercells = sorted(cells[layer])
+
+                layercoords = []
+                for cellnum in layercells:
+                    for nincell, cellelement in enumerate(layer.getCell(cellnum).getCellElements()):
+                        layercoords.extend(cellelement.coords)
+                        nvertices.append(len(cellelement.coords))
+                        polylinesets.append(irset)
+                        polylinelayernums.append(mapobj.getLayerIndex(layer))
+                        cerefs.append((cellnum, nincell))
+                        routingattributes.append(cellelement.routingattributes)
+                if len(layercoords) > 0:
+                    coordblocks.append(N.array(layercoords, dtype=N.int64))
+                    lonlatblocks.append(layer.discrete2float(layercoords))
+
+        if len(coordblocks) == 0:
+            return RoutingPolylines(N.zeros((0, 2), dtype=N.int64), N.zeros((0, 2)),
+                                    N.zeros(0, dtype=N.int64), [], [], [], [])
+
+        return RoutingPolylines(N.concatenate(coordblocks), N.concatenate(lonlatblocks),
+                                N.array(nvertices), polylinesets, polylinelayernums, cerefs,
+                                routingattributes)
+
+    def _routing_edges(self, polylines):
+        """Calculate the routing edges of polylines
+
+        Returns a list with a dictionary of edge attribute arrays for each routing edge layer
+        where istart and iend are the indices of the start and end vertex in the arrays of
+        the polylines.
+        """
+        nroutingsets = len(self.routingsets)
+        nvertices = polylines.nvertices
+        polyline = polylines.polyline
+        polylinesets = polylines.polylinesets
+        ivertex = polylines.ivertex
+        isendpoint = (ivertex == 0) | (ivertex == nvertices[polyline] - 1)
+
+        ## Number the distinct vertices
+        nodekeys, vertexnode = N.unique(polylines.keys, return_inverse=True)
+
+        ## The nodes are the end points of the polylines. Calculate the minimum routing set
+        ## of all nodes where nroutingsets marks vertices that are not nodes
+        endpointnodes = vertexnode[isendpoint]
+        endpointsets = polylinesets[polyline[isendpoint]]
+        order = N.argsort(endpointnodes, kind='mergesort')
+        endpointnodes, endpointsets = endpointnodes[order], endpointsets[order]
+        first = N.flatnonzero(N.r_[True, endpointnodes[1:] != endpointnodes[:-1]])
+        nodeminset = N.empty(len(nodekeys), dtype=N.int64)
+        nodeminset.fill(nroutingsets)
+        if len(endpointnodes) > 0:
+            nodeminset[endpointnodes[first]] = N.minimum.reduceat(endpointsets, first)
+
+        ## Routing vertices are the vertices of the polylines that are nodes
+        rvertex = N.flatnonzero(nodeminset[vertexnode] < nroutingsets)
+        rnode = vertexnode[rvertex]
+        rpolyline = polyline[rvertex]
+        rivertex = ivertex[rvertex]
+
+        ## Each routing vertex adds one edge to its node if it is an end point of
+        ## the polyline and two otherwise
+        nedges = N.where(isendpoint[rvertex], 1, 2)
+
+        ## Number of edges of the node of each routing vertex from the preceding polylines
+        order = N.lexsort((rpolyline, rnode))
+        sortednode, sortedpolyline = rnode[order], rpolyline[order]
+        preceding = N.cumsum(nedges[order]) - nedges[order]
+        index = N.arange(len(order))
+        newnode = N.r_[True, sortednode[1:] != sortednode[:-1]]
+        preceding -= preceding[N.maximum.accumulate(N.where(newnode, index, 0))]
+        newpolyline = newnode | N.r_[True, sortedpolyline[1:] != sortedpolyline[:-1]]
+        rnedges = N.empty(len(order), dtype=N.int64)
+        rnedges[order] = preceding[N.maximum.accumulate(N.where(newpolyline, index, 0))]
+
+        ## Segment lengths and bearings of all vertices, the segments between
+        ## polylines are never part of an edge
+        lon, lat = polylines.lonlat[:,0], polylines.lonlat[:,1]
+        seglength = N.zeros(len(lon))
+        seglength[:-1] = haversine(lon[:-1], lat[:-1], lon[1:], lat[1:])
+        bearings = N.zeros(len(lon))
+        bearings[:-1] = bearing(lon[:-1], lat[:-1], lon[1:], lat[1:])
+        reversebearings = N.zeros(len(lon))
+        reversebearings[:-1] = bearing(lon[1:], lat[1:], lon[:-1], lat[:-1])
+
+        result = []
+        for irset in range(len(self.routingedgelayers)):
+            ## The edges of a routing set goes between the start vertex of the polylines
+            ## and the routing vertices with nodes in the routing set
+            rset = N.flatnonzero((rivertex == 0) | (nodeminset[rnode] <= irset))
+            start, end = rset[:-1], rset[1:]
+            isedge = (rpolyline[start] == rpolyline[end]) & \
+                     (polylinesets[rpolyline[start]] < len(self.routingedgelayers))
+            start, end = start[isedge], end[isedge]
+
+            istart, iend = rvertex[start], rvertex[end]
+            if len(start) > 0:
+                costs = N.add.reduceat(seglength, N.column_stack((istart, iend)).ravel())[::2]
+            else:
+                costs = N.zeros(0)
+
+            result.append({'polyline': rpolyline[start],
+                           'istart': istart,
+                           'iend': iend,
+                           'istartvertex': rivertex[start],
+                           'iendvertex': rivertex[end],
+                           'startedgeindex': rnedges[start] + (rivertex[start] > 0),
+                           'endedgeindex': rnedges[end],
+                           'startorientation': angle2orientation(bearings[istart]),
+                           'endorientation': angle2orientation(reversebearings[iend - 1]),
+                           'cost': costs})
+        return result
+
+    def _create_routing_edges(self, polylines, edges, selection=None):
+        """Create routing edge cell elements from the edge arrays of _routing_edges
+
+        If selection is given only the selected edges are created
+        """
+        if selection != None:
+            edges = dict((name, values[selection]) for name, values in edges.items())
+
+        ## Convert the edge attributes to lists before creating the cell elements
+        edgeattributes = zip(edges['polyline'].tolist(),
+                             polylines.coords[edges['istart']].tolist(),
+                             polylines.coords[edges['iend']].tolist(),
+                             edges['istartvertex'].tolist(), edges['iendvertex'].tolist(),
+                             edges['startedgeindex'].tolist(), edges['endedgeindex'].tolist(),
+                             edges['startorientation'].tolist(), edges['endorientation'].tolist(),
+                             edges['cost'].tolist())
+
+        routingedges = []
+        for ipolyline, startcoord, endcoord, istartvertex, iendvertex, startedgeindex, endedgeindex, \
+                startorientation, endorientation, cost in edgeattributes:
+            ceref = polylines.cerefs[ipolyline]
+            routingedges.append(CellElement.CellElementRouting(coords = (startcoord, endcoord),
+                                                               layernumref = polylines.layernums[ipolyline],
+                                                               cellnumref = ceref[0],
+                                                               numincellref = ceref[1],
+                                                               ivertices = (istartvertex, iendvertex),
+                                                               edgeindices = (startedgeindex, endedgeindex),
+                                                               orientations = (startorientation, endorientation),
+                                                               cost = cost,
+                                                               routingattributes = polylines.routingattributes[ipolyline]
+                                                               ))
+        return routingedges
+
     def __repr__(self):
         s = ''
         s += 'Routing layers: ' + str(self.routinglayers) + '\n'
@@ -317,58 +526,163 @@ class RoutingConfig(object):
 
 
 
-wgs84 = osr.SpatialReference()
-wgs84.ImportFromEPSG(4326)
+class RoutingPolylines(object):
+    """Vertices of the routing polylines concatenated into arrays
 
-sweref99 = osr.SpatialReference()
-sweref99.ImportFromEPSG(3006)
+    Attributes
+    ----------
 
-wgs84_to_sweref99 = osr.CoordinateTransformation(wgs84, sweref99)
+    coords -- Discrete coordinates of all vertices
+    lonlat -- WGS84 coordinates of all vertices
+    keys -- Discrete coordinates of all vertices packed into int64 keys
+    nvertices -- Number of vertices of each polyline
+    polylinesets -- Index of the routing set where each polyline was added
+    polylinestart -- Index of the first vertex of each polyline
+    polyline -- Polyline index of each vertex
+    ivertex -- Vertex index in the polyline of each vertex
+    layernums, cerefs, routingattributes -- Layer index, cell element reference and routing
+                                            attributes of each polyline
+
+    """
+    def __init__(self, coords, lonlat, nvertices, polylinesets, layernums, cerefs, routingattributes):
+        self.coords = coords
+        self.lonlat = lonlat
+        self.keys = coordkeys(coords)
+        self.nvertices = nvertices
+        self.polylinesets = N.array(polylinesets, dtype=N.int64)
+        self.polylinestart = N.cumsum(nvertices) - nvertices
+        self.polyline = N.repeat(N.arange(len(nvertices)), nvertices)
+        self.ivertex = N.arange(len(coords)) - self.polylinestart[self.polyline]
+        self.layernums = layernums
+        self.cerefs = cerefs
+        self.routingattributes = routingattributes
+
+    def bboxrecs(self, polylineindices):
+        """Return the bounding boxes of the given polylines as a list of Rec objects"""
+        recs = []
+        for ipolyline in polylineindices:
+            start = self.polylinestart[ipolyline]
+            coords = self.coords[start:start + self.nvertices[ipolyline]]
+            recs.append(CellElement.Rec(coords.min(0), coords.max(0)))
+        return recs
+
+def cells_intersecting(layer, recs):
+    """Return the set of the non-empty cells of a layer that intersect any of the bounding
+    boxes in recs. The cells are looked up level by level in the cell hierarchy"""
+    cellnumbers = Set(layer.cellnumbers)
+    if len(cellnumbers) == 0:
+        return Set()
+
+    cells = Set()
+    for rec in recs:
+        ## The cell extents are in the internal coordinates with negated Y-values
+        rec = rec.negY()
+        for level in range(layer.nlevels+1):
+            cells.update(layer.calc_cells_intersecting(level, rec))
+    return cells & cellnumbers
+
+def coordkeys(coords):
+    """Pack discrete coordinates given as an (n, 2) int64 array into int64 keys
+
+    >>> coordkeys(N.array([[1, 2], [-1, -2]], dtype=N.int64))
+    array([4294967298,         -2])
+    
+    """
+    return (coords[:,0] << 32) + (coords[:,1] & 0xffffffff)
+
+def bearing(lon1, lat1, lon2, lat2):
+    """Calculate initial bearing in degrees from points 1 to points 2 given as arrays of WGS84
+    longitudes and latitudes. The bearing is measured clockwise from north in the range [-180, 180]
+
+    >>> bearing(N.array([0., 0.]), N.array([0., 0.]), N.array([1., 0.]), N.array([0., 1.]))
+    array([ 90.,   0.])
+    
+    """
+    lon1, lat1, lon2, lat2 = [N.radians(a) for a in (lon1, lat1, lon2, lat2)]
+    dlon = lon2 - lon1
+    return N.degrees(N.arctan2(N.sin(dlon) * N.cos(lat2),
+                               N.cos(lat1) * N.sin(lat2) - N.sin(lat1) * N.cos(lat2) * N.cos(dlon)))
+
+def haversine(lon1, lat1, lon2, lat2):
+    """Calculate great circle distance in meters between points 1 and points 2 given as arrays of
+    WGS84 longitudes and latitudes
+
+    >>> print '%.1f'%haversine(16.0, 58.0, 16.0, 59.0)
+    111194.9
+    
+    """
+    lon1, lat1, lon2, lat2 = [N.radians(a) for a in (lon1, lat1, lon2, lat2)]
+    a = N.sin((lat2 - lat1) / 2)**2 + N.cos(lat1) * N.cos(lat2) * N.sin((lon2 - lon1) / 2)**2
+    return 2 * earthradius * N.arcsin(N.sqrt(N.minimum(a, 1.0)))
 
 def angle(p1, p2):
     """Calculate direction angle from p1 to p2 which are WGS84 (lon,lat) coordinates
     
-    >>> angle([0., 0.], [1., 0])
+    >>> round(angle([0., 0.], [1., 0]), 1)
     90.0
-    >>> angle([0., 0.], [-1., 0])
+    >>> round(angle([0., 0.], [-1., 0]), 1)
     -90.0
-    >>> angle([0., 0.], [0., 1])
+    >>> round(angle([0., 0.], [0., 1]), 1)
     0.0
-    >>> angle([0., 0.], [1., -1])
+    >>> round(angle([0., 0.], [1., -1]), 1)
     135.0
-    >>> angle([0., 0.], [0., -1])
+    >>> round(angle([0., 0.], [0., -1]), 1)
     180.0
-    >>> angle([0., 0.], [1., 1])
+    >>> round(angle([0., 0.], [1., 1]), 1)
     45.0
 
     """
-    p1,p2 = [N.array(wgs84_to_sweref99.TransformPoint(*p)) for p in (p1,p2)]
-    v = p2-p1
-    return atan2(v[0], v[1]) * 180 / N.pi
+    return float(bearing(p1[0], p1[1], p2[0], p2[1]))
+
+def polylinegeometry(cellelement, layer):
+    """Calculate the geometry of all segments of a polyline cell element
+
+    Returns a tuple of arrays with the bearing of each segment, the bearing of each segment
+    in the reverse direction and the accumulated distance in meters at each vertex
+    """
+    lonlat = layer.discrete2float(cellelement.coords)
+    lon1, lat1 = lonlat[:-1,0], lonlat[:-1,1]
+    lon2, lat2 = lonlat[1:,0], lonlat[1:,1]
+    accdistance = N.zeros(len(lonlat))
+    accdistance[1:] = N.cumsum(haversine(lon1, lat1, lon2, lat2))
+    return bearing(lon1, lat1, lon2, lat2), bearing(lon2, lat2, lon1, lat1), accdistance
+
+def edgeorientations(geometry, istartvertices, iendvertices):
+    """Calculate start and end orientations of the edges between the start and end vertices
+    of a polyline with the geometry from polylinegeometry"""
+    bearings, reversebearings, accdistance = geometry
+    return (angle2orientation(bearings[N.asarray(istartvertices)]),
+            angle2orientation(reversebearings[N.asarray(iendvertices) - 1]))
+
+def edgedistances(geometry, istartvertices, iendvertices):
+    """Calculate the length in meters of the edges between the start and end vertices
+    of a polyline with the geometry from polylinegeometry"""
+    bearings, reversebearings, accdistance = geometry
+    return accdistance[N.asarray(iendvertices)] - accdistance[N.asarray(istartvertices)]
 
 def cellelement2orientations(cellelement, istartvertex, iendvertex, layer):
-    r = []
     n = len(cellelement.coords)
-    for points in (layer.discrete2float(cellelement.coords[istartvertex:istartvertex+2]),
-                   layer.discrete2float(cellelement.coords[iendvertex-n:iendvertex-n-2:-1])):
-        r.append(angle2orientation(angle(*points)))
-    return tuple(r)
+    startorientation, endorientation = edgeorientations(polylinegeometry(cellelement, layer),
+                                                        [istartvertex], [iendvertex % n])
+    return int(startorientation[0]), int(endorientation[0])
+
+def _cornersteps(scale):
+    ## Offsets to the four corners of a discrete coordinate cell
+    return N.array([scale, -scale, N.array([-1, 1])*scale, N.array([1, -1])*scale]) / 2
+
+def _cornerangles(p1, p2, scale):
+    ## Angles between all combinations of corners of the cells around p1 and p2
+    steps = _cornersteps(scale)
+    p1 = (N.asarray(p1) + steps).repeat(len(steps), axis=0)
+    p2 = N.tile(N.asarray(p2) + steps, (len(steps), 1))
+    return bearing(p1[:,0], p1[:,1], p2[:,0], p2[:,1])
 
 def points2orientationrange(p1, p2, scale):
-    possibleorient = Set([])
-    for step1 in [scale, -scale, N.array([-1, 1])*scale, N.array([1, -1])*scale]:
-       for step2 in [scale, -scale, N.array([-1, 1])*scale, N.array([1, -1])*scale]:
-           possibleorient.add(angle2orientation(angle(p1+step1/2, p2+step2/2)))
-    return list(possibleorient)
+    return list(Set(angle2orientation(_cornerangles(p1, p2, scale)).tolist()))
 
 def points2anglerange(p1, p2, scale):
-    amin = 360.0
-    amax = -360.0
-    for step1 in [scale, -scale, N.array([-1, 1])*scale, N.array([1, -1])*scale]:
-       for step2 in [scale, -scale, N.array([-1, 1])*scale, N.array([1, -1])*scale]:
-           amin = min(amin, angle(p1+step1/2, p2+step2/2))
-           amax = max(amax, angle(p1+step1/2, p2+step2/2))
-    return amin,amax
+    angles = _cornerangles(p1, p2, scale)
+    return float(angles.min()), float(angles.max())
 
 def angle2orientation(angle):
     """Calculate orientation number used in CellElement.CellElementRouting
@@ -406,15 +720,18 @@ def angle2orientation(angle):
       """
 #    return (-int(N.floor(angle/45.0))-2)%8
 #    return -(int(-angle/45) + 2)
-    return int(N.round(-(angle-(-90)) * 8./360.0)) % 8
+    orientation = N.round(-(N.asarray(angle)-(-90)) * 8./360.0).astype(int) % 8
+    if orientation.ndim == 0:
+        return int(orientation)
+    return orientation
 
 def distance(cellelement, start, end, layer):
-    """Calculate distance of a CellElement""" 
+    """Calculate distance in meters along a CellElement from vertex start to vertex end""" 
     if not isinstance(cellelement, CellElement.CellElement):
         raise ValueError("CellElement expected")
-    
-    coords = [wgs84_to_sweref99.TransformPoint(*v) for v in layer.discrete2float(cellelement.coords[start:end+1])]
-    return N.sum(N.sqrt(N.sum(N.diff(coords, axis=0)**2,axis=1)))
+
+    lonlat = layer.discrete2float(cellelement.coords[start:end+1])
+    return N.sum(haversine(lonlat[:-1,0], lonlat[:-1,1], lonlat[1:,0], lonlat[1:,1]))
         
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,446 @@
+"""Shortest path routing over the routing edge layers of a map
+
+The routing edges of all routing sets are loaded into a directed graph stored in
+compressed sparse row (CSR) form and point to point queries are answered with
+bidirectional A* search. A loaded graph can be saved as a snapshot directory of .npy
+files that is memory mapped when it is loaded again. The connected components of the
+graph can be listed to find parts of the road network that cannot be reached.
+
+"""
+import heapq
+import os
+import numpy as N
+import CellElement
+import routing
+
+## Direction flags of the edges, the same bits as in the serialized routing edges
+FlagBidirectional = CellElement.CellElementRouting.FlagBidirectional
+FlagReverse = 0x40  ## The traffic goes from the second to the first vertex
+
+def csr(nnodes, sources, targets):
+    """Create compressed sparse row adjacency from arrays of arc sources and targets
+
+    Returns offsets, targets and arc indices where the arcs leaving node i are
+    found at offsets[i]:offsets[i+1]
+
+    >>> offsets, targets, arcs = csr(3, N.array([2, 0, 2]), N.array([0, 1, 1]))
+    >>> offsets
+    array([0, 1, 1, 3])
+    >>> targets
+    array([1, 0, 1])
+    >>> arcs
+    array([1, 0, 2])
+
+    """
+    arcs = N.argsort(sources, kind='mergesort')
+    offsets = N.zeros(nnodes + 1, dtype=N.int64)
+    offsets[1:] = N.cumsum(N.bincount(sources, minlength=nnodes))
+    return offsets, targets[arcs], arcs
+
+def connected_components(nnodes, sources, targets):
+    """Find the connected components of an undirected graph given as arrays of edge end nodes
+
+    The components are found with union-find where all edges are processed at once in
+    each round. The root of each edge with different roots at its ends is hooked to the
+    smaller root followed by pointer jumping until all nodes point at their roots.
+    Returns the component index of each node where the components are numbered in
+    order of their smallest node.
+
+    >>> connected_components(6, N.array([4, 3, 1]), N.array([1, 5, 0]))
+    array([0, 0, 1, 2, 0, 2])
+
+    """
+    labels = N.arange(nnodes)
+    while True:
+        sourcelabels, targetlabels = labels[sources], labels[targets]
+        differ = sourcelabels != targetlabels
+        if not differ.any():
+            break
+
+        low = N.minimum(sourcelabels[differ], targetlabels[differ])
+        high = N.maximum(sourcelabels[differ], targetlabels[differ])
+        labels[high] = N.minimum(labels[high], low)
+
+        while True:
+            jumped = labels[labels]
+            if (jumped == labels).all():
+                break
+            labels = jumped
+
+    return N.unique(labels, return_inverse=True)[1]
+
+class Component(object):
+    """Connected component of the routing edges found by RoutingGraph.components
+
+    Attributes
+    ----------
+
+    nodes -- Node indices of the component
+    edges -- Edge indices of the component
+
+    """
+    def __init__(self, graph, nodes, edges):
+        self.graph = graph
+        self.nodes = nodes
+        self.edges = edges
+
+    @property
+    def nnodes(self):
+        return len(self.nodes)
+
+    @property
+    def nedges(self):
+        return len(self.edges)
+
+    @property
+    def cost(self):
+        """Sum of the costs of the edges"""
+        return int(self.graph.edgecosts[self.edges].sum())
+
+    @property
+    def routingsets(self):
+        """List of the routing sets of the edges"""
+        return N.unique(self.graph.edgesets[self.edges]).tolist()
+
+    @property
+    def bboxrec(self):
+        """Bounding box of the nodes in WGS84 coordinates"""
+        lonlat = self.graph.nodelonlat[self.nodes]
+        return CellElement.Rec(lonlat.min(0), lonlat.max(0))
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(nodes: %d, edges: %d, routing sets: %s)'%(
+            self.nnodes, self.nedges, str(self.routingsets))
+
+class Route(object):
+    """Route found by RoutingGraph.route
+
+    Attributes
+    ----------
+
+    cost -- Sum of the costs of the edges
+    nodes -- List of node indices from origin to destination
+    edges -- List of edge indices from origin to destination
+
+    """
+    def __init__(self, graph, cost, nodes, edges):
+        self.graph = graph
+        self.cost = cost
+        self.nodes = nodes
+        self.edges = edges
+
+    @property
+    def lonlat(self):
+        """WGS84 coordinates of the nodes of the route"""
+        return self.graph.nodelonlat[self.nodes]
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(cost: %d, nodes: %d)'%(self.cost, len(self.nodes))
+
+class RoutingGraph(object):
+    """Directed graph of the routing edges of a map
+
+    The nodes are the distinct end points of the routing edges. The routing edge layers
+    are assumed to share the same discrete coordinate space.
+
+    Attributes
+    ----------
+
+    nodecoords -- Discrete coordinates of the nodes as an (nnodes, 2) array
+    nodelonlat -- WGS84 coordinates of the nodes as an (nnodes, 2) array
+    edgenodes -- Start and end node of the edges as an (nedges, 2) array
+    edgecosts -- Cost of the edges
+    edgeflags -- Direction flags of the edges (FlagBidirectional, FlagReverse)
+    edgesets -- Routing set of the edges
+    edgerefs -- Routing edge layer index, cell number and number in cell of the edges
+    sourcerefs -- Layer index, cell number and number in cell of the polylines the edges were created from
+    offsets, targets, arcedges -- Outgoing arcs in CSR form
+    roffsets, rsources, rarcedges -- Incoming arcs in CSR form
+    nroutingsets -- Number of routing sets
+
+    levelradius -- Distance in meters from origin or destination where the search steps to
+                   the next coarser routing set. If None the whole graph is searched.
+    heuristicfactor -- Factor of the great circle distance used as A* heuristic. It is less than
+                   one to keep the heuristic admissible with the truncated integer edge costs.
+
+    """
+    levelradius = 10000.0
+    heuristicfactor = 0.9
+
+    ## Version and arrays of saved graphs
+    snapshotversion = 1
+    snapshotarrays = ('nodecoords', 'nodelonlat', 'edgenodes', 'edgecosts', 'edgeflags', 'edgesets',
+                      'edgerefs', 'sourcerefs', 'offsets', 'targets', 'arcedges',
+                      'roffsets', 'rsources', 'rarcedges')
+
+    def __init__(self, nodecoords, nodelonlat, edgenodes, edgecosts, edgeflags, edgesets,
+                 edgerefs, sourcerefs):
+        self.nodecoords = nodecoords
+        self.nodelonlat = nodelonlat
+        self.edgenodes = edgenodes
+        self.edgecosts = edgecosts
+        self.edgeflags = edgeflags
+        self.edgesets = edgesets
+        self.edgerefs = edgerefs
+        self.sourcerefs = sourcerefs
+
+        if len(edgesets) > 0:
+            self.nroutingsets = int(edgesets.max()) + 1
+        else:
+            self.nroutingsets = 0
+
+        self._buildAdjacency()
+
+    @classmethod
+    def fromMap(cls, mapobj):
+        """Load the routing edges of all routing sets of a map"""
+        if mapobj.routingcfg == None:
+            raise ValueError('Map has no routing network')
+
+        coordblocks = []
+        lonlatblocks = []
+        edgecosts = []
+        edgeflags = []
+        edgesets = []
+        edgerefs = []
+        sourcerefs = []
+        for irset, layer in enumerate(mapobj.routingcfg.routingedgelayers):
+            if layer.mode == None:
+                layer.open('r')
+            layerindex = mapobj.getLayerIndex(layer)
+
+            layercoords = []
+            for edge, ceref in layer.getCellElementsAndRefs():
+                layercoords.extend(edge.coords)
+                edgecosts.append(edge.cost)
+                edgeflags.append(int(edge.ratt.bidirectional) * FlagBidirectional |
+                                 int(edge.ratt.reversedir) * FlagReverse)
+                edgesets.append(irset)
+                edgerefs.append((layerindex, ceref[0], ceref[1]))
+                sourcerefs.append((edge.layernumref, edge.cellnumref, edge.numincellref))
+
+            if len(layercoords) > 0:
+                coordblocks.append(N.array(layercoords, dtype=N.int64))
+                lonlatblocks.append(layer.discrete2float(layercoords))
+
+        if len(coordblocks) == 0:
+            coords = N.zeros((0, 2), dtype=N.int64)
+            lonlat = N.zeros((0, 2))
+        else:
+            coords = N.concatenate(coordblocks)
+            lonlat = N.concatenate(lonlatblocks)
+
+        ## The nodes are the distinct edge end points
+        keys = (coords[:,0] << 32) + (coords[:,1] & 0xffffffff)
+        nodekeys, first, vertexnode = N.unique(keys, return_index=True, return_inverse=True)
+
+        return cls(coords[first], lonlat[first], vertexnode.reshape(-1, 2),
+                   N.array(edgecosts, dtype=N.int64),
+                   N.array(edgeflags, dtype=N.uint8),
+                   N.array(edgesets, dtype=N.int8),
+                   N.array(edgerefs, dtype=N.int64).reshape(-1, 3),
+                   N.array(sourcerefs, dtype=N.int64).reshape(-1, 3))
+
+    def save(self, dirname):
+        """Save graph to a snapshot directory with one .npy file per array
+
+        The header with the snapshot version is written last so an incomplete
+        snapshot cannot be loaded.
+        """
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        for name in self.snapshotarrays:
+            N.save(os.path.join(dirname, name + '.npy'), N.ascontiguousarray(getattr(self, name)))
+
+        N.save(os.path.join(dirname, 'header.npy'),
+               N.array([self.snapshotversion, self.nroutingsets], dtype=N.int64))
+
+    @classmethod
+    def load(cls, dirname, mmap_mode='r'):
+        """Load graph from a snapshot directory written by save
+
+        The arrays are memory mapped unless mmap_mode is None, see numpy.load
+        """
+        header = N.load(os.path.join(dirname, 'header.npy'))
+        if header[0] != cls.snapshotversion:
+            raise ValueError('Unsupported routing graph snapshot version %d'%header[0])
+
+        graph = cls.__new__(cls)
+        graph.nroutingsets = int(header[1])
+        for name in cls.snapshotarrays:
+            setattr(graph, name, N.load(os.path.join(dirname, name + '.npy'), mmap_mode=mmap_mode))
+        return graph
+
+    @property
+    def nnodes(self):
+        return len(self.nodecoords)
+
+    @property
+    def nedges(self):
+        return len(self.edgecosts)
+
+    def _buildAdjacency(self):
+        ## Bidirectional edges gives one arc in each direction and one way edges one arc
+        ## in the direction of the traffic
+        bidirectional = (self.edgeflags & FlagBidirectional) != 0
+        reverse = ~bidirectional & ((self.edgeflags & FlagReverse) != 0)
+        forward = ~reverse
+
+        edges = N.arange(self.nedges)
+        arcedges = N.concatenate((edges[forward], edges[bidirectional | reverse]))
+        sources = N.concatenate((self.edgenodes[forward,0], self.edgenodes[bidirectional | reverse,1]))
+        targets = N.concatenate((self.edgenodes[forward,1], self.edgenodes[bidirectional | reverse,0]))
+
+        self.offsets, self.targets, arcs = csr(self.nnodes, sources, targets)
+        self.arcedges = arcedges[arcs]
+        self.roffsets, self.rsources, arcs = csr(self.nnodes, targets, sources)
+        self.rarcedges = arcedges[arcs]
+
+    def components(self, routingsets=None):
+        """Find the connected components of the edges in the given routing sets
+
+        The direction of one-way edges is ignored. If routingsets is None the edges of all
+        routing sets are used. Returns a list of Component objects with the largest
+        component first.
+        """
+        if routingsets == None:
+            edges = N.arange(self.nedges)
+        else:
+            edges = N.flatnonzero(N.in1d(self.edgesets, routingsets))
+
+        ## Number the nodes of the selected edges
+        nodes, edgenodes = N.unique(N.asarray(self.edgenodes)[edges].ravel(), return_inverse=True)
+        edgenodes = edgenodes.reshape(-1, 2)
+
+        if len(nodes) == 0:
+            return []
+
+        nodelabels = connected_components(len(nodes), edgenodes[:,0], edgenodes[:,1])
+        edgelabels = nodelabels[edgenodes[:,0]]
+        ncomponents = nodelabels.max() + 1
+
+        ## Group the nodes and edges by component
+        nodegroups = N.split(nodes[N.argsort(nodelabels, kind='mergesort')],
+                             N.cumsum(N.bincount(nodelabels, minlength=ncomponents))[:-1])
+        edgegroups = N.split(edges[N.argsort(edgelabels, kind='mergesort')],
+                             N.cumsum(N.bincount(edgelabels, minlength=ncomponents))[:-1])
+
+        components = [Component(self, componentnodes, componentedges)
+                      for componentnodes, componentedges in zip(nodegroups, edgegroups)]
+        components.sort(key=lambda component: component.nnodes, reverse=True)
+        return components
+
+    def nearestNode(self, lon, lat):
+        """Return index of the node nearest to a WGS84 position"""
+        if self.nnodes == 0:
+            raise ValueError('Routing graph has no nodes')
+        return int(N.argmin(routing.haversine(self.nodelonlat[:,0], self.nodelonlat[:,1], lon, lat)))
+
+    def route(self, origin, destination, hierarchical=True):
+        """Find the shortest route between two WGS84 (lon, lat) positions
+
+        The positions are snapped to the nearest nodes. If hierarchical is True the search
+        uses coarser routing sets far from origin and destination which is faster but not
+        guaranteed to find the shortest route. The whole graph is searched if no route is found
+        that way. Returns a Route object or None if the destination cannot be reached.
+        """
+        source = self.nearestNode(*origin)
+        target = self.nearestNode(*destination)
+
+        if source == target:
+            return Route(self, 0, [source], [])
+
+        lon, lat = self.nodelonlat[:,0], self.nodelonlat[:,1]
+        hsource = routing.haversine(lon, lat, lon[source], lat[source])
+        htarget = routing.haversine(lon, lat, lon[target], lat[target])
+
+        route = None
+        if hierarchical and self.levelradius != None and self.nroutingsets > 1:
+            levels = self.nroutingsets - 1 - (N.minimum(hsource, htarget) / self.levelradius).astype(N.int64)
+            route = self._search(source, target, hsource, htarget, N.maximum(levels, 0))
+
+        if route == None:
+            route = self._search(source, target, hsource, htarget, None)
+
+        return route
+
+    def _search(self, source, target, hsource, htarget, levels):
+        """Bidirectional A* search from source to target node
+
+        Both searches use the average potential of the distances to source and target so
+        they work on the same reduced costs. An edge can only be used if its routing set
+        is less or equal to the level of one of its nodes.
+        """
+        potential = (htarget - hsource) * (0.5 * self.heuristicfactor)
+
+        ## Forward and reverse search state. Only the arcs of the scanned nodes are read
+        ## from the arrays so the search works well on memory mapped graphs
+        adjacency = ((self.offsets, self.targets, self.arcedges, 1),
+                     (self.roffsets, self.rsources, self.rarcedges, -1))
+        dist = ({source: 0}, {target: 0})
+        parent = ({source: None}, {target: None})
+        heaps = ([(0.0, 0, source)], [(0.0, 0, target)])
+        offset = (-float(potential[source]), float(potential[target]))
+
+        best = None
+        meeting = None
+        while heaps[0] and heaps[1]:
+            ## Stop when no shorter path can be found in the reduced costs
+            if best != None and heaps[0][0][0] + heaps[1][0][0] >= best + offset[0] + offset[1]:
+                break
+
+            d = len(heaps[0]) > len(heaps[1]) and 1 or 0
+            key, du, u = heapq.heappop(heaps[d])
+            if du > dist[d][u]:
+                continue
+
+            offsets, nodes, arcedges, sign = adjacency[d]
+            arcs = slice(offsets[u], offsets[u+1])
+            arcnodes = nodes[arcs]
+            edges = arcedges[arcs]
+            arcpotentials = (sign*potential[arcnodes] + offset[d]).tolist()
+            if levels is not None:
+                usable = self.edgesets[edges] <= N.maximum(levels[u], levels[arcnodes])
+            else:
+                usable = N.ones(len(edges), dtype=bool)
+
+            for v, edge, cost, arcpotential, isusable in zip(arcnodes.tolist(), edges.tolist(),
+                                                             self.edgecosts[edges].tolist(),
+                                                             arcpotentials, usable.tolist()):
+                if not isusable:
+                    continue
+                dv = du + cost
+                if dv < dist[d].get(v, dv + 1):
+                    dist[d][v] = dv
+                    parent[d][v] = (u, edge)
+                    heapq.heappush(heaps[d], (dv + arcpotential, dv, v))
+                    if v in dist[1-d] and (best == None or dv + dist[1-d][v] < best):
+                        best = dv + dist[1-d][v]
+                        meeting = v
+
+        if best == None:
+            return None
+
+        ## Follow the parents from the meeting node back to source and target
+        nodes = [meeting]
+        edges = []
+        for d in (0, 1):
+            node = meeting
+            while parent[d][node] != None:
+                node, edge = parent[d][node]
+                nodes.append(node)
+                edges.append(edge)
+            if d == 0:
+                nodes.reverse()
+                edges.reverse()
+
+        return Route(self, best, nodes, edges)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(nodes: %d, edges: %d, routing sets: %d)'%(
+            self.nnodes, self.nedges, self.nroutingsets)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
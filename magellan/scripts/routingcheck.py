@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+import sys
+import os
+
+from magellan.Map import Map
+import magellan.mapdir as mapdir
+from magellan.rsttable import toRSTtable
+
+def usage():
+    print "Usage: routingcheck.py mapfile|mapdir [maxcomponents]"
+
+if len(sys.argv) < 2:
+    usage()
+    sys.exit(1)
+
+if os.path.isfile(sys.argv[1]):
+    m = Map(mapdir.Image(sys.argv[1]))
+elif os.path.isdir(sys.argv[1]):
+    m = Map(mapdir.MapDirectory(sys.argv[1]))
+else:
+    raise Exception("Cannot open " + sys.argv[1])
+
+if len(sys.argv) > 2:
+    maxcomponents = int(sys.argv[2])
+else:
+    maxcomponents = 20
+
+m.open('r')
+
+graph = m.getRoutingGraph()
+print graph
+print
+
+## Number of components in each routing set
+rows = [['Routing set', 'Edges', 'Components', 'Largest component']]
+for irset in range(graph.nroutingsets):
+    components = graph.components([irset])
+    rows.append([irset, sum([c.nedges for c in components]), len(components),
+                 len(components) and components[0].nnodes])
+print toRSTtable(rows)
+print
+
+## Components of all routing sets, the components after the first are islands that
+## cannot be reached from the main network
+components = graph.components()
+rows = [['Component', 'Nodes', 'Edges', 'Routing sets', 'Bounding box']]
+for i, component in enumerate(components[:maxcomponents]):
+    rows.append([i, component.nnodes, component.nedges,
+                 ','.join(map(str, component.routingsets)), str(component.bboxrec)])
+print toRSTtable(rows)
+
+if len(components) > maxcomponents:
+    print '%d more components'%(len(components) - maxcomponents)
+
+m.close()
@@ -1,5 +1,5 @@
 from Map import Map
-from DBUtil import Database, AuxTableManager, Row
+from DBUtil import Database, AuxTableManager, Row, sortHashFunc
 from mapdir import MapDirectory
 import unittest
 import tempfile
@@ -8,6 +8,7 @@ import os
 import random
 from testutil import TempDir
 import struct
+from DBSchema import FieldStruct, FieldTypeCHARACTER, FieldTypeLONGINT, FieldTypeSHORTINT
 
 
 from sets import Set
@@ -93,6 +94,65 @@ class DBTest(unittest.TestCase):
         db.close()
         
         
+class AuxTableManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = TempDir()
+        self.mapdir = MapDirectory(str(self.tempdir))
+
+        db = Database(self.mapdir, "db00", 'w')
+        db.addTable(name='AUX', filename='aux.dat',
+                    fieldstructlist=[FieldStruct(name='NAME_BUF', fd_type=FieldTypeCHARACTER, fd_dim1=248, fd_dim2=1)])
+        self.db = db
+
+    def tearDown(self):
+        del self.tempdir
+
+    def writeTexts(self, texts, **kvargs):
+        am = AuxTableManager(self.db.getTableByName('AUX'), **kvargs)
+        textslots = [am.appendText(text, i+1) for i, text in enumerate(texts)]
+        am.flush()
+        index = am.index
+        del am
+        self.db.close()
+
+        self.db = Database(self.mapdir, "db00", 'r')
+        am = AuxTableManager(self.db.getTableByName('AUX'))
+        return textslots, index, am
+
+    def testReadBack(self):
+        texts = ['street%d'%i for i in range(200)] + ['x'*200, 'y'*100]
+        textslots, index, am = self.writeTexts(texts)
+
+        self.assertEqual([am.lookupText(ts & 0xffffff, ts >> 24) for ts in textslots], texts)
+
+    def testConsecutiveDuplicates(self):
+        texts = ['Apgatan', 'Apgatan', 'Storgatan', 'Apgatan']
+        textslots, index, am = self.writeTexts(texts)
+
+        self.assertEqual(textslots[0], textslots[1])
+        self.assertNotEqual(textslots[0], textslots[3])
+        self.assertEqual([am.lookupText(ts & 0xffffff, ts >> 24) for ts in textslots], texts)
+
+    def testGlobalDuplicates(self):
+        texts = ['Apgatan', 'Storgatan', 'Apgatan']
+        textslots, index, am = self.writeTexts(texts, cachesize=None)
+
+        self.assertEqual(textslots[0], textslots[2])
+        self.assertEqual(am.table.getRowCount(), 2)
+
+    def testNoReuse(self):
+        textslots, index, am = self.writeTexts(['Apgatan', 'Apgatan'], cachesize=0)
+
+        self.assertNotEqual(textslots[0], textslots[1])
+
+    def testSearchIndex(self):
+        texts = ['Apgatan', 'Apgatan', 'Axgatan', 'Bgatan', '1:a gatan']
+        textslots, index, am = self.writeTexts(texts)
+
+        self.assertEqual(index[sortHashFunc('A')], 1)
+        self.assertEqual(index[sortHashFunc('B')], 4)
+        self.assertEqual(index[sortHashFunc('1')], 5)
+
 class TableTest(unittest.TestCase):
     def setUp(self):
         self.tempdir = TempDir("./layerdata2",keep=True)
@@ -152,6 +212,46 @@ class TableTest(unittest.TestCase):
 
         self.assertEqual(rows+newrows, rowsafter)
 
+class TableColumnTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = TempDir()
+        self.mapdir = MapDirectory(str(self.tempdir))
+
+        db = Database(self.mapdir, "db00", 'w')
+        db.addTable(name='R_GR0', filename='gr0.ext',
+                    fieldstructlist=[FieldStruct(name='NAME_REF', fd_type=FieldTypeLONGINT),
+                                     FieldStruct(name='N_IN_C', fd_type=FieldTypeSHORTINT)])
+        table = db.getTableByName('R_GR0')
+
+        ## Write enough rows to fill several pages
+        for i in range(1000):
+            row = Row(table)
+            row.setColumnUInt(table.getColumnIndex('NAME_REF'), 0x01000000 + 3*i)
+            row.setColumnUInt(table.getColumnIndex('N_IN_C'), i % 7)
+            table.writeRow(row)
+        db.close()
+
+        self.db = Database(self.mapdir, "db00", 'r')
+
+    def tearDown(self):
+        del self.tempdir
+
+    def testGetColumn(self):
+        table = self.db.getTableByName("R_GR0")
+
+        expected = [curs.asDict()['NAME_REF'] for curs in table.getCursor(0)]
+
+        self.assertEqual(len(expected), 1000)
+        self.assertEqual(table.getColumn('NAME_REF'), expected)
+
+    def testGetColumns(self):
+        table = self.db.getTableByName("R_GR0")
+
+        namerefs, nincs = table.getColumns(['NAME_REF', 'N_IN_C'])
+
+        self.assertEqual(namerefs, [0x01000000 + 3*i for i in range(1000)])
+        self.assertEqual(nincs, [i % 7 for i in range(1000)])
+
 class FileTest(unittest.TestCase):
     def setUp(self):
         self.tempdir = TempDir("./layerdata1",keep=False)
@@ -12,6 +12,7 @@ from magellan.Cell import Cell
 from magellan.SearchGroup import Feature,FeatureNormal,FeatureStreet, \
      GroupNormal
 from magellan.Layer import Layer, LayerTypePolyline
+from magellan.mapdir import MapDirectory
 
 def dump(x):
     return " ".join(["0x%02x "%ord(c) for c in x])
@@ -21,6 +22,175 @@ def areSorted(x):
     tmp.sort()
     return tmp == x
 
+def createGroupMap(tempdir, names, maxfeaturesinmemory=None):
+    """Create a map in tempdir with a group 00_Streets that has a feature for each name. Feature i
+    has a polyline that starts at (16.0 + 0.001 * i, 58.0 + 0.001 * i)"""
+    map = Map(MapDirectory(str(tempdir)))
+    map.inmemory = True
+    map.open('w')
+
+    streets = Layer(map, name="00_Streets", filename="str", layertype=LayerTypePolyline)
+    map.addLayer(streets)
+    streets.open('w')
+
+    group = GroupNormal(map, name="00_Streets")
+    group.maxfeaturesinmemory = maxfeaturesinmemory
+    map.addGroup(group)
+    group.addLayer(streets)
+    map.addPOIGroupAndLayer()
+
+    for i, name in enumerate(names):
+        cellelement = CellElementPolyline.fromfloat(streets, [(16.0 + 0.001 * i, 58.0 + 0.001 * i),
+                                                              (16.0005 + 0.001 * i, 58.0005 + 0.001 * i)],
+                                                    objtype=group.getObjtypeIndex(map.getLayerIndex(streets), 1))
+        group.addFeature(FeatureNormal(map.getLayerIndex(streets), streets.addCellElement(cellelement), name, 1))
+
+    return map, group
+
+class GroupSearchTest(unittest.TestCase):
+    names = ['McDonald Road', 'MAX', 'apgatan', 'Mcbride Street', '1:a Gatan', 'Maa', 'MAB', 
+             'Apgatan', 'Nygatan', 'mcbride Street']
+
+    def setUp(self):
+        self.tempdir = TempDir()
+
+    def assertSearch(self, group):
+        for prefix in ('', 'a', 'AP', 'Mcb', 'MAB', 'ma', 'mc', '1', 'q', 'mcbride s', 'APGATAN', 'mcx'):
+            expected = Set([name for name in self.names if name.upper().startswith(prefix.upper())])
+            found = [feature.name for feature in group.search(prefix)]
+            self.assertEqual(len(found), len(expected))
+            self.assertEqual(Set(found), expected)
+
+            found = [feature.name for feature in group.search(prefix, limit=2)]
+            self.assertEqual(len(found), min(2, len(expected)))
+            self.assertTrue(Set(found) <= expected)
+
+    def testSearch(self):
+        map, group = createGroupMap(self.tempdir, self.names)
+
+        self.assertSearch(group)
+
+        map.close()
+
+        map = Map(MapDirectory(str(self.tempdir)))
+        map.open('r')
+        group = map.getGroupByName("00_Streets")
+        group.open('r')
+
+        ## The features are sorted case-sensitively within each first character bucket
+        self.assertEqual([feature.name for feature in group.features],
+                         ['1:a Gatan', 'Apgatan', 'apgatan', 'MAB', 'MAX', 'Maa', 'McDonald Road',
+                          'Mcbride Street', 'mcbride Street', 'Nygatan'])
+        
+        self.assertSearch(group)
+
+    def testSearchSpilled(self):
+        map, group = createGroupMap(self.tempdir, self.names, maxfeaturesinmemory=3)
+
+        nruns = len(group._runs)
+        self.assertTrue(nruns > 0)
+
+        self.assertSearch(group)
+
+        ## Searching must not read the spilled runs back to memory
+        self.assertEqual(len(group._runs), nruns)
+
+        map.close()
+
+class GroupTextslotIndexTest(unittest.TestCase):
+    def testGetFeatureByCellElement(self):
+        tempdir = TempDir()
+
+        ## Consecutive identical names share textslot
+        map, group = createGroupMap(tempdir, 20 * ['Storgatan'] + ['Apgatan'])
+
+        ## Features that are present in several cell elements
+        streets = group.layers[0]
+        for name in ('Storgatan', 'Bgatan'):
+            cellelementrefs = []
+            for i in range(3):
+                cellelement = CellElementPolyline.fromfloat(streets, [(16.1 + 0.001 * i, 58.1), (16.1 + 0.001 * i, 58.11)],
+                                                            objtype=group.getObjtypeIndex(map.getLayerIndex(streets), 1))
+                cellelementrefs += streets.addCellElement(cellelement)
+            group.addFeature(FeatureNormal(map.getLayerIndex(streets), cellelementrefs, name, 1))
+
+        map.close()
+
+        map = Map(MapDirectory(str(tempdir)))
+        map.open('r')
+        group = map.getGroupByName("00_Streets")
+        group.open('r')
+        streets = group.layers[0]
+
+        cellelements = list(streets.getCellElements())
+        self.assertEqual(len(cellelements), 27)
+
+        for cellelement in cellelements:
+            feature = group.getFeatureByCellElement(cellelement)
+            self.assertTrue((cellelement.cellnum, cellelement.numincell) in feature.getCellElementRefs())
+
+        for cell in streets.getCells():
+            cellelements = list(cell.getCellElements())
+            for cellelement, feature in zip(cellelements, group.getFeaturesByCellElements(cellelements)):
+                self.assertTrue((cellelement.cellnum, cellelement.numincell) in feature.getCellElementRefs())
+
+class GroupSpillTest(unittest.TestCase):
+    def testAddFeaturesSpilled(self):
+        tempdir = TempDir()
+
+        names = ["Storstigen", "apstigen", "Bstigen", "Apstigen", "1:a stigen", "Cstigen", "Astigen"]
+
+        ## Spill a sorted run to disk for every second feature
+        map, group = createGroupMap(tempdir, names, maxfeaturesinmemory=2)
+
+        self.assertEqual(len(group._runs), 3)
+        self.assertEqual(group.getFeatureCount(), len(names))
+        rundir = str(group._rundir)
+        self.assertEqual(len(os.listdir(rundir)), 3)
+
+        refsbefore = Set([ref for feature in group.xfeatures for ref in feature.getCellElementRefs()])
+
+        ## Use more than one cell level so the cell elements are moved when the layer is optimized
+        group.layers[0].estimator.maxcellelements = 4
+
+        map.close()
+
+        ## The runs are removed at close
+        self.assertFalse(os.path.exists(rundir))
+
+        map = Map(MapDirectory(str(tempdir)))
+        map.open('r')
+        group = map.getGroupByName("00_Streets")
+        group.open('r')
+        streets = group.layers[0]
+
+        features = list(group.features)
+        self.assertEqual([feature.name for feature in features],
+                         ["1:a stigen", "Apstigen", "Astigen", "apstigen", "Bstigen", "Cstigen", "Storstigen"])
+
+        ## The references of the spilled features must follow the moved cell elements
+        refsafter = Set([ref for feature in features for ref in feature.getCellElementRefs()])
+        self.assertNotEqual(refsafter, refsbefore)
+
+        for feature in features:
+            [ref] = feature.getCellElementRefs()
+            lon = streets.getCellElement(ref).floatcoords(streets)[0][0]
+            self.assertEqual(names[int(round((lon - 16.0) / 0.001))], feature.name)
+
+    def testRunsRemovedOnError(self):
+        tempdir = TempDir()
+
+        map, group = createGroupMap(tempdir, ["Storstigen", "apstigen", "Bstigen"], maxfeaturesinmemory=2)
+        rundir = str(group._rundir)
+        self.assertTrue(os.path.exists(rundir))
+
+        ## The runs are removed even if writing the features fails
+        def fail(aux, textslotupdates):
+            raise IOError("disk full")
+        group._writeFeatures = fail
+        self.assertRaises(IOError, group.close)
+        self.assertFalse(os.path.exists(rundir))
+
 class GroupNormalTest(unittest.TestCase):
     def setUp(self):
         self.tempdir = TempDir("./layerdata2", keep=True)
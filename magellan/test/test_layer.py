@@ -4,10 +4,12 @@ import tempfile
 import shutil
 import os
 from magellan.CellElement import CellElementPolyline, CellElementArea, CellElementPoint, Rec
-from magellan.Layer import Layer,LayerTypePolyline,LayerTypePoint
+from magellan.Layer import Layer,LayerTypePolyline,LayerTypePoint,LayerTypePolygon,cell_level,totcells_at_level
+from magellan.mapdir import MapDirectory
 from sets import Set
 from testutil import TempDir
 import numpy as N
+import random
 
 class myTestCase(unittest.TestCase):
     def assertSetsEqual(self, actual, expected):
@@ -400,5 +402,91 @@ class LayerTestAdd(myTestCase):
         
         self.assertSetsEqual(actual, expected)
         
+class LayerTestSplit(myTestCase):
+    def setUp(self):
+        self.tempdir = TempDir()
+        self.map = Map(MapDirectory(str(self.tempdir)))
+        self.map.inmemory = True
+        self.map.open('w')
+        self.map.bbox = ((16.0, 58.0), (16.16, 58.16))
+
+    def testSplit(self):
+        layer = Layer(self.map, name="00_Hydro", filename="hydro", layertype=LayerTypePolygon, nlevels=2)
+        layer.splitlevel = 2
+        self.map.addLayer(layer)
+        layer.open('w')
+
+        area = CellElementArea.fromfloat(layer, [[(16.01, 58.01), (16.15, 58.01), (16.15, 58.15), (16.01, 58.15)]],
+                                         objtype=1)
+        refs = layer.addCellElement(area)
+
+        ## The area overlaps all cells at level 2
+        self.assertEqual(len(refs), 16)
+        self.assertEqual(set([cell_level(cellnum) for cellnum, nincell in refs]), set([2]))
+
+        def polygonarea(cellelement):
+            x, y = N.array(list(cellelement)[0], dtype=float).T
+            return abs(N.dot(x, N.roll(y, 1)) - N.dot(y, N.roll(x, 1))) / 2
+
+        parts = [layer.getCellElement(ref) for ref in refs]
+        self.assertEqual(sum([polygonarea(part) for part in parts]), polygonarea(area))
+        for ref, part in zip(refs, parts):
+            self.assertTrue(part.dbboxrec.iscoveredby(layer.getCell(ref[0]).dbboxrec))
+
+        ## Several cell elements can not be added at once when they may be split
+        self.assertRaises(ValueError, layer.addCellElements, [area])
+
+        ## A layer without split level keeps the element in one cell
+        layer.splitlevel = None
+        self.assertEqual(len(layer.addCellElement(area)), 1)
+        self.assertEqual(len(layer.addCellElements([area, area])), 2)
+
+    def testSplitPolyline(self):
+        layer = Layer(self.map, name="00_Trails", filename="trails", layertype=LayerTypePolyline, nlevels=3)
+        layer.splitlevel = 1
+        self.map.addLayer(layer)
+        layer.open('w')
+
+        line = CellElementPolyline.fromfloat(layer, [(16.01, 58.05), (16.15, 58.05)], objtype=1)
+        refs = layer.addCellElement(line)
+
+        self.assertEqual(len(refs), 2)
+        parts = [layer.getCellElement(ref) for ref in refs]
+        self.assertEqual(sum([part.distance for part in parts]), line.distance)
+        self.assertEqual(parts[0].coords[0], line.coords[0])
+        self.assertEqual(parts[-1].coords[-1], line.coords[-1])
+        
+class LayerTestCells(myTestCase):
+    def setUp(self):
+        self.tempdir = TempDir()
+        self.map = Map(MapDirectory(str(self.tempdir)))
+        self.map.inmemory = True
+        self.map.open('w')
+        self.map.bbox = ((16.0, 58.0), (16.16, 58.16))
+
+    def testCellsIntersecting(self):
+        layer = Layer(self.map, name="00_Trails", filename="trails", layertype=LayerTypePolyline, nlevels=3)
+        self.map.addLayer(layer)
+        layer.open('w')
+        layer.addCellElement(CellElementPolyline.fromfloat(layer, [(16.01, 58.05), (16.15, 58.05)], objtype=1))
+
+        def intersects(rec1, rec2):
+            return (rec1.c1 <= rec2.c2).all() and (rec2.c1 <= rec1.c2).all()
+
+        bbox = layer.calc_cell_extents(1)
+        recs = [bbox, Rec(bbox.c1 - 10, bbox.c1 - 1), Rec(bbox.c1, bbox.c1)]
+        random.seed(1)
+        for i in range(20):
+            x0, x1 = sorted([random.uniform(bbox.c1[0] - 100, bbox.c2[0] + 100) for j in range(2)])
+            y0, y1 = sorted([random.uniform(bbox.c1[1] - 100, bbox.c2[1] + 100) for j in range(2)])
+            recs.append(Rec((x0, y0), (x1, y1)))
+        recs += [layer.calc_cell_extents(cellnum) for cellnum in (2, 5, 6, 14, 15, 30, 55)]
+
+        for level in range(layer.nlevels+1):
+            cellnums = range(totcells_at_level(level-1)+1, totcells_at_level(level)+1)
+            for rec in recs:
+                expected = [cellnum for cellnum in cellnums if intersects(layer.calc_cell_extents(cellnum), rec)]
+                self.assertEqual(layer.calc_cells_intersecting(level, rec), expected)
+
 if __name__ == "__main__":
     unittest.main()
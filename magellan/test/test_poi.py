@@ -1,4 +1,4 @@
-from Map import Map, MapTypeImage, createMap
+from Map import Map, MapTypeNormal, createMap
 import unittest
 import tempfile
 import shutil
@@ -9,9 +9,12 @@ from Cell import Cell
 from SearchGroup import Feature, GroupNormal
 from copy import copy,deepcopy
 from Layer import Layer, LayerTypePolyline
+from CellElement import Rec
 from POI import POIGroup, FeaturePOI, POICategory, POISubCategory
 from testutil import TempDir
 from mapdir import MapDirectory
+import math
+import random
 
 def dump(x):
     return " ".join(["0x%02x "%ord(c) for c in x])
@@ -30,7 +33,7 @@ class POITest(unittest.TestCase):
         del self.testdatadir
 
     def testSimple(self):
-        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeImage)
+        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeNormal)
         map.open('r')
 
         poigroup = map.getPOIGroup()
@@ -41,7 +44,7 @@ class POITest(unittest.TestCase):
         print f,aux
 
     def testAddPOI(self):
-        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeImage)
+        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeNormal)
         map.open('a')
 
         poigroup = map.getPOIGroup()
@@ -109,7 +112,7 @@ class POITest(unittest.TestCase):
         print f,aux
 
     def testCategories(self):
-        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeImage)
+        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeNormal)
         map.open('a')
 
         poigroup = map.getPOIGroup()
@@ -123,7 +126,7 @@ class POITest(unittest.TestCase):
         poigroup.close()
 
     def testAddCategory(self):
-        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeImage)
+        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeNormal)
         map.open('a')
         poigroup = map.getPOIGroup()
         poilayer = map.getPOILayers()[0]
@@ -132,7 +135,7 @@ class POITest(unittest.TestCase):
         map.close()
         map.writeImage("test.imi")
         
-        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeImage)
+        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeNormal)
         map.open('a')
         
         poigroup = map.getPOIGroup()
@@ -185,13 +188,139 @@ class POITest(unittest.TestCase):
     def testAddCategoryAndPOI(self):
         pass
 
+class POIQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = TempDir()
+
+        map = Map(MapDirectory(str(self.tempdir)))
+        map.inmemory = True
+        map.open('w')
+        map.bbox = ((16.0, 58.0), (16.1, 58.1))
+
+        streets = Layer(map, "00_Streets", "str", layertype=LayerTypePolyline)
+        map.addLayer(streets)
+        streets.open('w')
+        streetsgroup = GroupNormal(map, name="00_Streets")
+        map.addGroup(streetsgroup)
+        streetsgroup.addLayer(streets)
+
+        map.addPOIGroupAndLayer()
+        poigroup = map.getPOIGroup()
+        poilayer = map.getPOILayers()[0]
+
+        ## Use more than one cell level so the queries descend the cell hierarchy
+        poilayer.nlevels = 2
+
+        for name in ("Fuel", "Food"):
+            cat = POICategory(name)
+            cat.addField("POI Name")
+            cat.addSubCategory(POISubCategory("NOSUB1000"))
+            poigroup.addCategory(cat)
+
+        ## Name and category id of the POIs keyed by discrete coordinates
+        self.pois = {}
+        random.seed(1)
+        for i in range(40):
+            categoryid = 1 + i % 2
+            ce = CellElementPOI.fromfloat(poilayer, (16.0 + 0.1 * random.random(), 58.0 + 0.1 * random.random()),
+                                          categoryid=categoryid, subcategoryid=1)
+            poigroup.addFeature(FeaturePOI(poilayer.addCellElement(ce), ["P%02d" % i], categoryid, 1))
+            self.pois[(ce.x, ce.y)] = ("P%02d" % i, categoryid)
+
+        map.close()
+
+        self.map = Map(MapDirectory(str(self.tempdir)))
+        self.map.open('r')
+        self.poigroup = self.map.getPOIGroup()
+        self.poigroup.open('r')
+        self.poilayer = self.map.getPOILayers()[0]
+
+    def bruteForce(self, lon, lat, categoryid=None):
+        """Return (distance, ref, name) of all POIs sorted by distance from (lon, lat)"""
+        layer = self.poilayer
+        qx, qy = layer.float2discrete([(lon, lat)])[0]
+        k = 6371000.0 * math.pi / 180
+        mx, my = layer.scale[0] * k * math.cos(math.radians(lat)), layer.scale[1] * k
+
+        result = []
+        for ce, ref in layer.getCellElementsAndRefs():
+            name, poicategoryid = self.pois[(ce.x, ce.y)]
+            if categoryid == None or poicategoryid == categoryid:
+                result.append((math.hypot((ce.x - qx) * mx, (ce.y - qy) * my), ref, name))
+        result.sort()
+        return result
+
+    def assertNearest(self, lon, lat, k, categoryid=None):
+        expected = self.bruteForce(lon, lat, categoryid)[:k]
+        nearest = self.poigroup.nearest(lon, lat, k=k, categoryid=categoryid)
+
+        self.assertEqual([(f.getCellElementRefs()[0], f.getAux()) for d, f in nearest],
+                         [(ref, (name,)) for d, ref, name in expected])
+        for (d, f), (expecteddistance, ref, name) in zip(nearest, expected):
+            self.assertAlmostEqual(d, expecteddistance, 6)
+
+    def testNearest(self):
+        self.assertTrue(self.poilayer.nlevels > 0)
+
+        for lon, lat in ((16.05, 58.05), (16.0, 58.0), (15.9, 58.2)):
+            self.assertNearest(lon, lat, 5)
+            self.assertNearest(lon, lat, 3, categoryid=2)
+        self.assertNearest(16.05, 58.05, 50)
+
+        ## The text of the first POI is in the first slot of the aux table
+        [(ce, ref)] = [(ce, ref) for ce, ref in self.poilayer.getCellElementsAndRefs() if ce.textslot == 0]
+        lon, lat = self.poilayer.discrete2float([(ce.x, ce.y)])[0]
+        [(d, f)] = self.poigroup.nearest(lon, lat, k=1)
+        self.assertEqual(f.getCellElementRefs()[0], ref)
+        self.assertEqual(f.getAux(), (self.pois[(ce.x, ce.y)][0],))
+
+        self.poigroup.buildPointIndex()
+        for qlon, qlat in ((16.05, 58.05), (16.0, 58.0), (15.9, 58.2), (16.02, 58.09)):
+            self.assertNearest(qlon, qlat, 5)
+            self.assertNearest(qlon, qlat, 3, categoryid=2)
+        self.assertNearest(16.05, 58.05, 50)
+        [(d, f)] = self.poigroup.nearest(lon, lat, k=1)
+        self.assertEqual(f.getAux(), (self.pois[(ce.x, ce.y)][0],))
+
+    def testWithin(self):
+        bboxrec = Rec((16.02, 58.03), (16.07, 58.09))
+        (minx, miny), (maxx, maxy) = self.poilayer.float2discrete([bboxrec.c1, bboxrec.c2])
+
+        expected = Set([(ref, self.pois[(ce.x, ce.y)][0]) 
+                        for ce, ref in self.poilayer.getCellElementsAndRefs()
+                        if minx <= ce.x <= maxx and miny <= ce.y <= maxy])
+        self.assertTrue(len(expected) > 0)
+
+        found = Set([(f.getCellElementRefs()[0], f.getAux()[0]) for f in self.poigroup.within(bboxrec)])
+        self.assertEqual(found, expected)
+
+        ## The POI in the first aux slot
+        [ce] = [ce for ce in self.poilayer.getCellElements() if ce.textslot == 0]
+        lon, lat = self.poilayer.discrete2float([(ce.x, ce.y)])[0]
+        [f] = self.poigroup.within(Rec((lon - 1e-4, lat - 1e-4), (lon + 1e-4, lat + 1e-4)))
+        self.assertEqual(f.getAux(), (self.pois[(ce.x, ce.y)][0],))
+
+        categories = dict(self.pois.values())
+        for categoryid in (1, 2):
+            found = Set([(f.getCellElementRefs()[0], f.getAux()[0]) 
+                         for f in self.poigroup.within(bboxrec, categoryid=categoryid)])
+            self.assertEqual(found, Set([(ref, name) for ref, name in expected if categories[name] == categoryid]))
+
+        self.poigroup.buildPointIndex()
+        found = Set([(f.getCellElementRefs()[0], f.getAux()[0]) for f in self.poigroup.within(bboxrec)])
+        self.assertEqual(found, expected)
+        for categoryid in (1, 2):
+            found = Set([(f.getCellElementRefs()[0], f.getAux()[0]) 
+                         for f in self.poigroup.within(bboxrec, categoryid=categoryid)])
+            self.assertEqual(found, Set([(ref, name) for ref, name in expected if categories[name] == categoryid]))
+
 class POICreate(unittest.TestCase):
     def setUp(self):
         self.tempdir = TempDir("./layerdata1", keep=True)
         self.testdatadir = str(self.tempdir)
 
     def testSimple(self):
-        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeImage)
+        map = Map(MapDirectory(self.testdatadir), maptype=MapTypeNormal)
         map.open('a')
 
         map.addPOIGroupAndLayer()
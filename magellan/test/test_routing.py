@@ -0,0 +1,210 @@
+import unittest
+import numpy as N
+from testutil import TempDir
+
+from routinggraph import RoutingGraph, FlagBidirectional, FlagReverse
+from Map import Map, MapTypeStreetRoute
+from mapdir import MapDirectory
+from Layer import Layer, LayerTypePolyline
+from SearchGroup import FeatureNormal
+from CellElement import CellElementPolyline, Rec
+from routing import RoutingConfig
+
+def squaregraph():
+    """Graph with four nodes in a square where the edges via node 2 are one-way"""
+    lonlat = N.array([[16.0, 58.0], [16.001, 58.0], [16.0, 58.001], [16.001, 58.001]])
+    edgenodes = N.array([[0, 1], [1, 3], [0, 2], [3, 2]])
+    return RoutingGraph(nodecoords = N.round(lonlat / 1e-5).astype(N.int64),
+                        nodelonlat = lonlat,
+                        edgenodes = edgenodes,
+                        edgecosts = N.array([70, 120, 120, 60]),
+                        edgeflags = N.array([FlagBidirectional, FlagBidirectional, 0, FlagReverse], dtype=N.uint8),
+                        edgesets = N.array([0, 0, 1, 1], dtype=N.int8),
+                        edgerefs = N.zeros((4, 3), dtype=N.int64),
+                        sourcerefs = N.zeros((4, 3), dtype=N.int64))
+
+def addstreet(m, layer, name, coords):
+    roads = m.getGroupByName('00_Roads')
+    cellelement = CellElementPolyline.fromfloat(layer, coords,
+                                                objtype=roads.getObjtypeIndex(m.getLayerIndex(layer), 1))
+    roads.addFeature(FeatureNormal(m.getLayerIndex(layer), layer.addCellElement(cellelement), name, 1))
+
+def routingedges(m, recalculate=False):
+    """Return the routing edges of a map as sorted tuples. If recalculate is True the
+    edges are calculated from the routing layers instead of read from the map"""
+    routingcfg = m.routingcfg
+    for layer in routingcfg.routinglayers + routingcfg.routingedgelayers:
+        if layer.mode == None:
+            layer.open('r')
+
+    if recalculate:
+        polylines = routingcfg._gather_routing_polylines(m)
+        edgelayers = [routingcfg._create_routing_edges(polylines, edges)
+                      for edges in routingcfg._routing_edges(polylines)]
+    else:
+        edgelayers = [list(layer.getCellElements()) for layer in routingcfg.routingedgelayers]
+
+    return sorted([(irset, tuple(map(tuple, edge.coords)), edge.layernumref, edge.cellnumref,
+                    edge.numincellref, tuple(edge.ivertices), tuple(edge.edgeindices), edge.cost)
+                   for irset, edges in enumerate(edgelayers) for edge in edges])
+
+class RoutingGraphTest(unittest.TestCase):
+    def testAdjacency(self):
+        graph = squaregraph()
+
+        self.assertEqual(list(graph.offsets), [0, 2, 4, 5, 6])
+        self.assertEqual(list(graph.roffsets), [0, 1, 3, 4, 6])
+
+    def testRoute(self):
+        graph = squaregraph()
+
+        route = graph.route((16.0, 58.0), (16.001, 58.001))
+        self.assertEqual(route.cost, 180)
+        self.assertEqual(route.nodes, [0, 2, 3])
+        self.assertEqual(route.edges, [2, 3])
+
+        ## The one-way edges cannot be used in the other direction
+        route = graph.route((16.001, 58.001), (16.0, 58.0))
+        self.assertEqual(route.cost, 190)
+        self.assertEqual(route.nodes, [3, 1, 0])
+        self.assertEqual(route.edges, [1, 0])
+
+    def testUnreachable(self):
+        graph = squaregraph()
+        graph.edgeflags[:] = 0
+        graph._buildAdjacency()
+
+        self.assertEqual(graph.route((16.001, 58.001), (16.0, 58.0)), None)
+
+    def testComponents(self):
+        graph = squaregraph()
+
+        components = graph.components()
+        self.assertEqual(len(components), 1)
+        self.assertEqual(list(components[0].nodes), [0, 1, 2, 3])
+        self.assertEqual(components[0].routingsets, [0, 1])
+        self.assertEqual(components[0].cost, 370)
+
+        ## Remove the edges between the two routing sets
+        graph.edgenodes = N.array([[0, 1], [0, 1], [2, 3], [3, 2]])
+        components = graph.components()
+        self.assertEqual([list(component.edges) for component in components], [[0, 1], [2, 3]])
+        self.assertEqual([component.routingsets for component in components], [[0], [1]])
+        self.assertEqual(components[1].bboxrec, Rec((16.0, 58.001), (16.001, 58.001)))
+
+        components = graph.components([1])
+        self.assertEqual(len(components), 1)
+        self.assertEqual(list(components[0].nodes), [2, 3])
+
+    def testSaveLoad(self):
+        graph = squaregraph()
+        tempdir = TempDir()
+
+        graph.save(str(tempdir))
+        loaded = RoutingGraph.load(str(tempdir))
+
+        self.assertEqual(loaded.nroutingsets, graph.nroutingsets)
+        for name in RoutingGraph.snapshotarrays:
+            self.assertTrue(N.all(getattr(loaded, name) == getattr(graph, name)), name)
+
+        route = loaded.route((16.0, 58.0), (16.001, 58.001))
+        self.assertEqual(route.edges, [2, 3])
+
+class RoutingNetworkTest(unittest.TestCase):
+    def testUpdate(self):
+        tempdir = TempDir()
+
+        m = Map(MapDirectory(str(tempdir)), maptype=MapTypeStreetRoute)
+        m.inmemory = True
+        m.open('w')
+        m.addPOIGroupAndLayer()
+        roads = m.getGroupByName('00_Roads')
+        layers = []
+        for irset, name in enumerate(['Roads', 'Streets']):
+            layer = Layer(m, '00_' + name, name[:3].lower(), layertype=LayerTypePolyline)
+            m.addLayer(layer)
+            roads.addLayer(layer)
+            layer.open('w')
+            m.addRoutingLayer(layer, irset)
+            layers.append(layer)
+
+        for i in range(4):
+            addstreet(m, layers[0], 'Vag%d' % i, [(16.0 + 0.01 * i, 58.0), (16.0 + 0.01 * i, 58.03)])
+            addstreet(m, layers[1], 'Gata%d' % i, [(16.0, 58.0 + 0.01 * i), (16.03, 58.0 + 0.01 * i)])
+        m.close()
+
+        m = Map(MapDirectory(str(tempdir)))
+        m.open('r')
+        nedges = len(routingedges(m))
+        m.close()
+
+        ## Add a street from the start of a street to the start of a road
+        m = Map(MapDirectory(str(tempdir)))
+        m.open('a')
+        m.getGroupByName('00_Roads').open('a')
+        streets = m.getLayerAndGroupByName('00_Streets')[0]
+        streets.open('a')
+        addstreet(m, streets, 'Nygatan', [(16.0, 58.01), (16.005, 58.005), (16.01, 58.0)])
+        m.close()
+
+        m = Map(MapDirectory(str(tempdir)))
+        m.open('r')
+        edges = routingedges(m)
+
+        ## The new street ends at a node of the roads so it is added to all routing edge layers
+        self.assertEqual(len(edges), nedges + 3)
+        self.assertEqual(edges, routingedges(m, recalculate=True))
+
+    def testUpdateLocal(self):
+        tempdir = TempDir()
+
+        m = Map(MapDirectory(str(tempdir)), maptype=MapTypeStreetRoute)
+        m.inmemory = True
+        m.open('w')
+        m.bbox = ((16.0, 58.0), (16.16, 58.16))
+        m.addPOIGroupAndLayer()
+        roads = m.getGroupByName('00_Roads')
+        layers = []
+        for irset, name in enumerate(['Roads', 'Streets']):
+            layer = Layer(m, '00_' + name, name[:3].lower(), layertype=LayerTypePolyline, nlevels=3)
+            m.addLayer(layer)
+            roads.addLayer(layer)
+            layer.open('w')
+            m.addRoutingLayer(layer, irset)
+            layers.append(layer)
+
+        ## Grid of roads in the north-south direction and streets in the east-west direction
+        ## between the grid points
+        for i in range(8):
+            for j in range(7):
+                addstreet(m, layers[0], 'Vag%d' % i, [(16.01 + 0.02 * i, 58.01 + 0.02 * j), 
+                                                      (16.01 + 0.02 * i, 58.03 + 0.02 * j)])
+                addstreet(m, layers[1], 'Gata%d' % i, [(16.01 + 0.02 * j, 58.01 + 0.02 * i),
+                                                       (16.03 + 0.02 * j, 58.01 + 0.02 * i)])
+        m.close()
+
+        ## Add a street between two grid points and count the polylines that are read
+        m = Map(MapDirectory(str(tempdir)))
+        m.open('a')
+        m.getGroupByName('00_Roads').open('a')
+        streets = m.getLayerAndGroupByName('00_Streets')[0]
+        streets.open('a')
+        addstreet(m, streets, 'Nygatan', [(16.01, 58.03), (16.02, 58.02), (16.03, 58.01)])
+
+        routingcfg = m.routingcfg
+        gathered = []
+        def gather(mapobj, cells=None):
+            polylines = RoutingConfig._gather_routing_polylines(routingcfg, mapobj, cells)
+            gathered.append(len(polylines.nvertices))
+            return polylines
+        routingcfg._gather_routing_polylines = gather
+        m.close()
+
+        self.assertTrue(0 < max(gathered) < 2 * 8 * 7 / 2)
+
+        m = Map(MapDirectory(str(tempdir)))
+        m.open('r')
+        self.assertEqual(routingedges(m), routingedges(m, recalculate=True))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,13 @@
+import math
+import collections
+import multiprocessing
 import numpy as N
 from numpy import asarray
 import shapely.wkt as wkt
 from shapely import geometry as geo
-from shapely.ops import polygonize
+from shapely.geometry.polygon import orient
+from shapely.ops import polygonize, unary_union
+from shapely.strtree import STRtree
 from magellan.CellElement import Rec
 
 class CoastLine(object):
@@ -23,7 +28,12 @@ class CoastLine(object):
         """Add coastline segment"""
         self.coastlinesegments.append(segment)
 
-    def polygons(self, bbox = None, assumewater = False):
+    def polygons(self, bbox = None, assumewater = False, tilesize = None, processes = 1):
+        """Return the water polygons as sequences of an exterior and interior rings
+
+        If tilesize is given the polygons are created per tile of a grid with the given
+        tile size by tiledcoastline2polygons using the given number of processes.
+        """
         coastline = geo.MultiLineString(self.coastlinesegments)
 
         if bbox == None:
@@ -31,7 +41,13 @@ class CoastLine(object):
         else:
             bboxpolygon = wkt.loads(Rec(*bbox).wkt)
 
-        hydropolygons = coastline2polygon(bboxpolygon, coastline.geoms, assumewater = assumewater)
+        if tilesize:
+            hydropolygons = tiledcoastline2polygons(bboxpolygon, coastline.geoms, tilesize,
+                                                    assumewater = assumewater,
+                                                    processes = processes)
+        else:
+            hydropolygons = coastline2polygon(bboxpolygon, coastline.geoms, 
+                                              assumewater = assumewater)
 
         for p in hydropolygons:
             exterior = tuple(p.exterior.coords)
@@ -143,6 +159,157 @@ def coastline2polygon(bbox, linestrings, assumewater = False):
         
     return result
 
+def tiledcoastline2polygons(bbox, linestrings, tilesize, assumewater = False, processes = 1):
+    """Return water polygons from a bounding box and coastline segments which always have
+    land on the left side. The polygons are created per tile of a grid with the given
+    tile size that is aligned to multiples of the tile size.
+
+    Each tile is handled by tilewaterpolygons. The tiles without coastline get the same
+    status as their neighbours. The tiles are handled by the given number of processes.
+
+    >>> bbox = geo.box(0, 0, 1, 1)
+    >>> coastlines_downup = [geo.LineString(((0.3,-1), (0.4,0.5))), geo.LineString(((0.4,0.5), (0.4,2))) ]
+    >>> polygons = tiledcoastline2polygons(bbox, coastlines_downup, 0.5)
+    >>> len(polygons), round(sum([p.area for p in polygons]), 6)
+    (4, 0.608333)
+    >>> island = geo.LineString(((0.4, 0.1), (0.5,0.1), (0.5,0.2), (0.4,0.2), (0.4,0.1)))
+    >>> polygons = tiledcoastline2polygons(bbox, [island], 0.25)
+    >>> len(polygons), round(sum([p.area for p in polygons]), 6)
+    (16, 0.99)
+    >>> tiledcoastline2polygons(bbox, [], 0.5, assumewater = True)[0].bounds
+    (0.0, 0.0, 0.5, 0.5)
+
+    """
+    minx, miny, maxx, maxy = bbox.bounds
+
+    ## Grid aligned to multiples of the tile size
+    columns = range(int(math.floor(minx / tilesize)), int(math.ceil(maxx / tilesize)))
+    rows = range(int(math.floor(miny / tilesize)), int(math.ceil(maxy / tilesize)))
+
+    tilebounds = {}
+    for i in columns:
+        for j in rows:
+            tilebounds[(i, j)] = (max(minx, i * tilesize), max(miny, j * tilesize),
+                                  min(maxx, (i + 1) * tilesize), min(maxy, (j + 1) * tilesize))
+
+    ## Find the coastline segments of each tile
+    linestrings = [linestring for linestring in linestrings if not linestring.is_empty]
+    tasks = []
+    if len(linestrings) > 0:
+        tree = STRtree(linestrings)
+        for tile in sorted(tilebounds):
+            tilepolygon = geo.box(*tilebounds[tile])
+            lines = [line for line in tree.query(tilepolygon) if line.intersects(tilepolygon)]
+            if len(lines) > 0:
+                tasks.append((tilebounds[tile], lines))
+
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_tilewaterpolygons, tasks)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = map(_tilewaterpolygons, tasks)
+
+    tilewater = dict([(bounds, water) for (bounds, lines), water in zip(tasks, results)
+                      if water != None])
+
+    ## The status of the tiles without coastline is copied from a neighbour
+    queue = collections.deque([tile for tile in sorted(tilebounds) 
+                               if tilebounds[tile] in tilewater])
+    while queue:
+        i, j = queue.popleft()
+        water = tilewater[tilebounds[(i, j)]]
+        for neighbour in ((i - 1, j), (i + 1, j), (i, j - 1), (i, j + 1)):
+            if neighbour not in tilebounds or tilebounds[neighbour] in tilewater:
+                continue
+
+            edge = geo.box(*tilebounds[(i, j)]).intersection(geo.box(*tilebounds[neighbour]))
+            waterlength = sum([polygon.intersection(edge).length for polygon in water])
+            if waterlength > edge.length / 2:
+                tilewater[tilebounds[neighbour]] = [geo.box(*tilebounds[neighbour])]
+            else:
+                tilewater[tilebounds[neighbour]] = []
+            queue.append(neighbour)
+
+    result = []
+    for tile in sorted(tilebounds):
+        if tilebounds[tile] in tilewater:
+            result.extend(tilewater[tilebounds[tile]])
+        elif assumewater:
+            result.append(geo.box(*tilebounds[tile]))
+    return result
+
+def tilewaterpolygons(tilebounds, linestrings):
+    """Return the water polygons of a tile from the coastline segments that intersect it
+
+    The segments are clipped to the tile and noded together with the tile boundary. A
+    polygon of the result of polygonize is water if its boundary follows a coastline
+    segment in the opposite direction since there is land on the left side of the
+    coastline. None is returned if no coastline segment is inside the tile.
+
+    >>> ocean = geo.LineString(((0.4, 0.1), (0.4,0.2), (0.5,0.2), (0.5,0.1), (0.4,0.1)))
+    >>> [round(p.area, 6) for p in tilewaterpolygons((0, 0, 1, 1), [ocean])]
+    [0.01]
+
+    """
+    tilepolygon = geo.box(*tilebounds)
+
+    lines = []
+    for linestring in linestrings:
+        lines.extend([line for line in getattr(linestring.intersection(tilepolygon), 'geoms', 
+                                                 [linestring.intersection(tilepolygon)])
+                      if line.geom_type == 'LineString' and not line.is_empty])
+    if len(lines) == 0:
+        return None
+
+    ## Coastline segments as start and end point arrays
+    coords = [N.asarray(linestring.coords) for linestring in linestrings]
+    starts = N.concatenate([c[:-1] for c in coords])
+    ends = N.concatenate([c[1:] for c in coords])
+
+    result = []
+    for polygon in polygonize(unary_union([tilepolygon.exterior] + lines)):
+        water = iswater(orient(polygon), tilebounds, starts, ends)
+        if water == None:
+            ## The coastline segments only follow the tile boundary
+            return None
+        elif water:
+            result.append(polygon)
+    return result
+
+def iswater(polygon, tilebounds, starts, ends):
+    """Return True if a counter-clockwise oriented polygon is on the right side of the
+    coastline segment that its first edge that is not on the tile boundary lies on
+
+    None is returned if all edges of the polygon are on the tile boundary
+    """
+    minx, miny, maxx, maxy = tilebounds
+    eps = 1e-9 * max(1.0, maxx - minx, maxy - miny)
+
+    for ring in [polygon.exterior] + list(polygon.interiors):
+        coords = N.asarray(ring.coords)
+        midpoints = (coords[:-1] + coords[1:]) / 2
+        onboundary = (abs(midpoints[:, 0] - minx) < eps) | (abs(midpoints[:, 0] - maxx) < eps) | \
+                     (abs(midpoints[:, 1] - miny) < eps) | (abs(midpoints[:, 1] - maxy) < eps)
+
+        for i in N.flatnonzero(~onboundary)[:1]:
+            ## Find the coastline segment that is closest to the middle of the edge
+            delta = ends - starts
+            length2 = N.maximum((delta ** 2).sum(axis=1), 1e-300)
+            t = N.clip(((midpoints[i] - starts) * delta).sum(axis=1) / length2, 0, 1)
+            distance2 = ((starts + t[:, N.newaxis] * delta - midpoints[i]) ** 2).sum(axis=1)
+            segment = N.argmin(distance2)
+
+            ## The polygon is on the left side of its edges
+            return N.dot(coords[i + 1] - coords[i], delta[segment]) < 0
+    return None
+
+def _tilewaterpolygons(task):
+    return tilewaterpolygons(*task)
+
 def showpoly(p):
     import pylab
     a = asarray(p.exterior)
@@ -0,0 +1,229 @@
+"""
+The nodestore module provides a compact store of OSM node coordinates
+
+The node ids are kept in a sorted int64 array and the coordinates as int32 fixed point
+values in the discrete coordinate system of the map. The nodes are buffered while they
+are added and written to memory or to files that are memory mapped when the
+nodes are looked up.
+"""
+import os
+from array import array
+import numpy as N
+
+class NodeStore(object):
+    """Store of node coordinates keyed by node id
+
+    If filename is given the nodes are stored in the files filename.ids and
+    filename.coords instead of in memory.
+
+    >>> store = NodeStore(scale = (1e-5, 1e-5), refpoint = (0.0, 0.0))
+    >>> store[17] = (16.123456, 58.5)
+    >>> store[3] = (-16.1, -58.0)
+    >>> len(store), 3 in store, 4 in store
+    (2, True, False)
+    >>> ['%.5f' % c for c in store[17]]
+    ['16.12346', '58.50000']
+    >>> coords, found = store.lookup([3, 4, 17])
+    >>> found
+    array([ True, False,  True], dtype=bool)
+    >>> coords[found].round(5)
+    array([[-16.1    , -58.     ],
+           [ 16.12346,  58.5    ]])
+
+    """
+    chunksize = 1 << 20
+
+    def __init__(self, scale, refpoint = (0.0, 0.0), filename = None):
+        self.scale = N.array(scale, dtype=float)
+        self.refpoint = N.array(refpoint, dtype=float)
+        self.filename = filename
+
+        ## Buffers of added nodes
+        self._bufids = array('l')
+        self._bufcoords = array('d')
+
+        ## Sorted nodes
+        self._ids = N.zeros(0, dtype=N.int64)
+        self._coords = N.zeros((0, 2), dtype=N.int32)
+
+        ## Sorted ids of the nodes to store or None to store all nodes
+        self._restriction = None
+
+        ## Chunks of nodes that are not yet merged with the sorted nodes
+        self._idchunks = []
+        self._coordchunks = []
+        self._nchunks = 0
+
+        if filename:
+            self._idfile = open(filename + '.ids', 'wb')
+            self._coordfile = open(filename + '.coords', 'wb')
+
+    def __setitem__(self, id, coord):
+        self._bufids.append(id)
+        self._bufcoords.extend(coord)
+        if len(self._bufids) >= self.chunksize:
+            self._flush()
+
+    def extend(self, ids, coords):
+        """Add nodes given as an array of ids and an (n, 2) array of float coordinates"""
+        self._flush()
+        self._addchunk(N.asarray(ids, dtype=N.int64), N.asarray(coords, dtype=float))
+
+    def _flush(self):
+        """Move the buffered nodes to a chunk"""
+        if len(self._bufids) == 0:
+            return
+
+        ids = N.frombuffer(self._bufids, dtype='l').astype(N.int64)
+        coords = N.frombuffer(self._bufcoords, dtype=float).reshape(-1, 2)
+
+        self._bufids = array('l')
+        self._bufcoords = array('d')
+
+        self._addchunk(ids, coords)
+
+    def _addchunk(self, ids, coords):
+        if self._restriction is not None:
+            keep = contains(self._restriction, ids)
+            ids, coords = ids[keep], coords[keep]
+
+        ## The coordinates are rounded in the same way as in Layer.float2discrete
+        coords = ((coords - self.refpoint) / self.scale).round().astype(N.int32)
+        if self.filename:
+            self._idfile.write(ids.tostring())
+            self._coordfile.write(coords.tostring())
+        else:
+            self._idchunks.append(ids)
+            self._coordchunks.append(coords)
+        self._nchunks += 1
+
+    def restrict(self, ids):
+        """Only store the nodes with the given ids from now on
+
+        >>> store = NodeStore(scale = (1e-5, 1e-5))
+        >>> store.restrict([7, 3])
+        >>> store[3] = (16.0, 58.0)
+        >>> store[5] = (16.1, 58.1)
+        >>> len(store), 3 in store, 5 in store
+        (1, True, False)
+
+        """
+        self._flush()
+        self._restriction = N.unique(N.asarray(ids, dtype=N.int64))
+
+    def _update(self):
+        """Merge the added nodes with the sorted nodes"""
+        self._flush()
+        if self._nchunks == 0:
+            return
+
+        if self.filename:
+            self._idfile.flush()
+            self._coordfile.flush()
+            ids = N.memmap(self.filename + '.ids', dtype=N.int64, mode='r')
+            coords = N.memmap(self.filename + '.coords', dtype=N.int32, mode='r').reshape(-1, 2)
+        else:
+            ids = N.concatenate([self._ids] + self._idchunks)
+            coords = N.concatenate([self._coords] + self._coordchunks)
+            self._idchunks = []
+            self._coordchunks = []
+        self._nchunks = 0
+
+        ## The nodes are usually sorted by id in OSM files so they are only sorted if needed
+        if len(ids) > 1 and (ids[1:] < ids[:-1]).any():
+            order = N.argsort(ids, kind='mergesort')
+            ids = ids[order]
+            coords = coords[order]
+
+            ## Write the sorted nodes back to the files so they can be memory mapped
+            if self.filename:
+                self._idfile.close()
+                self._coordfile.close()
+                ids.tofile(self.filename + '.ids')
+                coords.tofile(self.filename + '.coords')
+                self._idfile = open(self.filename + '.ids', 'ab')
+                self._coordfile = open(self.filename + '.coords', 'ab')
+                ids = N.memmap(self.filename + '.ids', dtype=N.int64, mode='r')
+                coords = N.memmap(self.filename + '.coords', dtype=N.int32, mode='r').reshape(-1, 2)
+
+        self._ids = ids
+        self._coords = coords
+
+    def finalize(self):
+        """Merge and sort the added nodes so later lookups don't have to. Call it before
+        the store is shared with forked worker processes, otherwise each worker sorts
+        its own copy
+
+        >>> store = NodeStore(scale = (1e-5, 1e-5))
+        >>> store.extend([9, 2], [(16.0, 58.0), (16.1, 58.1)])
+        >>> store.finalize()
+        >>> store._ids
+        array([2, 9])
+
+        """
+        self._update()
+
+    def __len__(self):
+        self._update()
+        return len(self._ids)
+
+    def __contains__(self, id):
+        return self.lookup([id])[1][0]
+
+    def __getitem__(self, id):
+        coords, found = self.lookup([id])
+        if not found[0]:
+            raise KeyError(id)
+        return tuple(coords[0].tolist())
+
+    def lookup(self, ids):
+        """Look up the coordinates of a sequence of node ids
+
+        Returns the float coordinates as an (n, 2) array and a boolean array that is
+        False for ids that are not found
+        """
+        if len(self._bufids) > 0 or self._nchunks > 0:
+            self._update()
+
+        ids = N.asarray(ids, dtype=N.int64)
+        if len(self._ids) > 0:
+            index = N.minimum(N.searchsorted(self._ids, ids), len(self._ids) - 1)
+            found = self._ids[index] == ids
+            coords = self._coords[index] * self.scale + self.refpoint
+        else:
+            found = N.zeros(len(ids), dtype=bool)
+            coords = N.zeros((len(ids), 2))
+        return coords, found
+
+    def close(self):
+        """Release the nodes and remove the node files"""
+        self._bufids = array('l')
+        self._bufcoords = array('d')
+        self._idchunks = []
+        self._coordchunks = []
+        self._nchunks = 0
+        self._ids = N.zeros(0, dtype=N.int64)
+        self._coords = N.zeros((0, 2), dtype=N.int32)
+
+        if self.filename:
+            self._idfile.close()
+            self._coordfile.close()
+            for filename in (self.filename + '.ids', self.filename + '.coords'):
+                if os.path.exists(filename):
+                    os.unlink(filename)
+
+def contains(sortedids, ids):
+    """Return a boolean array that is True for the ids that are in the sorted array sortedids
+
+    >>> contains(N.array([2, 5, 9]), N.array([9, 1, 5, 10]))
+    array([ True, False,  True, False], dtype=bool)
+
+    """
+    if len(sortedids) == 0:
+        return N.zeros(len(ids), dtype=bool)
+    index = N.minimum(N.searchsorted(sortedids, ids), len(sortedids) - 1)
+    return sortedids[index] == ids
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
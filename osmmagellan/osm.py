@@ -3,19 +3,29 @@ The osm rule module provides functionality to convert OpenStreetMap XML-file
 to a Magellan GPS image file
 """
 import os
+import math
 import urllib
 import tempfile
-import xml
-from xml.sax import make_parser, handler
+import threading
+from array import array
+import Queue
+import gzip
+import bz2
+from xml.parsers import expat
+
+import numpy as N
 
 import char
 import coastline
+from nodestore import NodeStore, contains
 import magellan.Layer as Layer
+from magellan.routing import coordkeys
+from magellan.misc import earthradius
 from magellan.CellElement import CellElementPolyline, CellElementArea, \
-    CellElementPoint, CellElementPOI, RoutingAttributes, GeometryError
+    CellElementPoint, CellElementPOI, RoutingAttributes, GeometryError, \
+    vlistinterpolate
 from magellan.POI import FeaturePOI
 from magellan.SearchGroup import FeatureNormal
-import struct
 import logging
 
 try:
@@ -36,6 +46,9 @@ class MapBuilder(object):
         self.charmap = char.UnicodeTranslator()
         self.coastline = None
 
+        ## Compiled actions of the statements of the rules
+        self.actions = {}
+
         ## Set copyright field
         self.map.copyrightholders = \
             ('The map can be used freely under the terms of the Creative Commons '
@@ -45,214 +58,427 @@ class MapBuilder(object):
         raise Exception('Not implemented')
 
     def add_element(self, statement, tags, coords):
+      element = self.encode_element(statement, tags, coords)
+      if element != None:
+        self.place_element(statement, *element)
+
+    def action(self, statement):
+      """Return the compiled action of a statement"""
+      try:
+        return self.actions[statement]
+      except KeyError:
+        action = self.actions[statement] = StatementAction(self, statement)
+        return action
+
+    def encode_element(self, statement, tags, coords):
+      """Convert an OSM element that matches a statement to the coordinates, name and
+      attributes of the map element. The conversion only reads from the map so it can
+      be done in a worker process.
+
+      Returns None if no map element should be created
+      """
+      action = self.action(statement)
       cm = self.charmap
-      if statement.tag in ('polygon', 'polyline', 'point'):
-        layer, group = self.map.getLayerAndGroupByName(\
-            self.map.mapnumstr + '_' + statement.get('layer') )
+      attributes = None
+      name = None
 
-        objtype = statement.get('objtype') or 1
+      if action.tag == 'polyline':
+        if len(coords) < 2:
+          return
 
-        if statement.tag == 'polyline':
-          assert(layer.layertype == Layer.LayerTypePolyline)
-          if len(coords) < 2:
-            return
+        if self.routable:
+          ## Routing attributes as (name, value) pairs in the order they are set
+          attributes = list(action.routingattributes)
 
-          unk = None
-          if self.routable:
-              unk = 0
-          cellelement = CellElementPolyline.fromfloat(layer, coords, \
-                objtype=group.getObjtypeIndex(self.map.getLayerIndex(layer), objtype), unk=None)
+          if 'junction' in tags and tags['junction'] == 'roundabout':
+            attributes.append(('roundabout', True))
+            attributes.append(('bidirectional', False))
 
-          if self.routable:
-              routingelements = statement.findall("routing")
+          if 'oneway' in tags and tags['oneway'] == 'yes':
+            attributes.append(('bidirectional', False))
+
+        ## The vertices needed by the delta encoder are inserted here instead of in
+        ## the main process when the elements are encoded by worker processes
+        coords = N.array(vlistinterpolate(action.layer.float2discrete(coords))).astype(int)
+        name = action.findname(tags)
+
+      elif action.tag == 'polygon':
+        coords = action.layer.float2discrete(coords)
+        name = action.findname(tags)
+
+      elif action.tag in ('point', 'poi'):
+        coords = action.layer.float2discrete(coords[:1])
+        name = action.findname(tags)
 
+        if action.tag == 'poi' and hasname(name):
+          attributes = []
+          for k, text in action.poiattributes:
+            if k in tags:
+              attributes.append(cm.translate(tags[k]))
+            elif text:
+              attributes.append(cm.translate(text))
+            else:
+              attributes.append('')
+
+      elif action.tag == 'coastline':
+        if len(coords) < 2:
+          return
+
+      else:
+        return
+
+      if hasname(name):
+        name = cm.translate(name)
+      else:
+        name = None
+
+      return coords, name, attributes
+
+    def place_element(self, statement, coords, name, attributes):
+      """Add a map element from the result of encode_element to its layer and group"""
+      action = self.action(statement)
+      layer = action.layer
+
+      if action.tag in ('polygon', 'polyline', 'point'):
+        objtypeindex = action.group.getObjtypeIndex(action.layerindex, action.objtype)
+
+        if action.tag == 'polyline':
+          cellelement = CellElementPolyline(coords, objtype=objtypeindex, unk=None)
+
+          if self.routable:
               ra = RoutingAttributes()
               ra.segmentflags = 0
               ra.speedcat = 0
+              for key, value in attributes:
+                  setattr(ra, key, value)
               cellelement.routingattributes = ra
 
-              for routing in statement.findall("routing"):
-                  for key, value in routing.items():
-                      if key == 'oneway':
-                          ra.bidirectional = value != 'on'
-                      elif key == 'freeway':
-                          ra.freeway = (value == 'on')
-                      elif key == 'speedcat':
-                          ra.speedcat = int(value)
-                      elif key == 'segmenttype':
-                          ra.segmenttype = int(value)
-
-              if 'junction' in tags and self.tags['junction'] == 'roundabout':
-                  ra.roundabout = True
-                  ra.bidirectional = False
-
-              if 'oneway' in tags and tags['oneway'] == 'yes':
-                  ra.bidirectional = False
-
-        elif statement.tag == 'polygon':
+        elif action.tag == 'polygon':
             try:
-                objtype = group.getObjtypeIndex(self.map.getLayerIndex(layer), objtype)
-                cellelement = CellElementArea.fromfloat(layer, (coords,), 
-                                                        objtype=objtype)
+                cellelement = CellElementArea((coords,), objtype=objtypeindex)
             except GeometryError:
-                logging.warning('Improper polygon found: ' + str(coords))
+                logging.warning('Improper polygon found: ' + \
+                                    str(layer.discrete2float(coords).tolist()))
                 return
 
-        elif statement.tag == 'point':
-          assert(layer.layertype == Layer.LayerTypePoint)
-          cellelement = CellElementPoint.fromfloat(layer, coords[0],
-                         objtype = group.getObjtypeIndex(self.map.getLayerIndex(layer), objtype))
+        elif action.tag == 'point':
+          cellelement = CellElementPoint(coords[0], objtype=objtypeindex)
         cellelementrefs = layer.addCellElement(cellelement)
 
-        name = self._findname(statement, tags)
-
-        if hasname(name):
-            feature = FeatureNormal(name=cm.translate(name), 
-                                    layerindex=self.map.getLayerIndex(layer),
-                                    objtype=objtype,
+        if name != None:
+            feature = FeatureNormal(name=name, 
+                                    layerindex=action.layerindex,
+                                    objtype=action.objtype,
                                     cellelementreflist=cellelementrefs)
-            group.addFeature(feature)
-
-      elif statement.tag == 'poi':
-        poigroup = self.map.getPOIGroup()
-        poilayer = self.map.getPOILayers()[0]
-
-        category = statement.get('category')
-        subcategory = statement.get('subcategory') or 'NOSUB1000'
-
-        cat = poigroup.catman.getCategoryByName(category)
-        subcat = cat.getSubCategoryByName(subcategory)
-
-        poice = CellElementPOI.fromfloat(poilayer, coords[0], categoryid=cat.id, subcategoryid=subcat.id)
-
-        name = self._findname(statement, tags)
-
-        if hasname(name):
-          attributes = []
-          for a in statement.findall('attr'):
-            if a.get('k') in tags:
-              attributes.append(cm.translate(tags[a.get('k')]))
-            elif a.text:
-              attributes.append(cm.translate(a.text.encode))
-            else:
-              attributes.append('')
+            action.group.addFeature(feature)
 
-          feature = FeaturePOI(poilayer.addCellElement(poice), [cm.translate(name)] + attributes, cat.id, subcat.id)
-          poigroup.addFeature(feature)
-      elif statement.tag == 'coastline':
-          if len(coords) < 2:
-              return
+      elif action.tag == 'poi':
+        poice = CellElementPOI(coords[0], categoryid=action.categoryid, 
+                               subcategoryid=action.subcategoryid)
 
+        if name != None:
+          feature = FeaturePOI(layer.addCellElement(poice), [name] + attributes, 
+                               action.categoryid, action.subcategoryid)
+          action.group.addFeature(feature)
+      elif action.tag == 'coastline':
           if self.coastline == None:
               self.coastline = coastline.CoastLine()
 
           self.coastline.add(coords)
           self.coastlayername = statement.get('layer')
 
-    def _findname(self, statement, tags):
-        if self.nametags != None:
-            for nametag in self.nametags:
-                if nametag in tags:
-                    return tags[nametag]
-        else:       
-            nameelements = statement.findall('name')
-
-            for nameelem in nameelements:
-                if nameelem.get('k') in tags.keys():
-                    return tags[nameelem.get('k')]
-                elif nameelem.text != None:
-                    return nameelem.text
-
-    def addCoastLinePolygon(self, bbox = None):
+    def addCoastLinePolygon(self, bbox = None, tilesize = None, processes = 1):
+        """Add the water polygons created from the coastline to the coast layer
+
+        If tilesize is given the polygons are created per tile of a grid with the
+        given tile size in degrees using the given number of processes.
+        """
         if self.coastline:
             layer, group = self.map.getLayerAndGroupByName(\
                 self.map.mapnumstr + '_' + self.coastlayername )
 
             assert(layer.layertype == Layer.LayerTypePolygon)
 
-            for polygon in self.coastline.polygons(bbox):
+            for polygon in self.coastline.polygons(bbox, tilesize = tilesize, 
+                                                   processes = processes):
                 try:
                     objtype = group.getObjtypeIndex(self.map.getLayerIndex(layer), 1)
                     cellelement = CellElementArea.fromfloat(layer, polygon, 
                                                             objtype=objtype)
                 except GeometryError:
-                    logging.warning('Improper polygon found: ' + str(coords))
+                    logging.warning('Improper polygon found: ' + str(polygon))
                     return
 
                 layer.addCellElement(cellelement)
         else:
             logging.warning("No coastline features found")
+
+    def simplifyLayers(self):
+        """Simplify the polygons and polylines of the layers that have a simplification
+        tolerance
+
+        The vertices that are shared by the polylines of the routing layers are kept
+        since they are the nodes of the routing network.
+        """
+        layers = [layer for layer in self.map.layers if layer.simplifytolerance and 
+                  layer.layertype in (Layer.LayerTypePolygon, Layer.LayerTypePolyline)]
+        if len(layers) == 0:
+            return
+
+        routinglayers = []
+        if self.map.routingcfg != None:
+            routinglayers = self.map.routingcfg.routinglayers
+
+        ## Find the vertices that occur more than once in the routing layers
+        sharedkeys = N.zeros(0, dtype=N.int64)
+        if len([layer for layer in layers if layer in routinglayers]) > 0:
+            keys = [coordkeys(N.array(cellelement.coords, dtype=N.int64)) 
+                    for layer in routinglayers for cellelement in layer.getCellElements()]
+            if len(keys) > 0:
+                keys = N.sort(N.concatenate(keys))
+                sharedkeys = N.unique(keys[1:][keys[1:] == keys[:-1]])
+
+        for layer in layers:
+            logging.info('Simplifying layer %s' % layer.name)
+
+            ## The tolerance is converted from meters to discrete coordinates
+            tolerance = layer.simplifytolerance / (layer.scale[1] * earthradius * math.pi / 180)
+
+            for cellelement, cellelementref in layer.getCellElementsAndRefs():
+                if layer in routinglayers:
+                    keep = contains(sharedkeys, coordkeys(N.array(cellelement.coords, dtype=N.int64)))
+                    simplified = cellelement.simplify(tolerance, keep)
+                else:
+                    simplified = cellelement.simplify(tolerance)
+
+                if simplified is not cellelement:
+                    layer.updateCellElement(cellelementref, simplified)
             
 
-class LoadOsm(handler.ContentHandler, MapBuilder):
-  """Parse an OSM file and add features to a Map"""
+class StatementAction(object):
+  """Statement of the rules compiled with the map objects it refers to
+
+  The layer, group and POI category are looked up once per statement instead of
+  for every element. The objtype index is looked up when the element is added since
+  it is assigned when the objtype is first used.
+  """
+  def __init__(self, builder, statement):
+    mapobj = builder.map
+    self.tag = statement.tag
+    self.layer = self.group = None
+
+    if self.tag in ('polygon', 'polyline', 'point'):
+      self.layer, self.group = mapobj.getLayerAndGroupByName(\
+          mapobj.mapnumstr + '_' + statement.get('layer') )
+      self.layerindex = mapobj.getLayerIndex(self.layer)
+      self.objtype = statement.get('objtype') or 1
+
+      if self.tag == 'polyline':
+        assert(self.layer.layertype == Layer.LayerTypePolyline)
+      elif self.tag == 'point':
+        assert(self.layer.layertype == Layer.LayerTypePoint)
+
+    elif self.tag == 'poi':
+      self.group = mapobj.getPOIGroup()
+      self.layer = mapobj.getPOILayers()[0]
+
+      cat = self.group.catman.getCategoryByName(statement.get('category'))
+      subcat = cat.getSubCategoryByName(statement.get('subcategory') or 'NOSUB1000')
+      self.categoryid = cat.id
+      self.subcategoryid = subcat.id
+      self.poiattributes = [(a.get('k'), a.text) for a in statement.findall('attr')]
+
+    ## Routing attributes of the statement as (name, value) pairs
+    self.routingattributes = []
+    for routing in statement.findall("routing"):
+      for key, value in routing.items():
+        if key == 'oneway':
+          self.routingattributes.append(('bidirectional', value != 'on'))
+        elif key == 'freeway':
+          self.routingattributes.append(('freeway', value == 'on'))
+        elif key == 'speedcat':
+          self.routingattributes.append(('speedcat', int(value)))
+        elif key == 'segmenttype':
+          self.routingattributes.append(('segmenttype', int(value)))
+
+    ## Name tags as (key, default name) pairs
+    if builder.nametags != None:
+      self.names = [(nametag, None) for nametag in builder.nametags]
+    else:
+      self.names = [(nameelem.get('k'), nameelem.text) 
+                    for nameelem in statement.findall('name')]
+
+  def findname(self, tags):
+    for k, text in self.names:
+      if k in tags:
+        return tags[k]
+      elif text != None:
+        return text
+
+class ElementBatch(object):
+  """Compact batch of map elements from MapBuilder.encode_element
+
+  The elements refer to their statements by index and the coordinates of all
+  elements are kept in one array so a batch can be sent efficiently between
+  processes.
+
+  >>> batch = ElementBatch()
+  >>> batch.append(3, N.array([[1, 2], [3, 4]]), u'Storgatan', None)
+  >>> batch.append(5, [(16.5, 58.25)], None, [('speedcat', 2)])
+  >>> for statementindex, coords, name, attributes in batch:
+  ...     print statementindex, coords.tolist(), name, attributes
+  3 [[1, 2], [3, 4]] Storgatan None
+  5 [[16.5, 58.25]] None [('speedcat', 2)]
+
+  """
+  def __init__(self):
+    self.statements = array('i')
+    self.lengths = array('i')
+    self.isfloat = array('b')
+    self.coords = array('l')
+    self.floatcoords = array('d')
+    self.names = []
+    self.attributes = []
+
+  def __len__(self):
+    return len(self.statements)
+
+  def append(self, statementindex, coords, name, attributes):
+    coords = N.asarray(coords)
+    self.statements.append(statementindex)
+    self.lengths.append(len(coords))
+    ## Discrete coordinates are stored as integers and others, like coastlines, as floats
+    if coords.dtype.kind == 'f':
+      self.isfloat.append(1)
+      self.floatcoords.fromstring(coords.astype(float).tostring())
+    else:
+      self.isfloat.append(0)
+      self.coords.fromstring(coords.astype('l').tostring())
+    self.names.append(name)
+    self.attributes.append(attributes)
+
+  def __iter__(self):
+    coords = N.frombuffer(self.coords, dtype='l').reshape(-1, 2)
+    floatcoords = N.frombuffer(self.floatcoords, dtype=float).reshape(-1, 2)
+    pos = [0, 0]
+    for i in xrange(len(self.statements)):
+      isfloat = self.isfloat[i]
+      start = pos[isfloat]
+      pos[isfloat] += self.lengths[i]
+      yield self.statements[i], (coords, floatcoords)[isfloat][start:pos[isfloat]], \
+          self.names[i], self.attributes[i]
+
+class LoadOsm(MapBuilder):
+  """Parse an OSM file and add features to a Map
+
+  The file is parsed with the expat parser. Files ending with .gz or .bz2 are
+  decompressed in a separate thread while the parser is running.
+
+  If twopass is True the ways and relations are scanned in a first pass and only
+  the nodes that are referenced by ways and relations that match the rules are
+  stored in the second pass.
+  """
   def __init__(self, filename, rules, mapobj, nametags = None, 
-               routable = False, inmemory = True):
+               routable = False, inmemory = True, twopass = False):
       MapBuilder.__init__(self, rules, mapobj, nametags, routable)
 
+      ## The node coordinates are stored in the discrete coordinate system of the map
       if inmemory:
-          self.nodes = {}
+          self.nodes = NodeStore(mapobj.scale, mapobj.refpoint)
       else:
-          import bsddb
-          class NodeDictionary(object):
-              def __init__(self):
-                  self.db = bsddb.hashopen(None, 'c')
-                  
-              def __getitem__(self, key):
-                  return struct.unpack('dd', self.db[struct.pack('L',key)])
-
-              def __setitem__(self, key, value): 
-                  self.db[struct.pack('L',key)] = struct.pack('dd', *value)
-
-          self.nodes = NodeDictionary()
+          self.nodes = NodeStore(mapobj.scale, mapobj.refpoint, filename = tempfile.mktemp())
 
       self.ways = []
       self.poicount = 0
       self.stop = False
       self.filename = filename
+      self.twopass = twopass
+      self.tags = {}
+      self.waynodes = []
 
   def load(self):
     if(not os.path.exists(self.filename)):
       raise ValueError("No such data file %s" % self.filename)
     try:
-      parser = make_parser()
-      parser.setContentHandler(self)
-
-      parser.parse(self.filename)
-    except xml.sax._exceptions.SAXParseException:
-      print "Error loading %s" % self.filename
+      try:
+        if self.twopass:
+          self.nodes.restrict(self._scanways())
+        self._read()
+      except expat.ExpatError:
+        print "Error loading %s" % self.filename
+    finally:
+      self.nodes.close()
+
+  def _read(self):
+    self._parse(self.startElement, self.endElement)
+
+  def _parse(self, startElement, endElement):
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    for data in readchunks(self.filename):
+      parser.Parse(data, False)
+    parser.Parse('', True)
+
+  def _scanways(self):
+    """First pass that returns the ids of the nodes referenced by ways and relations
+    that match the rules"""
+    neededids = array('l')
+    refs = array('l')
+
+    def startElement(name, attrs):
+      if name == 'nd':
+        refs.append(int(attrs['ref']))
+      elif name == 'tag':
+        self.tags[attrs['k']] = attrs['v']
+      elif name == 'member':
+        if attrs['type'] == 'node':
+          refs.append(int(attrs['ref']))
+      elif name in ('way', 'relation'):
+        self.tags = {}
+        del refs[:]
+
+    def endElement(name):
+      if name in ('way', 'relation'):
+        self.tags.pop('created_by', None)
+        if self.rules.filterOSMElement(name, self.tags) != None:
+          neededids.extend(refs)
+
+    self._parse(startElement, endElement)
+
+    return N.frombuffer(neededids, dtype='l')
 
   def startElement(self, name, attrs):
-    """Handle XML elements"""
-    if name in('node','way','relation'):
-      self.tags = {}
-      self.waynodes = []
-      if name == 'node':
-        """Nodes need to be stored"""
-        id = int(attrs.get('id'))
-        lat = float(attrs.get('lat'))
-        lon = float(attrs.get('lon'))
-        self.nodes[id] = (lon,lat)
-        self.lastnodecoord = (lon, lat)
-
-    elif name == 'nd':
+    """Handle XML elements, the most frequent elements are tested first"""
+    if name == 'nd':
       """Nodes within a way -- add them to a list"""
-      nodeid = int(attrs.get('ref'))
-      if nodeid in self.nodes:
-          self.waynodes.append(nodeid)
-      else:
-          logging.warning('Ignoring undefined node %d in way'%nodeid)
+      self.waynodes.append(int(attrs['ref']))
+
+    elif name == 'node':
+      """Nodes need to be stored"""
+      coord = (float(attrs['lon']), float(attrs['lat']))
+      self.nodes[int(attrs['id'])] = coord
+      self.lastnodecoord = coord
+      self.tags = {}
 
     elif name == 'tag':
       """Tags - store them in a hash"""
-      k,v = (attrs.get('k'), attrs.get('v'))
-      if not k in ('created_by'):
-        self.tags[k] = v
+      k = attrs['k']
+      if k != 'created_by':
+        self.tags[k] = attrs['v']
+
+    elif name in ('way', 'relation'):
+      self.tags = {}
+      self.waynodes = []
   
   def endElement(self, name):
     """Handle ways in the OSM data"""
     
-    if name not in ('node','way','relation'):
+    if name == 'node':
+      ## Nodes without tags are only used as way vertices
+      if len(self.tags) == 0:
+        return
+    elif name not in ('way', 'relation'):
       return
 
     matchingstatements = self.rules.filterOSMElement(name, self.tags)
@@ -261,13 +487,96 @@ class LoadOsm(handler.ContentHandler, MapBuilder):
       return
 
     if name == 'way':
-        coords = [self.nodes[ref] for ref in self.waynodes]
+        coords, found = self.nodes.lookup(self.waynodes)
+        if not found.all():
+            for ref in N.array(self.waynodes)[~found]:
+                logging.warning('Ignoring undefined node %d in way'%ref)
+            coords = coords[found]
     elif name == 'node':
         coords = [self.lastnodecoord]
+    else:
+        coords = []
 
     for statement in matchingstatements:
         self.add_element(statement, self.tags, coords)
 
+def openosmfile(filename):
+  """Open an OSM file that may be compressed with gzip or bzip2"""
+  if filename.endswith('.gz'):
+    return gzip.open(filename, 'rb')
+  elif filename.endswith('.bz2'):
+    return bz2.BZ2File(filename, 'rb')
+  else:
+    return open(filename, 'rb')
+
+def readchunks(filename, chunksize = 1 << 20, queuesize = 8):
+  """Read an OSM file in chunks. Compressed files are decompressed by a separate thread
+  that is at most queuesize chunks ahead of the reader.
+
+  >>> import tempfile
+  >>> filename = tempfile.mktemp('.osm.gz')
+  >>> f = gzip.open(filename, 'wb')
+  >>> f.writelines([3000 * 'abc'])
+  >>> f.close()
+  >>> chunks = list(readchunks(filename, chunksize = 1000))
+  >>> len(chunks), ''.join(chunks) == 3000 * 'abc'
+  (9, True)
+  >>> os.unlink(filename)
+
+  """
+  f = openosmfile(filename)
+
+  if not filename.endswith(('.gz', '.bz2')):
+    try:
+      while True:
+        data = f.read(chunksize)
+        if not data:
+          break
+        yield data
+    finally:
+      f.close()
+    return
+
+  queue = Queue.Queue(queuesize)
+  error = []
+  stop = threading.Event()
+
+  def decompress():
+    try:
+      try:
+        while not stop.isSet():
+          data = f.read(chunksize)
+          queue.put(data)
+          if not data:
+            break
+      except Exception, e:
+        error.append(e)
+        queue.put('')
+    finally:
+      f.close()
+
+  thread = threading.Thread(target=decompress)
+  thread.setDaemon(True)
+  thread.start()
+
+  try:
+    while True:
+      data = queue.get()
+      if not data:
+        break
+      yield data
+  finally:
+    ## Let the thread finish if the reader stops early
+    stop.set()
+    while thread.isAlive():
+      try:
+        queue.get(timeout = 0.1)
+      except Queue.Empty:
+        pass
+
+  if error:
+    raise error[0]
+
 def downloadOsm(bbox, filename):
   """Download OSM data from www.informationfreeway.org of given bounding box
 
@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
 import magellan.Map as Map
+import magellan.Layer as Layer
 import osmmagellan.osm as osm
-from osmmagellan.osmrulesfast import OSMMagRules as OSMMagRules
+import osmmagellan.pbf as pbf
+#from osmmagellan.osmrulesfast import OSMMagRules as OSMMagRules
 #from osmmagellan.osmrulesfast import OSMMagRulesFast as OSMMagRules
+from osmmagellan.osmrulesfast import OSMMagRulesCompiled as OSMMagRules
 
 import sys
 from optparse import OptionParser, BadOptionError, OptionValueError
@@ -21,7 +24,12 @@ def osmmag(outfile, osmfiles = [], bbox=None, topo=None, name=None,
            scale = None,
            fromdb = False,
            db = 'osm,localhost,osm',
-           download = False):
+           download = False,
+           twopass = False,
+           processes = 1,
+           coastlinetilesize = None,
+           splitlevel = None,
+           simplify = False):
            
     logging.info('Loading rules: %s'%rulefile)
         
@@ -62,6 +70,25 @@ def osmmag(outfile, osmfiles = [], bbox=None, topo=None, name=None,
             if scale:
                 m.scale = scale
 
+            ## Split polygons and polylines that span several cells. The routing layers
+            ## are not split since the routing network refers to whole polylines
+            if splitlevel != None:
+                routinglayers = []
+                if routable:
+                    routinglayers = m.routingcfg.routinglayers
+                for layer in m.layers:
+                    if layer.layertype in (Layer.LayerTypePolygon, Layer.LayerTypePolyline) and \
+                            layer not in routinglayers:
+                        layer.splitlevel = splitlevel
+
+            ## Simplify polygons and polylines with half the pixel size at the most detailed
+            ## zoom level where they are visible unless the rules give a tolerance
+            if simplify:
+                for layer in m.layers:
+                    if layer.layertype in (Layer.LayerTypePolygon, Layer.LayerTypePolyline) and \
+                            layer.simplifytolerance == None:
+                        layer.simplifytolerance = m.getLayerStyle(layer).pixelsize() / 2
+
             ## Read data
             logging.info('Reading osm data and creating map')
 
@@ -78,16 +105,31 @@ def osmmag(outfile, osmfiles = [], bbox=None, topo=None, name=None,
                 
                 ## Add coastline
                 logging.info('Creating hydro polygons from coastline')
-                data.addCoastLinePolygon()
+                data.addCoastLinePolygon(tilesize = coastlinetilesize,
+                                         processes = processes)
+
+                ## Simplify geometries
+                data.simplifyLayers()
             else:
                 for osmfile in osmfiles:
-                    data = osm.LoadOsm(osmfile, rules, m, nametags = nametaglist, 
-                                       routable = routable, inmemory = inmemory)
+                    if osmfile.endswith('.pbf'):
+                        data = pbf.LoadOsmPbf(osmfile, rules, m, nametags = nametaglist, 
+                                              routable = routable, inmemory = inmemory,
+                                              twopass = twopass, processes = processes)
+                    else:
+                        data = osm.LoadOsm(osmfile, rules, m, nametags = nametaglist, 
+                                           routable = routable, inmemory = inmemory,
+                                           twopass = twopass)
                     data.load()
 
                     ## Add coastline
                     logging.info('Creating hydro polygons from coastline')
-                    data.addCoastLinePolygon()
+                    data.addCoastLinePolygon(tilesize = coastlinetilesize,
+                                             processes = processes)
+
+                ## Simplify geometries once all files are loaded
+                if osmfiles:
+                    data.simplifyLayers()
 
             if name:
                 m.name = name
@@ -138,7 +180,7 @@ def parseStringList(option, opt_str, value, parser):
 
 def main():
 
-    usage = 'usage: %prog [options] [file1.osm] [file2.osm] [...]'
+    usage = 'usage: %prog [options] [file1.osm] [file2.osm.pbf] [...]'
     parser = OptionParser(usage=usage,
                           version=version,
                           prog='osmmag',
@@ -203,6 +245,31 @@ def main():
                       default=True,
                       help='Preserve memory by storing geometries on disk')
 
+    parser.add_option('--two-pass', dest='twopass', action='store_true',
+                      default=False,
+                      help='Read the osm files twice to only store the nodes '
+                           'that are used by the map')
+
+    parser.add_option('-j', '--processes', dest='processes', type='int',
+                      default=1, metavar='N',
+                      help='Number of worker processes used to read PBF files '
+                           'and to create the coastline tiles')
+
+    parser.add_option('--coastline-tile-size', dest='coastlinetilesize', type='float',
+                      default=None, metavar='DEGREES',
+                      help='Create the hydro polygons from the coastline in tiles '
+                           'of the given size')
+
+    parser.add_option('--split-level', dest='splitlevel', type='int',
+                      default=None, metavar='LEVEL',
+                      help='Split polygons and polylines that span several cells at the '
+                           'given cell level into one part per cell')
+
+    parser.add_option('--simplify', dest='simplify', action='store_true',
+                      default=False,
+                      help='Simplify polygons and polylines to the resolution of the '
+                           'most detailed zoom level where they are visible')
+
     parser.add_option('--from-database', dest='fromdb', 
                       action='store_true', 
                       default=False,
@@ -253,7 +320,12 @@ def main():
            scale=options.scale,
            bigendian=options.bigendian,
            fromdb=options.fromdb,
-           db=options.db
+           db=options.db,
+           twopass=options.twopass,
+           processes=options.processes,
+           coastlinetilesize=options.coastlinetilesize,
+           splitlevel=options.splitlevel,
+           simplify=options.simplify
            )            
                
 if __name__ == "__main__":
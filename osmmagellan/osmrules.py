@@ -118,6 +118,10 @@ class OSMMagRules(object):
           if layerelem.get("draworder"):
             l.draworder = int(layerelem.get("draworder"))
 
+          ## Set simplification tolerance
+          if layerelem.get("simplify"):
+            l.simplifytolerance = float(layerelem.get("simplify"))
+
           m.addLayer(l, layerstyle = layerstyle)
           g.addLayer(l)
 
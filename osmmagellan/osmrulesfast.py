@@ -2,6 +2,13 @@
 
 from osmrules import *
 
+try:
+    ## python 2.5
+    from xml.etree.cElementTree import XML
+except:
+    ## python 2.4
+    from cElementTree import XML
+
 class Node(object):
   nodetype = 'n'
   
@@ -128,3 +135,152 @@ class OSMMagRulesFast(OSMMagRules):
         return result
 
 
+class RuleCondition(object):
+  """Compiled condition of a rule element with the same semantics as applyRules"""
+  def __init__(self, ruleelem):
+    self.keys = ruleelem.get('k').split('|')
+    self.values = frozenset(ruleelem.get('v').split('|'))
+    self.anyvalue = '*' in self.values
+    self.absentvalue = '~' in self.values
+    self.emptykey = '~' in self.keys
+    self.anykey = '*' in self.keys
+
+  def matches(self, tags):
+    for key in self.keys:
+      if key in tags and (self.anyvalue or tags[key] in self.values):
+        return True
+    if self.emptykey and len(tags) == 0:
+      return True
+    if self.absentvalue:
+      for key in self.keys:
+        if key not in tags:
+          return True
+    if self.anykey and not self.values.isdisjoint(tags.itervalues()):
+      return True
+    return False
+
+class CompiledRules(object):
+  """Rules compiled for one OSM element type
+
+  The rules of other element types are removed and the conditions are parsed once.
+  The items are statements, (condition, items) tuples for rules and (None, items)
+  tuples for else clauses.
+
+  The result of a lookup only depends on the tags with keys used by the rules, the
+  tags with values used by rules with the key * and if there are no tags. The
+  relevantkeys and anykeyvalues attributes are used to select those tags.
+
+  >>> rules = XML('<rules><name k="name"/>'
+  ...             '<rule e="way" k="highway" v="motorway|trunk"> <polyline layer="a"/> </rule>'
+  ...             '<else> <rule e="way" k="*" v="river"> <polyline layer="b"/> </rule> </else>'
+  ...             '<rule e="way" k="~" v="~"> <polygon layer="c"/> </rule></rules>')
+  >>> compiled = CompiledRules(rules, 'way')
+  >>> [[e.get('layer') for e in compiled.lookup(tags)] for tags in
+  ...     ({'highway': 'trunk'}, {'highway': 'primary'}, {'waterway': 'river'}, {})]
+  [[None, 'a'], [None], [None, 'b'], [None]]
+  >>> sorted(compiled.relevantkeys), sorted(compiled.anykeyvalues)
+  (['*', 'highway'], ['river'])
+
+  """
+  def __init__(self, rules, elem):
+    self.elem = elem
+    self.relevantkeys = set()
+    self.anykeyvalues = set()
+    self.items = self._compile(rules)
+
+  def _compile(self, rules):
+    items = []
+    lastruleelem = None
+    for ruleelem in rules.getchildren():
+      if ruleelem.tag == 'rule':
+        ## Rules of other element types never match but still count as the rule before an else
+        if self.elem == ruleelem.get("e"):
+          condition = RuleCondition(ruleelem)
+          self.relevantkeys.update(condition.keys)
+          if condition.anykey:
+            self.anykeyvalues.update(condition.values)
+          items.append((condition, self._compile(ruleelem)))
+      elif ruleelem.tag == 'else':
+        if lastruleelem != None and lastruleelem.tag == 'rule':
+          items.append((None, self._compile(ruleelem)))
+          ## The rest of the rules are never reached
+          break
+        else:
+          raise ValueError('else clause must be preceeded by rule')
+      else:
+        items.append(ruleelem)
+      lastruleelem = ruleelem
+    return items
+
+  def lookup(self, tags):
+    """Return the list of matching statements"""
+    result = []
+    items = self.items
+    i = 0
+    while i < len(items):
+      item = items[i]
+      i += 1
+      if type(item) is tuple:
+        condition, subitems = item
+        if condition == None or condition.matches(tags):
+          items = subitems
+          i = 0
+      else:
+        result.append(item)
+    return result
+
+  def cachekey(self, tags):
+    """Return the part of the tags that the result of lookup depends on"""
+    relevantkeys = self.relevantkeys
+    anykeyvalues = self.anykeyvalues
+    return (len(tags) == 0,
+            frozenset([(k, v) for k, v in tags.iteritems()
+                       if k in relevantkeys or v in anykeyvalues]))
+
+class OSMMagRulesCompiled(OSMMagRules):
+    """Rules that are compiled per element type with memoized results
+
+    The results are cached by element type and the tags that are relevant to the
+    rules. The cache is cleared when it holds more than cachesize results.
+
+    >>> r = OSMMagRulesCompiled('test/data/testrules.xml')
+    >>> [e.tag for e in r.filterOSMElement('node', {'amenity': 'fuel', 'name': 'Q8'})]
+    ['poi']
+    >>> r.filterOSMElement('node', {'amenity': 'fuel', 'name': 'OKQ8'}) is \\
+    ...     r.filterOSMElement('node', {'amenity': 'fuel'})
+    True
+    >>> r.filterOSMElement('way', {'amenity': 'fuel'})
+    
+    """
+    cachesize = 100000
+
+    def __init__(self, filename):
+        super(OSMMagRulesCompiled, self).__init__(filename)
+        self.compiled = {}
+        self.cache = {}
+
+    def filterOSMElement(self, elementname, tags):
+        compiled = self.compiled.get(elementname)
+        if compiled == None:
+            compiled = self.compiled[elementname] = \
+                CompiledRules(self.root.find("rules"), elementname)
+
+        key = (elementname, compiled.cachekey(tags))
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+
+        elements = compiled.lookup(tags)
+        if len(elements) == 0:
+            result = None
+        else:
+            result = Element('result')
+            for element in elements:
+                result.append(element)
+
+        if len(self.cache) >= self.cachesize:
+            self.cache.clear()
+        self.cache[key] = result
+
+        return result
@@ -0,0 +1,478 @@
+"""
+The pbf module reads OpenStreetMap files in the binary PBF format
+
+A PBF file is a sequence of zlib compressed blobs with protocol buffer encoded
+primitive blocks. The protocol buffer wire format is decoded directly so no
+protocol buffer library is needed. The packed and delta coded arrays of dense
+nodes and way references are decoded with numpy.
+"""
+import struct
+import zlib
+import collections
+import multiprocessing
+
+import numpy as N
+
+import osm
+
+## Features of the OSMHeader block that the reader supports
+supportedfeatures = ('OsmSchema-V0.6', 'DenseNodes')
+
+## Member types of relations
+MemberNode, MemberWay, MemberRelation = range(3)
+
+def varint(data, pos):
+    """Decode a varint at position pos of a string, returns the value and the position after it
+
+    >>> varint('\\x96\\x01\\x08', 0)
+    (150, 2)
+
+    """
+    result = 0
+    shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def int64(value):
+    """Convert a decoded varint to a signed 64-bit integer"""
+    if value >= 1 << 63:
+        return value - (1 << 64)
+    return value
+
+def sint64(value):
+    """Decode a zigzag encoded varint
+
+    >>> [sint64(v) for v in (0, 1, 2, 3)]
+    [0, -1, 1, -2]
+
+    """
+    return (value >> 1) ^ -(value & 1)
+
+def fields(data):
+    """Iterate over the fields of a protocol buffer message
+
+    Yields the field number and the value which is an integer for varint fields and
+    a string for the other wire types.
+
+    >>> list(fields('\\x08\\x96\\x01\\x12\\x02ab'))
+    [(1, 150), (2, 'ab')]
+
+    """
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = varint(data, pos)
+        number, wiretype = key >> 3, key & 7
+        if wiretype == 0:
+            value, pos = varint(data, pos)
+        elif wiretype == 2:
+            length, pos = varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wiretype == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wiretype == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError('Unsupported protocol buffer wire type %d' % wiretype)
+        yield number, value
+
+def unpacklist(data):
+    """Decode a short packed array of varints to a list
+
+    >>> unpacklist('\\x03\\x96\\x01')
+    [3, 150]
+
+    """
+    values = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        value, pos = varint(data, pos)
+        values.append(value)
+    return values
+
+def unpackvarints(data):
+    """Decode a packed array of varints to an uint64 array. Use unpacklist for short arrays
+
+    >>> unpackvarints('\\x03\\x96\\x01\\x00')
+    array([  3, 150,   0], dtype=uint64)
+
+    """
+    b = N.frombuffer(data, dtype=N.uint8)
+    ends = N.flatnonzero(b < 0x80)
+    if len(b) > 0 and (len(ends) == 0 or ends[-1] != len(b) - 1):
+        raise ValueError('Truncated packed varint array')
+
+    ## Fast path when all values fit in one byte
+    if len(ends) == len(b):
+        return b.astype(N.uint64)
+
+    starts = N.zeros(len(ends), dtype=N.int64)
+    starts[1:] = ends[:-1] + 1
+    shifts = 7 * (N.arange(len(b)) - N.repeat(starts, ends - starts + 1))
+    values = (b & 0x7f).astype(N.uint64) << shifts.astype(N.uint64)
+    return N.bitwise_or.reduceat(values, starts)
+
+def unpacksint64(data, delta = False):
+    """Decode a packed array of zigzag encoded varints to an int64 array. If delta is
+    True the values are delta coded.
+
+    >>> unpacksint64('\\x14\\x01\\x04', delta = True)
+    array([10,  9, 11])
+
+    """
+    values = unpackvarints(data)
+    values = (values >> N.uint64(1)).astype(N.int64) ^ -(values & N.uint64(1)).astype(N.int64)
+    if delta:
+        return N.cumsum(values)
+    return values
+
+class PrimitiveBlock(object):
+    """Decoded header of a primitive block with the string table and coordinate encoding
+
+    The primitive groups are kept encoded in the groups attribute.
+    """
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.latoffset = 0
+        self.lonoffset = 0
+
+        for number, value in fields(data):
+            if number == 1:
+                self.strings = [s.decode('utf-8') for n, s in fields(value) if n == 1]
+            elif number == 2:
+                self.groups.append(value)
+            elif number == 17:
+                self.granularity = value
+            elif number == 19:
+                self.latoffset = int64(value)
+            elif number == 20:
+                self.lonoffset = int64(value)
+
+    def lonlat(self, lon, lat):
+        """Convert arrays of encoded coordinates to an (n, 2) array of longitude and latitude"""
+        coords = N.empty((len(lon), 2))
+        coords[:, 0] = (self.lonoffset + self.granularity * N.asarray(lon)) / 1e9
+        coords[:, 1] = (self.latoffset + self.granularity * N.asarray(lat)) / 1e9
+        return coords
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return dict([(strings[k], strings[v]) for k, v in zip(keys, vals)])
+
+def readblobs(filename):
+    """Iterate over the compressed data blobs of a PBF file
+
+    The header blob is checked for unsupported features and is not returned.
+    """
+    f = open(filename, 'rb')
+    try:
+        while True:
+            data = f.read(4)
+            if not data:
+                break
+            if len(data) < 4:
+                raise ValueError('Truncated PBF file %s' % filename)
+
+            header = dict(fields(f.read(struct.unpack('>I', data)[0])))
+            blob = f.read(header[3])
+
+            if header[1] == 'OSMHeader':
+                for number, value in fields(decodeblob(blob)):
+                    if number == 4 and value not in supportedfeatures:
+                        raise ValueError('Unsupported PBF feature %s in %s' % (value, filename))
+            elif header[1] == 'OSMData':
+                yield blob
+    finally:
+        f.close()
+
+def decodeblob(data):
+    """Return the uncompressed data of a blob"""
+    blob = dict(fields(data))
+    if 1 in blob:
+        return blob[1]
+    elif 3 in blob:
+        return zlib.decompress(blob[3])
+    else:
+        raise ValueError('Unsupported PBF blob compression')
+
+def readblocks(filename):
+    """Iterate over the primitive blocks of a PBF file"""
+    for blob in readblobs(filename):
+        yield PrimitiveBlock(decodeblob(blob))
+
+def decodenode(block, data):
+    """Decode a node message, returns id, tags and coordinate"""
+    id, keys, vals, lon, lat = 0, (), (), 0, 0
+    for number, value in fields(data):
+        if number == 1:
+            id = sint64(value)
+        elif number == 2:
+            keys = unpacklist(value)
+        elif number == 3:
+            vals = unpacklist(value)
+        elif number == 8:
+            lat = sint64(value)
+        elif number == 9:
+            lon = sint64(value)
+    return id, block.tags(keys, vals), ((block.lonoffset + block.granularity * lon) / 1e9,
+                                        (block.latoffset + block.granularity * lat) / 1e9)
+
+def decodedensenodes(block, data):
+    """Decode a dense nodes message
+
+    Returns the ids, the coordinates as an (n, 2) array and a list of the indices
+    and tags of the nodes that have tags
+    """
+    ids = lat = lon = N.zeros(0, dtype=N.int64)
+    keysvals = None
+    for number, value in fields(data):
+        if number == 1:
+            ids = unpacksint64(value, delta = True)
+        elif number == 8:
+            lat = unpacksint64(value, delta = True)
+        elif number == 9:
+            lon = unpacksint64(value, delta = True)
+        elif number == 10:
+            keysvals = unpackvarints(value).astype(N.int64)
+
+    taggednodes = []
+    if keysvals is not None and len(keysvals) > 0:
+        ## The tags of each node are stored as key and value string indices terminated by 0
+        ends = N.flatnonzero(keysvals == 0)
+        starts = N.zeros(len(ends), dtype=N.int64)
+        starts[1:] = ends[:-1] + 1
+        for i in N.flatnonzero(ends > starts):
+            kv = keysvals[starts[i]:ends[i]]
+            taggednodes.append((i, block.tags(kv[::2], kv[1::2])))
+
+    return ids, block.lonlat(lon, lat), taggednodes
+
+def decodeway(block, data):
+    """Decode a way message, returns id, tags and the node references"""
+    id, keys, vals, refs = 0, (), (), N.zeros(0, dtype=N.int64)
+    for number, value in fields(data):
+        if number == 1:
+            id = int64(value)
+        elif number == 2:
+            keys = unpacklist(value)
+        elif number == 3:
+            vals = unpacklist(value)
+        elif number == 8:
+            refs = unpacksint64(value, delta = True)
+    return id, block.tags(keys, vals), refs
+
+def decoderelation(block, data):
+    """Decode a relation message, returns id, tags and the member references and types"""
+    id, keys, vals = 0, (), ()
+    memids = N.zeros(0, dtype=N.int64)
+    types = N.zeros(0, dtype=N.uint64)
+    for number, value in fields(data):
+        if number == 1:
+            id = int64(value)
+        elif number == 2:
+            keys = unpacklist(value)
+        elif number == 3:
+            vals = unpacklist(value)
+        elif number == 9:
+            memids = unpacksint64(value, delta = True)
+        elif number == 10:
+            types = unpackvarints(value)
+    return id, block.tags(keys, vals), memids, types
+
+class LoadOsmPbf(osm.LoadOsm):
+    """Parse an OSM PBF file and add features to a Map
+
+    The elements are passed to the same rule matching as the XML elements in LoadOsm.
+
+    If processes is larger than 1 the blocks are decoded by worker processes that
+    also do the rule matching and the conversion to discrete coordinates. The workers
+    send batches of encoded map elements to the main process that only adds them to
+    the layers and groups of the map. The nodes are read by a first set of workers
+    and the ways and relations by a second set of workers that are started when all
+    nodes are stored.
+    """
+    def __init__(self, filename, rules, mapobj, nametags = None, 
+                 routable = False, inmemory = True, twopass = False, processes = 1):
+        osm.LoadOsm.__init__(self, filename, rules, mapobj, nametags = nametags,
+                             routable = routable, inmemory = inmemory, twopass = twopass)
+        self.processes = processes
+
+        ## Batch of encoded elements when running in a worker process
+        self.batch = None
+
+    def add_element(self, statement, tags, coords):
+        if self.batch == None:
+            osm.LoadOsm.add_element(self, statement, tags, coords)
+        else:
+            element = self.encode_element(statement, tags, coords)
+            if element != None:
+                self.batch.append(self.statementindex[statement], *element)
+
+    def _read(self):
+        if self.processes > 1:
+            self._readparallel()
+        else:
+            for block in readblocks(self.filename):
+                self._readblock(block, self.nodes.extend)
+
+    def _readparallel(self):
+        ## The statements are sent by index, the workers inherit the rules when forked
+        statements = list(self.rules.root.getiterator())
+        self.statementindex = dict([(statement, i) for i, statement in enumerate(statements)])
+
+        wayblobs = set()
+        results = self._map(_readnodes, readblobs(self.filename))
+        for i, (nodeids, nodecoords, batch, hasways) in enumerate(results):
+            for ids, coords in zip(nodeids, nodecoords):
+                self.nodes.extend(ids, coords)
+            self._placebatch(statements, batch)
+            if hasways:
+                wayblobs.add(i)
+
+        ## Sort the nodes before the second set of workers is forked
+        self.nodes.finalize()
+
+        blobs = (blob for i, blob in enumerate(readblobs(self.filename)) if i in wayblobs)
+        for nodeids, nodecoords, batch, hasways in self._map(_readways, blobs):
+            self._placebatch(statements, batch)
+
+    def _placebatch(self, statements, batch):
+        for statementindex, coords, name, attributes in batch:
+            self.place_element(statements[statementindex], coords, name, attributes)
+
+    def _map(self, function, blobs):
+        """Apply a worker function to blobs in worker processes and iterate over the
+        results in order. At most two blobs per process are read ahead."""
+        global _loader
+        _loader = self
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            pending = collections.deque()
+            for blob in blobs:
+                pending.append(pool.apply_async(function, (blob,)))
+                if len(pending) >= 2 * self.processes:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            _loader = None
+            pool.terminate()
+            pool.join()
+
+    def _readencoded(self, blob, nodes, ways):
+        """Read a blob in a worker process
+
+        Returns the node ids and coordinates, the batch of encoded elements and
+        if the block has ways or relations
+        """
+        nodeids = []
+        nodecoords = []
+        def addnodes(ids, coords):
+            nodeids.append(ids)
+            nodecoords.append(coords)
+
+        self.batch = osm.ElementBatch()
+        try:
+            hasways = self._readblock(PrimitiveBlock(decodeblob(blob)), addnodes, nodes, ways)
+            return nodeids, nodecoords, self.batch, hasways
+        finally:
+            self.batch = None
+
+    def _readblock(self, block, addnodes, nodes = True, ways = True):
+        """Read the elements of a primitive block, the ids and coordinates of the nodes
+        are passed to addnodes. Returns True if the block has ways or relations."""
+        hasways = False
+        for group in block.groups:
+            nodeids = []
+            nodecoords = []
+            for number, data in fields(group):
+                if number in (3, 4):
+                    hasways = True
+                    if not ways:
+                        break
+                elif not nodes:
+                    break
+
+                if number == 2:
+                    ids, coords, taggednodes = decodedensenodes(block, data)
+                    addnodes(ids, coords)
+                    for i, tags in taggednodes:
+                        self._element('node', tags, lastnodecoord = tuple(coords[i]))
+                elif number == 3:
+                    id, tags, refs = decodeway(block, data)
+                    self._element('way', tags, waynodes = refs)
+                elif number == 1:
+                    id, tags, coord = decodenode(block, data)
+                    nodeids.append(id)
+                    nodecoords.append(coord)
+                    self._element('node', tags, lastnodecoord = coord)
+                elif number == 4:
+                    id, tags, memids, types = decoderelation(block, data)
+                    self._element('relation', tags)
+
+            if nodeids:
+                addnodes(N.array(nodeids, dtype=N.int64), N.array(nodecoords))
+        return hasways
+
+    def _element(self, name, tags, lastnodecoord = None, waynodes = None):
+        tags.pop('created_by', None)
+        self.tags = tags
+        self.lastnodecoord = lastnodecoord
+        self.waynodes = waynodes
+        self.endElement(name)
+
+    def _scanways(self):
+        """First pass that returns the ids of the nodes referenced by ways and relations
+        that match the rules"""
+        if self.processes > 1:
+            neededids = list(self._map(_scanblob, readblobs(self.filename)))
+        else:
+            neededids = [self._scanblock(block) for block in readblocks(self.filename)]
+        return N.concatenate([N.zeros(0, dtype=N.int64)] + neededids)
+
+    def _scanblock(self, block):
+        neededids = [N.zeros(0, dtype=N.int64)]
+        for group in block.groups:
+            for number, data in fields(group):
+                if number == 3:
+                    id, tags, refs = decodeway(block, data)
+                    name = 'way'
+                elif number == 4:
+                    id, tags, memids, types = decoderelation(block, data)
+                    refs = memids[types == MemberNode]
+                    name = 'relation'
+                else:
+                    break
+
+                tags.pop('created_by', None)
+                if self.rules.filterOSMElement(name, tags) != None:
+                    neededids.append(refs)
+
+        return N.concatenate(neededids)
+
+## Loader used by the worker functions, it is set before the worker processes are forked
+_loader = None
+
+def _readnodes(blob):
+    return _loader._readencoded(blob, nodes = True, ways = False)
+
+def _readways(blob):
+    return _loader._readencoded(blob, nodes = False, ways = True)
+
+def _scanblob(blob):
+    return _loader._scanblock(PrimitiveBlock(decodeblob(blob)))
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
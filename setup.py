@@ -13,6 +13,7 @@ setup(name='pymagellan',
       scripts=[os.path.join('magellan', 'scripts', 'imgextract.py'),
                os.path.join('magellan', 'scripts', 'imgcreate.py'),
                os.path.join('magellan', 'scripts', 'mag2ogr.py'),
+               os.path.join('magellan', 'scripts', 'routingcheck.py'),
                os.path.join('osmmagellan', 'osmmag.py')
                ]
      )